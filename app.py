@@ -1,5 +1,5 @@
 from typing import Literal, Optional
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,14 +10,37 @@ import prometheus_client
 from processor.metadata import list_pending_uuids
 from processor.handler import preprocess_file
 from processor.utils.settings import settings
+from processor.config import config
+from processor.jobs import JobQueue, Scheduler
+from processor.metrics import jobs_queued
 from processor.logger import logger
 from processor import __version__
 
 
+# create the long-lived scheduler for all dispatched files
+scheduler = Scheduler(
+    JobQueue(config.dispatch_queue_path, retention=config.dispatch_retention),
+    worker=preprocess_file,
+    max_workers=config.dispatch_workers
+)
+
+# report the length of the dispatch queue on each scrape
+jobs_queued.set_function(lambda: len(scheduler.queue.list('queued')))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # start the workers and pick up the jobs queued before the last shutdown
+    scheduler.start()
+    yield
+    scheduler.stop(wait=False)
+
+
 app = FastAPI(
     title="Deadwood AI upload preprocessor",
     description="This is a simplistic API around two preprocessing entrypoints: `/dispatch/all` and `/dispatch/{uuid}`",
     version=__version__,
+    lifespan=lifespan,
 )
 
 # Add CORS middleware
@@ -44,11 +67,19 @@ def get_pending() -> list[str]:
     """
     return list_pending_uuids()
 
+@app.get("/files/queued")
+def get_queued() -> list[str]:
+    """
+    Get a list of all files waiting in the dispatch queue
+    """
+    return scheduler.queue.list('queued')
+
+
 @app.post("/dispatch")
 @app.post("/dispatch/{uuid}")
-async def dispatch(uuid: str = 'all', body: SupabaseWebhookPayload | None = None):
+def dispatch(uuid: str = 'all', body: SupabaseWebhookPayload | None = None, priority: int = 0):
     """
-    Dispatch a file for preprocessing.
+    Dispatch a file for preprocessing. Files with a higher priority are processed first.
     The API will not wait for the process to be finished.
     """
     # handle supabase webhook payloads
@@ -63,14 +94,14 @@ async def dispatch(uuid: str = 'all', body: SupabaseWebhookPayload | None = None
     if uuid == 'all':
         uuids = list_pending_uuids()
         
-        # dispatch them all
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for uuid in uuids:
-                executor.submit(preprocess_file, uuid)
-        logger.info(f"Dispatching {len(uuids)} preprocessor threads over /dispatch by API using uuid: 'all'")
+        # queue them all, uuids already in the queue are skipped
+        queued = [uuid for uuid in uuids if scheduler.submit(uuid, priority=priority)]
+        logger.info(f"Dispatching {len(queued)} of {len(uuids)} pending files over /dispatch by API using uuid: 'all'")
     else:
-        ThreadPoolExecutor().submit(preprocess_file, uuid)
-        logger.info(f"Dispatching preprocessor by invoking /dispatch/{uuid}")
+        if scheduler.submit(uuid, priority=priority):
+            logger.info(f"Dispatching preprocessor by invoking /dispatch/{uuid}")
+        else:
+            return {"status": "already queued"}
     
     return {"status": "dispatched"}
 
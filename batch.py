@@ -0,0 +1,25 @@
+"""
+Process local rasters without the backend, ie.:
+
+    python batch.py /data/raw /data/processed --manifest=/data/manifest.json
+    python batch.py "/data/raw/**/*.tif" /data/processed --workers=4 --register=True
+
+"""
+import logging
+
+import fire
+
+from processor.batch import process_batch
+from processor.pool import shutdown
+
+
+def run(*args, **kwargs):
+    try:
+        process_batch(*args, **kwargs)
+    finally:
+        shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    fire.Fire(run)
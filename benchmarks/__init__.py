@@ -0,0 +1,11 @@
+"""
+Benchmarks of the resampling and the full processing pipeline.
+
+The pipeline benchmark runs against in-process fakes of the Supabase backend and
+the SSH servers, so it needs neither of them. Run it with:
+
+    python -m benchmarks resample --width=8192 --height=8192 --drivers=GTiff,COG
+    python -m benchmarks pipeline --files=8 --remote=True
+    python -m benchmarks compare benchmarks/results/a-resample.json benchmarks/results/b-resample.json
+
+"""
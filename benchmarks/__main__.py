@@ -0,0 +1,11 @@
+import fire
+
+from .runner import benchmark_resample, benchmark_pipeline, compare
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        "resample": benchmark_resample,
+        "pipeline": benchmark_pipeline,
+        "compare": compare,
+    })
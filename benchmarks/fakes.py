@@ -0,0 +1,254 @@
+"""
+In-process stand-ins for the Supabase backend and the SSH servers.
+
+The fake backend keeps the tables in memory and understands the few PostgREST
+filters the processor uses. The fake SSH connection works on the local filesystem,
+so the remote code paths (chunked download, streaming upload, layer includes) run
+for real, only without the network in between.
+
+"""
+from typing import Any, Callable, Dict, List, Optional
+from types import SimpleNamespace
+from pathlib import Path
+import subprocess
+import threading
+import shutil
+import time
+import os
+
+from processor import auth, ssh
+from processor.utils.settings import settings
+from processor.config import config
+
+
+class FakeResponse:
+    def __init__(self, data: Any):
+        self.data = data
+
+
+class FakeQuery:
+    def __init__(self, backend: "FakeBackend", table: str):
+        self.backend = backend
+        self.table = table
+        self.filters: List[Callable[[dict], bool]] = []
+        self.operation = ("select",)
+        self.max_rows: Optional[int] = None
+        self.order_by: Optional[str] = None
+        self.as_single = False
+
+    # filters
+    def eq(self, column: str, value: Any) -> "FakeQuery":
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column: str, values: List[Any]) -> "FakeQuery":
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def lt(self, column: str, value: Any) -> "FakeQuery":
+        self.filters.append(lambda row: row.get(column) is not None and row.get(column) < value)
+        return self
+
+    def gt(self, column: str, value: Any) -> "FakeQuery":
+        self.filters.append(lambda row: row.get(column) is not None and row.get(column) > value)
+        return self
+
+    def order(self, column: str) -> "FakeQuery":
+        self.order_by = column
+        return self
+
+    def limit(self, n: int) -> "FakeQuery":
+        self.max_rows = n
+        return self
+
+    def single(self) -> "FakeQuery":
+        self.as_single = True
+        return self
+
+    # operations
+    def select(self, *columns: str) -> "FakeQuery":
+        self.operation = ("select",)
+        return self
+
+    def update(self, values: dict) -> "FakeQuery":
+        self.operation = ("update", values)
+        return self
+
+    def delete(self) -> "FakeQuery":
+        self.operation = ("delete",)
+        return self
+
+    def insert(self, rows: dict | List[dict]) -> "FakeQuery":
+        self.operation = ("insert", rows if isinstance(rows, list) else [rows])
+        return self
+
+    def upsert(self, rows: dict | List[dict], on_conflict: str = "uuid", ignore_duplicates: bool = False, **kwargs) -> "FakeQuery":
+        self.operation = ("upsert", rows if isinstance(rows, list) else [rows], on_conflict, ignore_duplicates)
+        return self
+
+    def execute(self) -> FakeResponse:
+        time.sleep(self.backend.latency)
+        with self.backend.lock:
+            table = self.backend.tables.setdefault(self.table, [])
+            matches = [row for row in table if all(f(row) for f in self.filters)]
+            if self.order_by is not None:
+                matches.sort(key=lambda row: row.get(self.order_by))
+            kind = self.operation[0]
+
+            if kind == "select":
+                data = [dict(row) for row in matches][:self.max_rows]
+            elif kind == "update":
+                for row in matches:
+                    row.update(self.operation[1])
+                data = [dict(row) for row in matches]
+            elif kind == "delete":
+                self.backend.tables[self.table] = [row for row in table if row not in matches]
+                data = matches
+            elif kind == "insert":
+                table.extend(dict(row) for row in self.operation[1])
+                data = self.operation[1]
+            else:
+                _, rows, key, ignore_duplicates = self.operation
+                data = []
+                for row in rows:
+                    existing = next((r for r in table if r.get(key) == row[key]), None)
+                    if existing is None:
+                        table.append(dict(row))
+                    elif ignore_duplicates:
+                        continue
+                    else:
+                        existing.update(row)
+                    data.append(dict(row))
+
+        if self.as_single:
+            if len(data) != 1:
+                raise ValueError(f"Expected a single row from {self.table}, found {len(data)}.")
+            data = data[0]
+        return FakeResponse(data)
+
+
+class FakeBackend:
+    """
+    A Supabase client with in-memory tables. latency is added to each request.
+    """
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.tables: Dict[str, List[dict]] = {}
+        self.lock = threading.Lock()
+        self.postgrest = SimpleNamespace(auth=lambda token: None)
+        self.user_id: Optional[str] = None
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def login(self) -> SimpleNamespace:
+        # a session that never expires
+        session = SimpleNamespace(access_token="benchmark", refresh_token="benchmark", expires_at=time.time() + 10**9, expires_in=None)
+        return SimpleNamespace(session=session, user=SimpleNamespace(id="benchmark"))
+
+
+class FakeRemoteFile:
+    """
+    A local file with the parts of the paramiko SFTPFile interface the processor uses.
+    """
+    def __init__(self, path: str, mode: str):
+        self._f = open(path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self._f, name)
+
+    def set_pipelined(self, pipelined: bool = True):
+        pass
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            self._f.seek(offset)
+            yield self._f.read(length)
+
+
+class FakeSFTP:
+    def stat(self, path: str) -> os.stat_result:
+        return os.stat(path)
+
+    def open(self, path: str, mode: str = "r") -> FakeRemoteFile:
+        return FakeRemoteFile(path, mode)
+
+    def putfo(self, fo, path: str):
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fo, f)
+
+    def posix_rename(self, src: str, dst: str):
+        os.replace(src, dst)
+
+    def remove(self, path: str):
+        os.remove(path)
+
+
+class FakeConnection:
+    """
+    A fabric Connection that runs commands and file transfers on the local machine.
+    """
+    def __init__(self):
+        self.is_connected = False
+        self._sftp = FakeSFTP()
+        transport = SimpleNamespace(is_active=lambda: self.is_connected, send_ignore=lambda: None)
+        self.client = SimpleNamespace(get_transport=lambda: transport)
+
+    def open(self):
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+
+    def sftp(self) -> FakeSFTP:
+        return self._sftp
+
+    def run(self, command: str, hide: bool = False, warn: bool = False):
+        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        if result.returncode != 0 and not warn:
+            raise RuntimeError(f"Command failed: {command}\n{result.stderr}")
+        return SimpleNamespace(stdout=result.stdout, stderr=result.stderr, return_code=result.returncode, ok=result.returncode == 0)
+
+    def get(self, remote: str, local: str):
+        shutil.copyfile(remote, local)
+
+    def put(self, local: str, remote: str):
+        shutil.copyfile(local, remote)
+
+
+def install(workdir: str, remote: bool = False, latency: float = 0.0) -> FakeBackend:
+    """
+    Point the processor at a fake backend and the directories below workdir. With
+    remote=True, storage and mapserver are reached through the fake SSH connections.
+
+    Returns the fake backend to insert metadata rows into
+    """
+    workdir = Path(workdir)
+    for name in ("raw", "archive", "processed", "mapfiles"):
+        (workdir / name).mkdir(parents=True, exist_ok=True)
+
+    settings.storage_local = not remote
+    settings.mapserver_local = not remote
+    settings.archive_path = workdir / "archive"
+    settings.processed_path = str(workdir / "processed")
+    settings.mapfile_path = workdir / "mapfiles"
+
+    # the benchmarks process the same raster several times, which must not hit the cache
+    config.cache_max_size = 0
+
+    # replace the backend
+    backend = FakeBackend(latency=latency)
+    auth.get_client = lambda: backend
+    auth.direct_authenticate_processor = backend.login
+
+    # replace the SSH connections
+    for server in ("storage", "mapserver"):
+        ssh.get_pool(server).factory = FakeConnection
+
+    return backend
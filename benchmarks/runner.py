@@ -0,0 +1,258 @@
+"""
+Run the benchmark cases and keep their results.
+
+Each case runs in a fresh process, so that the peak memory of one case does not
+hide the peak of the next. The results are saved as JSON together with the
+versions and the commit they were measured on, so runs can be compared later.
+
+"""
+from typing import Any, Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import multiprocessing
+import subprocess
+import itertools
+import platform
+import resource
+import shutil
+import json
+import time
+import os
+import uuid as uuidlib
+
+import rasterio
+
+from .synthetic import make_raster
+
+
+# the default directory of the saved results, it is not tracked by git
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def as_list(value: Any) -> List[Any]:
+    # fire passes comma separated values either as a string or as a tuple
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(",") if v.strip()]
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux. The pipeline resamples in child processes
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = None
+
+    return dict(
+        commit=commit,
+        python=platform.python_version(),
+        rasterio=rasterio.__version__,
+        gdal=rasterio.__gdal_version__,
+        cpus=os.cpu_count(),
+        machine=platform.machine(),
+    )
+
+
+def run_isolated(func, *args, **kwargs) -> dict:
+    """
+    Run func in a new spawned process and return its result.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(func, *args, **kwargs).result()
+
+
+def _resample_case(input_file: str, output_file: str, driver: str, compress: str, quality: int, scale_factor: float, num_threads: int) -> dict:
+    from processor.resample import resample
+
+    with rasterio.open(input_file) as src:
+        megapixels = src.width * src.height / 1e6
+
+    t1 = time.time()
+    resample(
+        input_file,
+        output_file,
+        scale_factor=scale_factor,
+        driver=driver,
+        compress=compress,
+        jpeg_quality=quality,
+        num_threads=num_threads
+    )
+    elapsed = time.time() - t1
+
+    return dict(
+        seconds=elapsed,
+        megapixels_per_second=megapixels / elapsed,
+        output_bytes=os.path.getsize(output_file),
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def _pipeline_case(raw_files: List[str], workdir: str, remote: bool, latency: float, driver: str, compress: str, quality: int, scale_factor: float) -> dict:
+    from .fakes import install
+    from processor.utils.settings import settings
+    from processor.handler import dispatch_pending_files
+    from processor.metrics import stage_time
+    from processor import pool
+
+    backend = install(workdir, remote=remote, latency=latency)
+    settings.processor_image_driver = driver
+    settings.processor_compression = compress
+    settings.compression_quality = quality
+    settings.scale_factor = scale_factor
+
+    # copy the raw files into the upload directory, the pipeline archives them
+    megapixels, raw_bytes = 0.0, 0
+    for path in raw_files:
+        file_id = f"{uuidlib.uuid4()}.tif"
+        raw_path = Path(workdir) / "raw" / file_id
+        shutil.copyfile(path, raw_path)
+        with rasterio.open(raw_path) as src:
+            megapixels += src.width * src.height / 1e6
+        raw_bytes += raw_path.stat().st_size
+        backend.table(settings.metadata_table).insert(dict(
+            uuid=str(uuidlib.uuid4()),
+            file_id=file_id,
+            file_name=file_id,
+            file_size=raw_path.stat().st_size,
+            raw_path=str(raw_path),
+            status="pending",
+            user_id="benchmark",
+            copy_time=0.0,
+        )).execute()
+
+    t1 = time.time()
+    dispatch_pending_files()
+    elapsed = time.time() - t1
+    pool.shutdown()
+
+    rows = backend.tables[settings.metadata_table]
+    stages = {
+        sample.labels["stage"]: sample.value
+        for metric in stage_time.collect() for sample in metric.samples if sample.name.endswith("_sum")
+    }
+    return dict(
+        seconds=elapsed,
+        files_per_second=len(raw_files) / elapsed,
+        megapixels_per_second=megapixels / elapsed,
+        raw_bytes=raw_bytes,
+        output_bytes=sum(os.path.getsize(row["processed_path"]) for row in rows if row.get("processed_path")),
+        processed=sum(row["status"] == "processed" for row in rows),
+        stage_seconds=stages,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def save(kind: str, params: dict, cases: List[dict], name: Optional[str] = None, results_dir: Optional[str] = None) -> Path:
+    results_dir = Path(results_dir) if results_dir is not None else RESULTS_DIR
+    results_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = results_dir / f"{name or stamp}-{kind}.json"
+    with open(path, "w") as f:
+        json.dump(dict(kind=kind, created=stamp, environment=environment(), params=params, cases=cases), f, indent=2)
+
+    return path
+
+
+def benchmark_resample(
+    width: int = 4096,
+    height: int = 4096,
+    count: int = 3,
+    dtype: str = "uint8",
+    crs: str = "utm",
+    drivers: Any = "GTiff,COG",
+    compressions: Any = "jpeg,deflate",
+    scale_factors: Any = "0.1,0.25",
+    quality: int = 75,
+    threads: int = 1,
+    name: Optional[str] = None,
+    results_dir: Optional[str] = None
+) -> Path:
+    """
+    Time resample() for each combination of driver, compression and scale factor
+    on a synthetic raster. The results are saved into results_dir, by default
+    benchmarks/results.
+    """
+    params = dict(width=width, height=height, count=count, dtype=dtype, crs=crs, quality=quality, threads=threads)
+    cases = []
+    with TemporaryDirectory() as tmp:
+        input_file = make_raster(str(Path(tmp) / "input.tif"), width, height, count, dtype, crs)
+        for driver, compress, scale_factor in itertools.product(as_list(drivers), as_list(compressions), as_list(scale_factors)):
+            output_file = str(Path(tmp) / "output.tif")
+            result = run_isolated(_resample_case, input_file, output_file, driver, compress, quality, float(scale_factor), threads)
+            cases.append(dict(driver=driver, compress=compress, scale_factor=float(scale_factor), **result))
+            os.remove(output_file)
+            print(f"{driver:5} {compress:8} {float(scale_factor):5}: {result['seconds']:7.2f} s  {result['megapixels_per_second']:7.1f} MP/s  {result['output_bytes'] / 2**20:7.1f} MB  {result['peak_rss_mb']:7.0f} MB RSS")
+
+    return save("resample", params, cases, name=name, results_dir=results_dir)
+
+
+def benchmark_pipeline(
+    files: int = 4,
+    width: int = 4096,
+    height: int = 4096,
+    count: int = 3,
+    dtype: str = "uint8",
+    crs: str = "utm",
+    remote: bool = True,
+    latency: float = 0.0,
+    drivers: Any = "GTiff",
+    compressions: Any = "jpeg",
+    scale_factors: Any = "0.1",
+    quality: int = 75,
+    name: Optional[str] = None,
+    results_dir: Optional[str] = None
+) -> Path:
+    """
+    Run dispatch_pending_files for a batch of synthetic rasters against the fake
+    backend and the fake SSH servers (remote=True) or local directories. The
+    results are saved into results_dir, by default benchmarks/results.
+    """
+    params = dict(files=files, width=width, height=height, count=count, dtype=dtype, crs=crs, remote=remote, latency=latency, quality=quality)
+    cases = []
+    with TemporaryDirectory() as tmp:
+        raw_file = make_raster(str(Path(tmp) / "input.tif"), width, height, count, dtype, crs)
+        for driver, compress, scale_factor in itertools.product(as_list(drivers), as_list(compressions), as_list(scale_factors)):
+            workdir = Path(tmp) / "run"
+            result = run_isolated(_pipeline_case, [raw_file] * files, str(workdir), remote, latency, driver, compress, quality, float(scale_factor))
+            cases.append(dict(driver=driver, compress=compress, scale_factor=float(scale_factor), **result))
+            shutil.rmtree(workdir)
+            print(f"{driver:5} {compress:8} {float(scale_factor):5}: {result['seconds']:7.2f} s  {result['files_per_second']:6.2f} files/s  {result['megapixels_per_second']:7.1f} MP/s  {result['peak_rss_mb']:7.0f} MB RSS")
+
+    return save("pipeline", params, cases, name=name, results_dir=results_dir)
+
+
+def compare(baseline: str, candidate: str, tolerance: float = 0.1) -> bool:
+    """
+    Compare two saved results case by case. Returns False if the candidate is
+    slower, larger or uses more memory than the baseline by more than tolerance.
+    """
+    with open(baseline) as f:
+        base = json.load(f)
+    with open(candidate) as f:
+        cand = json.load(f)
+
+    key = lambda case: (case["driver"], case["compress"], case["scale_factor"])
+    base_cases = {key(case): case for case in base["cases"]}
+
+    ok = True
+    for case in cand["cases"]:
+        before = base_cases.get(key(case))
+        if before is None:
+            continue
+        for metric in ("seconds", "output_bytes", "peak_rss_mb"):
+            change = case[metric] / before[metric] - 1 if before[metric] else 0.0
+            flag = "REGRESSION" if change > tolerance else ""
+            ok = ok and not flag
+            print(f"{'/'.join(map(str, key(case))):25} {metric:12} {before[metric]:12.2f} -> {case[metric]:12.2f} ({change:+.1%}) {flag}")
+
+    return ok
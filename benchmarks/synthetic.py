@@ -0,0 +1,76 @@
+"""
+Synthetic GeoTIFFs that look roughly like orthomosaics.
+
+The rasters are written in strips, so that large files can be generated without
+holding them in memory. The content is a smooth pattern with noise, which
+compresses about as well as aerial imagery. The corners are left empty, like the
+nodata collar around a real orthomosaic.
+
+"""
+from typing import Literal
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+
+# origin and resolution of a 5 cm orthomosaic in southern Germany
+CRS = {
+    "utm": ("EPSG:32632", (500000.0, 5400000.0), 0.05),
+    "3857": ("EPSG:3857", (890000.0, 6240000.0), 0.07),
+    "4326": ("EPSG:4326", (8.0, 48.7), 0.05 / 111000),
+}
+
+STRIP_HEIGHT = 512
+
+
+def make_raster(
+    path: str,
+    width: int = 4096,
+    height: int = 4096,
+    count: int = 3,
+    dtype: str = "uint8",
+    crs: Literal["utm", "3857", "4326"] = "utm",
+    seed: int = 42
+) -> str:
+    """
+    Write a synthetic raster to path and return the path.
+    """
+    crs_code, origin, res = CRS[crs]
+    rng = np.random.default_rng(seed)
+    info = np.iinfo(dtype) if np.dtype(dtype).kind in "ui" else None
+    low, high = (info.min, info.max) if info is not None else (0.0, 1.0)
+
+    profile = dict(
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=count,
+        dtype=dtype,
+        crs=crs_code,
+        transform=from_origin(*origin, res, res),
+        nodata=0 if info is not None else None,
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress="deflate",
+        BIGTIFF="IF_SAFER",
+    )
+    with rasterio.open(path, "w", **profile) as dst:
+        for row in range(0, height, STRIP_HEIGHT):
+            rows = min(STRIP_HEIGHT, height - row)
+            yy, xx = np.mgrid[row:row + rows, 0:width].astype(np.float32)
+
+            # a smooth pattern per band plus some noise, scaled to the value range
+            bands = [0.5 + 0.4 * np.sin(xx / (60 + 15 * b)) * np.cos(yy / 75) for b in range(count)]
+            data = np.stack(bands) + rng.normal(0, 0.03, size=(count, rows, width))
+            data = np.clip(low + data * (high - low), low, high).astype(dtype)
+
+            # leave the corners outside of a tilted footprint empty
+            outside = (xx + yy < min(width, height) * 0.2) | (xx - yy > width * 0.9)
+            data[:, outside] = 0
+
+            dst.write(data, window=Window(0, row, width, rows))
+
+    return path
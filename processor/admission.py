@@ -0,0 +1,148 @@
+"""
+Admit resampling jobs against a memory budget.
+
+The memory a resampling needs depends on the size of the raster, not on the number
+of files processed at once. Before a raster is resampled, its peak memory is estimated
+from the header and the job waits until it fits into the budget next to the jobs
+already running. A job larger than the whole budget runs alone.
+
+Small jobs may overtake a large job waiting for memory, which keeps the node busy.
+Once the oldest waiting job has waited for starvation_timeout seconds, nothing else
+is admitted before it, so large files still make progress.
+
+"""
+from typing import Generator, List, Optional
+from contextlib import contextmanager
+import itertools
+import threading
+import logging
+import time
+import os
+
+from .config import config
+from .metrics import memory_admitted, admission_wait
+
+
+logger = logging.getLogger("processor")
+
+
+# memory limit of the container for cgroup v2 and v1
+CGROUP_LIMITS = ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+
+
+def cgroup_memory_limit() -> Optional[int]:
+    """
+    Memory limit of the container in MB, or None if there is none
+    """
+    for path in CGROUP_LIMITS:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+
+        # cgroup v2 writes max, v1 a huge number if there is no limit
+        if value.isdigit():
+            return int(value) // 2**20
+        return None
+
+    return None
+
+
+def physical_memory() -> int:
+    """
+    Memory available to the node in MB, the total memory of the host or the
+    memory limit of the container, whichever is smaller
+    """
+    host = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2**20
+    limit = cgroup_memory_limit()
+    return host if limit is None else min(host, limit)
+
+
+class Ticket:
+    def __init__(self, seq: int, cost: int):
+        self.seq = seq
+        self.cost = cost
+        self.since = time.monotonic()
+
+
+class MemoryAdmission:
+    def __init__(self, budget: int, starvation_timeout: float = 300.0):
+        self.budget = budget
+        self.starvation_timeout = starvation_timeout
+
+        self.used = 0
+        self.running = 0
+        self._waiting: List[Ticket] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _can_admit(self, ticket: Ticket) -> bool:
+        # a job larger than the budget runs alone
+        if self.running > 0 and self.used + ticket.cost > self.budget:
+            return False
+
+        # overtaking is fine, until the oldest job starves
+        oldest = self._waiting[0]
+        return oldest is ticket or time.monotonic() - oldest.since < self.starvation_timeout
+
+    def acquire(self, cost: int) -> Ticket:
+        """
+        Wait until cost MB fit into the budget and reserve them.
+        """
+        with self._cond:
+            ticket = Ticket(next(self._seq), cost)
+            self._waiting.append(ticket)
+            try:
+                # check again from time to time, as the oldest job might start starving
+                while not self._can_admit(ticket):
+                    self._cond.wait(timeout=5.0)
+            finally:
+                self._waiting.remove(ticket)
+
+            self.used += cost
+            self.running += 1
+            memory_admitted.set(self.used)
+
+            # others might fit as well now, ie. if this one overtook them
+            self._cond.notify_all()
+
+        admission_wait.observe(time.monotonic() - ticket.since)
+        return ticket
+
+    def release(self, ticket: Ticket):
+        with self._cond:
+            self.used -= ticket.cost
+            self.running -= 1
+            memory_admitted.set(self.used)
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, cost: int) -> Generator[None, None, None]:
+        if cost > self.budget:
+            logger.warning(f"The job needs about {cost} MB, more than the budget of {self.budget} MB. It will run alone.")
+        ticket = self.acquire(cost)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+
+__ADMISSION: Optional[MemoryAdmission] = None
+__LOCK = threading.Lock()
+
+
+def get_admission() -> MemoryAdmission:
+    """
+    Return the admission control of this node and create it on first use.
+    """
+    global __ADMISSION
+
+    with __LOCK:
+        if __ADMISSION is None:
+            __ADMISSION = MemoryAdmission(
+                budget=config.memory_budget or int(physical_memory() * 0.75),
+                starvation_timeout=config.admission_starvation_timeout
+            )
+
+    return __ADMISSION
@@ -1,18 +1,23 @@
-from typing import Generator
+from typing import Generator, Optional
 from contextlib import contextmanager
-from datetime import datetime
+import threading
+import time
 
-from supabase import Client
-from gotrue import AuthResponse
+from supabase import Client, create_client
+from gotrue import AuthResponse, Session
 
 from .utils.settings import settings
-from .utils.supabase_client import use_client, login
+from .utils.supabase_client import login
 
 
-__ACCESS_TOKEN = None
-__REFRESH_TOKEN = None
-__ISSUED_AT = None
-__USER_ID = None
+# refresh the access token this many seconds before it expires
+REFRESH_MARGIN = 5 * 60
+
+__LOCK = threading.RLock()
+__SESSION: Optional[Session] = None
+__EXPIRES_AT: Optional[float] = None
+__USER_ID: Optional[str] = None
+__CLIENT: Optional[Client] = None
 
 
 class AuthorizedClient(Client):
@@ -26,56 +31,72 @@ def direct_authenticate_processor() -> AuthResponse:
     return auth
 
 
-def authenticate_processor():
-    # use the global TOKENS
-    global __ACCESS_TOKEN
-    global __REFRESH_TOKEN
-    global __ISSUED_AT
-    
-    # if there is no access token
-    if __ACCESS_TOKEN is None or __REFRESH_TOKEN is None:    
-        # login to the supabase backend to retrieve an access token
-        auth = login(settings.processor_username, settings.processor_password)
-
-        # upadate
-        __ACCESS_TOKEN = auth.session.access_token
-        __REFRESH_TOKEN = auth.session.refresh_token
-        __ISSUED_AT = datetime.now()
-        __USER_ID = auth.user.id
-
-    # check if we need to refresh the token
-    elif (datetime.now() - __ISSUED_AT).total_seconds() > 60 * 45:  # 45 minutes
-        with use_client(__ACCESS_TOKEN) as client:
-            auth = client.auth.refresh_session(__REFRESH_TOKEN)
-
-            # update the tokens
-            __ACCESS_TOKEN = auth.session.access_token
-            __REFRESH_TOKEN = auth.session.refresh_token
-            __ISSUED_AT = datetime.now()
-            __USER_ID = auth.user.id
-    
+def _update_session(auth: AuthResponse):
+    global __SESSION
+    global __EXPIRES_AT
+    global __USER_ID
+
+    __SESSION = auth.session
+    __USER_ID = auth.user.id
+
+    # use the expiry time sent by the backend, fall back to one hour
+    if auth.session.expires_at is not None:
+        __EXPIRES_AT = float(auth.session.expires_at)
     else:
-        # there is nothing to do
-        pass
+        __EXPIRES_AT = time.time() + (auth.session.expires_in or 60 * 60)
+
+
+def get_client() -> Client:
+    """
+    Return the shared supabase client. It keeps its HTTP connections open
+    and is reused by all threads.
+    """
+    global __CLIENT
+
+    with __LOCK:
+        if __CLIENT is None:
+            __CLIENT = create_client(settings.supabase_url, settings.supabase_key)
+
+    return __CLIENT
+
+
+def authenticate_processor() -> str:
+    """
+    Return a valid access token for the processor. The processor only logs in
+    once and refreshes the session shortly before it expires.
+    """
+    with __LOCK:
+        # if there is no session, login to the supabase backend
+        if __SESSION is None:
+            _update_session(direct_authenticate_processor())
+
+        # check if we need to refresh the token
+        elif time.time() > __EXPIRES_AT - REFRESH_MARGIN:
+            try:
+                _update_session(get_client().auth.refresh_session(__SESSION.refresh_token))
+            except Exception:
+                # the refresh token might be used up, so login again
+                _update_session(direct_authenticate_processor())
+
+        return __SESSION.access_token
 
 
 @contextmanager
 def supabase_client() -> Generator[AuthorizedClient, None, None]:
     # authenticate the processor
-    # TODO: debug one day why this is not working
-    # authenticate_processor()
+    access_token = authenticate_processor()
 
-    auth = direct_authenticate_processor()
+    # use the shared supabase client with the current token
+    client = get_client()
+    with __LOCK:
+        client.postgrest.auth(access_token)
+    client.user_id = __USER_ID
 
-    # create a supabase client
-    #with use_client(__ACCESS_TOKEN) as client:
-    with use_client(auth.session.access_token) as client:
-        client.user_id = auth.user.id
-        yield client
+    yield client
 
 
 def get_user_id() -> str:
     if __USER_ID is None:
         authenticate_processor()
-    
+
     return __USER_ID
@@ -0,0 +1,260 @@
+"""
+Process a batch of local rasters without the backend.
+
+The rasters are resampled with the same settings and the same process pool as the
+files dispatched from the backend, and written into an output directory together
+with a manifest of their bounding boxes, timings and sizes. The outputs keep their
+path relative to the source directory, or to the directory the glob pattern starts
+in. Neither Supabase nor the MapServer is needed, unless the results are registered
+with register=True. In that case, each raster is matched to the metadata row with
+its file name as file_id, placed into the processed_path, published as WMS layer
+and flagged as processed.
+
+"""
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import logging
+import shutil
+import glob
+import json
+import time
+import csv
+import os
+
+from rasterio.enums import Resampling
+from rasterio.coords import BoundingBox
+
+from .utils.settings import settings
+from .utils.metadata_models import FileUploadMetadata, StatusEnum
+from .config import config
+from .auth import supabase_client
+from .pool import resample_in_pool, pool_workers
+from .resample import estimate_memory
+from .admission import get_admission
+from .mapserver import create_wms_source
+from .files import processed_raster_path, processed_raster_tmp_path, upload_processed_raster
+
+
+logger = logging.getLogger("processor")
+
+# the columns of the manifest, in order
+MANIFEST_FIELDS = [
+    "file", "output", "status", "error",
+    "left", "bottom", "right", "top",
+    "raw_size", "processed_size", "compression_ratio",
+    "wait_time", "resample_time", "total_time", "wms_source",
+]
+
+
+def find_rasters(source: str, exclude: Optional[str] = None) -> List[Path]:
+    """
+    All GeoTIFFs in the directory source, or all files matching the glob pattern source.
+    Files within the directory exclude are left out.
+    """
+    if Path(source).is_dir():
+        paths = [p for p in Path(source).iterdir() if p.suffix.lower() in (".tif", ".tiff")]
+    else:
+        paths = [Path(p) for p in glob.glob(source, recursive=True)]
+
+    # the outputs of an earlier run are not processed again
+    if exclude is not None:
+        excluded = Path(exclude).resolve()
+        paths = [p for p in paths if not p.resolve().is_relative_to(excluded)]
+
+    return sorted(p for p in paths if p.is_file())
+
+
+def source_root(source: str) -> Path:
+    """
+    The directory source, or the directory the glob pattern source starts in.
+    """
+    if Path(source).is_dir():
+        return Path(source)
+
+    parts = []
+    for part in Path(source).parts:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return Path(*parts) if len(parts) > 0 else Path(".")
+
+
+def find_metadata(file_id: str) -> Optional[FileUploadMetadata]:
+    with supabase_client() as client:
+        response = client.table(settings.metadata_table).select("*").eq("file_id", file_id).limit(1).execute()
+
+    if len(response.data) == 0:
+        return None
+    return FileUploadMetadata(**response.data[0])
+
+
+def register_raster(output_file: str, file_id: str, bbox: BoundingBox, band_stats: List[dict], compress_time: float) -> str:
+    """
+    Place a processed raster of the batch on the MapServer, add its WMS layer and
+    update the metadata row of file_id.
+
+    Returns the WMS source URL
+    """
+    metadata = find_metadata(file_id)
+    if metadata is None:
+        raise ValueError(f"There is no metadata row with file_id {file_id}.")
+
+    # copy the output, so it stays in the output directory
+    tmp_path = processed_raster_tmp_path(metadata)
+    shutil.copyfile(output_file, tmp_path)
+    metadata.processed_path = upload_processed_raster(metadata, tmp_path)
+    metadata.bbox = bbox
+    metadata.wms_source = create_wms_source(metadata=metadata, band_stats=band_stats)
+
+    updates = {
+        "status": StatusEnum.processed.value,
+        "compress_time": compress_time,
+        "processed_path": metadata.processed_path,
+        "wms_source": metadata.wms_source,
+        "bbox": f"BOX({bbox.bottom} {bbox.left}, {bbox.top} {bbox.right})",
+    }
+    if config.store_band_stats:
+        updates["band_stats"] = band_stats
+    with supabase_client() as client:
+        client.table(settings.metadata_table).update(updates).eq("file_id", file_id).execute()
+
+    return metadata.wms_source
+
+
+def process_raster(
+    input_file: Path,
+    output_file: Path,
+    scale_factor: float,
+    compress: str,
+    quality: int,
+    driver: str,
+    overwrite: bool = False,
+    register: bool = False
+) -> dict:
+    """
+    Resample a single raster of the batch into output_file. Errors are not raised,
+    but reported in the returned manifest row.
+    """
+    row = dict(file=str(input_file), output=str(output_file), status="processed")
+    if output_file.exists() and not overwrite:
+        row["status"] = "skipped"
+        return row
+
+    t1 = time.time()
+    tmp_file = output_file.with_name(f".{output_file.name}.tmp")
+    try:
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        # wait until the raster fits into the memory budget
+        cost = estimate_memory(str(input_file), scale_factor, driver, config.resample_max_memory)
+        with get_admission().admit(cost):
+            t2 = time.time()
+            bbox, band_stats = resample_in_pool(
+                str(input_file),
+                str(tmp_file),
+                scale_factor=scale_factor,
+                compress=compress,
+                jpeg_quality=quality,
+                driver=driver,
+                max_memory=config.resample_max_memory,
+                overview_resampling=Resampling[config.overview_resampling],
+                blocksize=config.cog_blocksize
+            )
+            t3 = time.time()
+
+        raw_size, processed_size = input_file.stat().st_size, tmp_file.stat().st_size
+        row.update(
+            left=bbox.left, bottom=bbox.bottom, right=bbox.right, top=bbox.top,
+            raw_size=raw_size,
+            processed_size=processed_size,
+            compression_ratio=raw_size / max(processed_size, 1),
+            wait_time=t2 - t1,
+            resample_time=t3 - t2
+        )
+
+        # the output only appears once it is registered, so a failed registration
+        # is retried by the next run instead of being skipped
+        if register:
+            row["wms_source"] = register_raster(str(tmp_file), output_file.name, bbox, band_stats, t3 - t1)
+        os.replace(tmp_file, output_file)
+
+    except Exception as e:
+        logger.error(f"Could not process {input_file}: {e}")
+        row.update(status="errored", error=str(e))
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+    row["total_time"] = time.time() - t1
+    return row
+
+
+def write_manifest(rows: List[Dict], path: str):
+    """
+    Write the manifest as JSON or, for any other extension, as CSV.
+    """
+    if Path(path).suffix.lower() == ".json":
+        with open(path, "w") as f:
+            json.dump(rows, f, indent=2)
+        return
+
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def process_batch(
+    source: str,
+    output_dir: str,
+    manifest: Optional[str] = None,
+    scale_factor: Optional[float] = None,
+    compress: Optional[str] = None,
+    quality: Optional[int] = None,
+    driver: Optional[str] = None,
+    workers: Optional[int] = None,
+    overwrite: bool = False,
+    register: bool = False
+) -> List[dict]:
+    """
+    Resample all GeoTIFFs in the directory or glob pattern source into output_dir,
+    keeping their paths relative to the source. Files within output_dir are left
+    out. The options default to the settings of the processor. Up to workers files
+    are processed at once, by default one per process of the resampling pool.
+    Existing outputs are skipped unless overwrite is set. The manifest is written
+    to manifest, by default manifest.csv in the output_dir, and contains one row
+    per raster. With register, the file names have to be unique, and an output
+    is only kept once it is registered.
+
+    Returns the rows of the manifest
+    """
+    files = find_rasters(source, exclude=output_dir)
+    root = source_root(source)
+    out = Path(output_dir)
+    out.mkdir(parents=True, exist_ok=True)
+
+    # the file name is the file_id in the backend, so it has to be unique
+    if register:
+        names = [f.name for f in files]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if len(duplicates) > 0:
+            raise ValueError(f"Can't register several rasters with the same file name: {duplicates}")
+
+    logger.info(f"Processing {len(files)} rasters from {source} into {out}.")
+
+    options = dict(
+        scale_factor=settings.scale_factor if scale_factor is None else scale_factor,
+        compress=settings.processor_compression if compress is None else compress,
+        quality=settings.compression_quality if quality is None else quality,
+        driver=settings.processor_image_driver if driver is None else driver,
+        overwrite=overwrite,
+        register=register
+    )
+
+    with ThreadPoolExecutor(max_workers=workers or pool_workers()) as executor:
+        rows = list(executor.map(lambda f: process_raster(f, out / f.relative_to(root), **options), files))
+
+    write_manifest(rows, manifest or str(out / "manifest.csv"))
+
+    failed = sum(1 for row in rows if row["status"] == "errored")
+    logger.info(f"Processed {len(rows) - failed} of {len(rows)} rasters, {failed} failed.")
+    return rows
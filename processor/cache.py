@@ -0,0 +1,163 @@
+"""
+A content-addressed cache of processed rasters.
+
+Users often upload the same orthomosaic more than once. The cache is keyed by the
+digest of the raw file and the settings that change the processed output. On a hit,
+the cached raster is linked to the location of the new file and its bounding box
+and band statistics are reused, so only the WMS layer has to be created.
+
+The cache keeps its own link to each processed raster in cache_dir on the MapServer,
+so deleting a dataset does not break the cache and evicting a cache entry does not
+break a dataset. The index is a SQLite database local to the processor. Entries are
+evicted by least recent use, once the cached rasters exceed cache_max_size.
+
+"""
+from typing import List, Optional, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import hashlib
+import sqlite3
+import logging
+import json
+import time
+
+from rasterio.coords import BoundingBox
+
+from .utils.settings import settings
+from .config import config
+from .files import link_processed_raster, remove_processed_raster
+
+
+logger = logging.getLogger("processor")
+
+
+def cache_key(raw_digest: str) -> str:
+    """
+    Combine the digest of the raw file with all settings that change the output.
+    """
+    options = dict(
+        scale_factor=settings.scale_factor,
+        compress=settings.processor_compression,
+        quality=settings.compression_quality,
+        driver=settings.processor_image_driver,
+        overview_resampling=config.overview_resampling,
+        blocksize=config.cog_blocksize,
+        percentiles=list(config.scale_percentiles),
+    )
+    return hashlib.sha256(f"{raw_digest}:{json.dumps(options, sort_keys=True)}".encode()).hexdigest()
+
+
+class ProcessedCache:
+    def __init__(self, path: str, cache_dir: str, max_size: int):
+        self.path = path
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        with self.connect() as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    bbox TEXT NOT NULL,
+                    band_stats TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL
+                )
+            """)
+
+    @contextmanager
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def cached_path(self, key: str) -> str:
+        return str(self.cache_dir / f"{key}.tif")
+
+    def get(self, key: str, target_path: str) -> Optional[Tuple[BoundingBox, List[dict]]]:
+        """
+        Link the cached raster of key to target_path.
+
+        Returns the bounding box and band statistics, or None if the key is not cached
+        """
+        with self.connect() as con:
+            row = con.execute("SELECT bbox, band_stats FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE entries SET used_at = ? WHERE key = ?", (time.time(), key))
+
+        try:
+            link_processed_raster(self.cached_path(key), target_path)
+        except Exception as e:
+            # the cached raster is gone, so forget about it
+            logger.warning(f"Dropping cache entry {key}, its raster could not be linked: {e}")
+            with self.connect() as con:
+                con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+
+        return BoundingBox(*json.loads(row[0])), json.loads(row[1])
+
+    def put(self, key: str, processed_path: str, bbox: BoundingBox, band_stats: List[dict], size: int):
+        """
+        Add the processed raster to the cache and evict old entries if needed.
+        """
+        link_processed_raster(processed_path, self.cached_path(key))
+
+        now = time.time()
+        with self.connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entries (key, bbox, band_stats, size, created_at, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(list(bbox)), json.dumps(band_stats), size, now, now)
+            )
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into max_size.
+        """
+        with self._lock:
+            with self.connect() as con:
+                rows = con.execute("SELECT key, size FROM entries ORDER BY used_at DESC").fetchall()
+
+            total, expired = 0, []
+            for key, size in rows:
+                total += size
+                if total > self.max_size:
+                    expired.append(key)
+
+            for key in expired:
+                remove_processed_raster(self.cached_path(key))
+                with self.connect() as con:
+                    con.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+        if len(expired) > 0:
+            logger.info(f"Evicted {len(expired)} processed rasters from the cache.")
+
+
+__CACHE: Optional[ProcessedCache] = None
+__LOCK = threading.Lock()
+
+
+def get_cache() -> Optional[ProcessedCache]:
+    """
+    Return the cache of processed rasters, or None if it is disabled.
+    """
+    global __CACHE
+
+    if config.cache_max_size <= 0:
+        return None
+
+    with __LOCK:
+        if __CACHE is None:
+            __CACHE = ProcessedCache(
+                config.cache_index_path,
+                config.cache_dir or str(Path(settings.processed_path) / ".cache"),
+                max_size=config.cache_max_size * 2**20
+            )
+
+    return __CACHE
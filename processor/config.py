@@ -0,0 +1,134 @@
+"""
+Tuning options of the processor itself.
+
+The paths, credentials and connection settings are shared with the storage server
+and live in the utils submodule. The options in here only change how the processor
+does its work and can be overwritten by environment variables of the same name,
+ie. RESAMPLE_MAX_MEMORY=2048.
+
+"""
+from typing import Literal, Optional, Tuple
+
+from pydantic_settings import BaseSettings
+
+
+class ProcessorConfig(BaseSettings):
+    # memory ceiling for the resampling in MB. If set, resample streams the
+    # raster window by window instead of loading it into memory at once
+    resample_max_memory: Optional[int] = None
+
+    # options for PROCESSOR_IMAGE_DRIVER=COG: the resampling method used to build
+    # the overview pyramid and the size of the internal tiles in pixels
+    overview_resampling: str = "average"
+    cog_blocksize: int = 512
+
+    # number of worker processes for resampling and the number of GDAL threads 
+    # each of them uses to warp and compress. Defaults to one process per CPU, with
+    # the CPUs shared among the processes as threads.
+    resample_workers: Optional[int] = None
+    resample_threads: Optional[int] = None
+
+    # memory in MB the resampling jobs may use together, estimated from the raster
+    # headers. Defaults to 75% of the node's memory, or of the memory limit of the
+    # container. Once a large job waited for admission_starvation_timeout seconds,
+    # smaller jobs can't overtake it anymore
+    memory_budget: Optional[int] = None
+    admission_starvation_timeout: float = 300.0
+
+    # location of the persistent job queue behind the /dispatch endpoints, on the
+    # data volume so it survives a new container, the number of files that are
+    # processed at the same time and how long finished jobs are kept in seconds
+    dispatch_queue_path: str = "/data/dispatch_queue.sqlite"
+    dispatch_workers: int = 5
+    dispatch_retention: float = 7 * 24 * 3600
+
+    # number of pending files dispatch_pending_files claims and processes at once
+    claim_batch_size: int = 20
+
+    # dispatch_pending_files runs the files through a pipeline of stages. These are
+    # the number of threads fetching, resampling, uploading and publishing files and
+    # the number of files that may wait in front of each stage. The resample stage
+    # defaults to one thread per worker process of the resampling pool
+    pipeline_fetch_workers: int = 2
+    pipeline_resample_workers: Optional[int] = None
+    pipeline_upload_workers: int = 2
+    pipeline_publish_workers: int = 2
+    pipeline_queue_size: int = 2
+
+    # reprocess_files encodes processed files again from the archive. It resamples
+    # up to reprocess_workers files at once, by default one per worker process of the
+    # resampling pool, and writes at most reprocess_write_rate batches of metadata
+    # rows per second, to keep the load on the node and the backend bounded
+    reprocess_workers: Optional[int] = None
+    reprocess_write_rate: float = 1.0
+
+    # several nodes can share the metadata table. Each node leases the files it
+    # processes for lease_ttl seconds and renews the leases every lease_heartbeat_interval
+    # seconds. node_id identifies the node and defaults to the hostname and pid
+    node_id: Optional[str] = None
+    lease_ttl: float = 120.0
+    lease_heartbeat_interval: float = 30.0
+
+    # maximum number of open SSH connections per server, the number of seconds
+    # after which an unused connection is closed and the number of seconds to
+    # wait for a free connection
+    ssh_pool_size: int = 4
+    ssh_idle_timeout: float = 300.0
+    ssh_acquire_timeout: float = 60.0
+
+    # raw rasters are downloaded in chunks of download_chunk_size MB over
+    # download_workers parallel SFTP sessions into download_dir (defaults to
+    # the temp directory). With download_verify the sha256 checksum is checked
+    download_dir: Optional[str] = None
+    download_workers: int = 4
+    download_chunk_size: int = 64
+    download_verify: bool = False
+
+    # processed rasters are uploaded in chunks of upload_chunk_size MB while
+    # they are being encoded
+    upload_chunk_size: int = 8
+
+    # publish each processed raster as its own WMS layer ('layer'), or add its
+    # footprint to a tile index served by a single layer ('tileindex')
+    wms_publishing: Literal['layer', 'tileindex'] = 'layer'
+    tileindex_layer: str = "mosaic"
+
+    # lower and upper percentile of each band used as fixed SCALE values of the layers
+    scale_percentiles: Tuple[float, float] = (2.0, 98.0)
+
+    # with store_band_stats, the band statistics are also written to the metadata
+    # table. The column has to be added to the table first:
+    #   ALTER TABLE <metadata_table> ADD COLUMN band_stats JSONB;
+    store_band_stats: bool = False
+
+    # if tiles_path is set, a static XYZ tile pyramid of each processed raster is
+    # rendered into tiles_path on the MapServer and served from tiles_base_url. The zoom
+    # levels default to the range from a single tile to the native resolution. With
+    # store_tile_source, the URL of the tiles is written to the metadata table, which
+    # needs the column first:
+    #   ALTER TABLE <metadata_table> ADD COLUMN tile_source TEXT;
+    tiles_path: Optional[str] = None
+    tiles_base_url: str = "/tiles"
+    tiles_format: Literal['webp', 'png'] = 'webp'
+    tiles_min_zoom: Optional[int] = None
+    tiles_max_zoom: Optional[int] = None
+    store_tile_source: bool = False
+
+    # processed rasters are cached by the digest of the raw file and the processing
+    # settings, up to cache_max_size MB. Set it to 0 to disable the cache. The cached
+    # rasters are kept in cache_dir on the MapServer, by default .cache in the processed_path.
+    # The index is kept on the data volume, so it survives a new container
+    cache_index_path: str = "/data/processed_cache.sqlite"
+    cache_dir: Optional[str] = None
+    cache_max_size: int = 50 * 1024
+
+    # log records are inserted into the logs table in batches of log_batch_size or
+    # every log_flush_interval seconds. If more than log_queue_size records are
+    # waiting, log_overflow decides what happens to new records
+    log_batch_size: int = 100
+    log_flush_interval: float = 2.0
+    log_queue_size: int = 10000
+    log_overflow: Literal['drop_oldest', 'drop_newest', 'block'] = 'drop_oldest'
+
+
+config = ProcessorConfig()
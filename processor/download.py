@@ -0,0 +1,189 @@
+"""
+Parallel, resumable download of large files over SFTP.
+
+The file is split into chunks, which are fetched at the same time over several
+pooled SSH connections and written into a preallocated partial file. The finished
+chunks are recorded next to the partial file, so that an interrupted download only
+fetches the missing chunks on the next attempt. The file can be hashed on the way,
+in order of the chunks as soon as they are finished.
+
+"""
+from typing import Any, Literal, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+from shlex import quote
+
+import prometheus_client
+
+from .ssh import get_pool
+from .metrics import network_bytes
+
+
+# size of the single read requests pipelined within a chunk
+READ_SIZE = 2**20
+
+# create a prometheus histogram for the download throughput
+download_throughput = prometheus_client.Histogram(
+    'processor_download_throughput',
+    'Throughput of raw raster downloads in megabytes per second',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
+logger = logging.getLogger("processor")
+
+
+def _load_state(state_path: Path, size: int) -> Set[int]:
+    # load the finished chunks, if they belong to a download of the same size
+    if not state_path.exists():
+        return set()
+    try:
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        return set(state["done"]) if state["size"] == size else set()
+    except Exception:
+        return set()
+
+
+def _save_state(state_path: Path, size: int, done: Set[int]):
+    # write to a temporary file first, so that the state is never half written
+    tmp_path = state_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(dict(size=size, done=sorted(done)), f)
+    os.replace(tmp_path, state_path)
+
+
+def hash_file(path: str, digest: Any) -> Any:
+    # update the hashlib object with the content of the file
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * READ_SIZE), b""):
+            digest.update(block)
+    return digest
+
+
+def download(
+    remote_path: str,
+    local_path: str,
+    server: Literal['storage'] | Literal['mapserver'] = 'storage',
+    workers: int = 4,
+    chunk_size: int = 64 * 2**20,
+    verify: bool = False,
+    digest: Optional[Any] = None
+) -> str:
+    """
+    Download remote_path from the server into local_path using workers parallel
+    SFTP sessions. A partial download at local_path is resumed. The number of bytes
+    of each chunk is always checked, with verify=True the sha256 checksum is compared
+    to the one calculated on the server as well. If a hashlib object is passed
+    as digest, it is updated with the content of the file.
+
+    Returns the local_path
+    """
+    pool = get_pool(server)
+    local_path = Path(local_path)
+    state_path = local_path.with_name(local_path.name + ".chunks")
+
+    # get the expected size
+    with pool.connection() as c:
+        size = c.sftp().stat(remote_path).st_size
+
+    # get the chunks that are still missing
+    done = _load_state(state_path, size) if local_path.exists() else set()
+    count = len(range(0, size, chunk_size))
+    chunks = [(i, offset, min(chunk_size, size - offset)) for i, offset in enumerate(range(0, size, chunk_size)) if i not in done]
+    if done:
+        logger.info(f"Resuming download of {remote_path}: {len(done)} chunks already fetched, {len(chunks)} missing.")
+
+    # preallocate the partial file
+    with open(local_path, "r+b" if local_path.exists() else "wb") as f:
+        f.truncate(size)
+
+    lock = threading.Lock()
+    fd = os.open(local_path, os.O_RDWR)
+
+    # the hash has to see the chunks in order, so they are hashed from the front of
+    # the file as far as they are finished, while they are still in the page cache
+    hasher = digest if digest is not None else (hashlib.sha256() if verify else None)
+    hash_lock = threading.Lock()
+    hashed = [0]
+
+    def hash_finished(wait: bool = False):
+        if hasher is None or not hash_lock.acquire(blocking=wait):
+            return
+        try:
+            while True:
+                with lock:
+                    if hashed[0] >= count or hashed[0] not in done:
+                        return
+                index = hashed[0]
+                offset = index * chunk_size
+                end = min(offset + chunk_size, size)
+                while offset < end:
+                    block = os.pread(fd, min(8 * READ_SIZE, end - offset), offset)
+                    hasher.update(block)
+                    offset += len(block)
+                hashed[0] += 1
+        finally:
+            hash_lock.release()
+
+    def fetch_chunk(chunk: tuple[int, int, int]):
+        index, offset, length = chunk
+        with pool.connection() as c:
+            with c.sftp().open(remote_path, "rb") as remote:
+                # readv pipelines the read requests of the chunk
+                position = offset
+                reads = [(o, min(READ_SIZE, offset + length - o)) for o in range(offset, offset + length, READ_SIZE)]
+                for data in remote.readv(reads):
+                    os.pwrite(fd, data, position)
+                    position += len(data)
+
+        # a short read leaves a hole of zeros in the preallocated file
+        if position - offset != length:
+            raise IOError(f"Downloaded {position - offset} of {length} bytes of chunk {index} from {remote_path}.")
+
+        # record the finished chunk
+        with lock:
+            done.add(index)
+            _save_state(state_path, size, done)
+
+        # if another worker is hashing already, the chunk is hashed by it or at the end
+        hash_finished()
+
+    t1 = time.time()
+    try:
+        # chunks of an earlier attempt
+        hash_finished(wait=True)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            # consume the results to raise errors of the chunks
+            list(executor.map(fetch_chunk, chunks))
+        hash_finished(wait=True)
+    finally:
+        os.close(fd)
+    t2 = time.time()
+
+    # check the result
+    if verify:
+        with pool.connection() as c:
+            expected = c.run(f"sha256sum {quote(remote_path)}", hide=True).stdout.split()[0]
+        if hasher.hexdigest() != expected:
+            # the partial file can't be trusted anymore
+            local_path.unlink()
+            state_path.unlink(missing_ok=True)
+            raise IOError(f"Checksum mismatch for the download of {remote_path}.")
+
+    # the download is complete
+    state_path.unlink(missing_ok=True)
+
+    # report the throughput of the bytes fetched in this attempt
+    fetched = sum(length for _, _, length in chunks)
+    throughput = fetched / 2**20 / max(t2 - t1, 1e-6)
+    download_throughput.observe(throughput)
+    network_bytes.labels(direction="download").inc(fetched)
+    logger.debug(f"Downloaded {fetched / 2**20:.1f} MB of {remote_path} in {t2 - t1:.1f} seconds ({throughput:.1f} MB/s).")
+
+    return str(local_path)
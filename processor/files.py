@@ -6,34 +6,49 @@ via SFTP from the storage server. This is abstracted into a submodule to add mor
 connections, like S3, later.
 
 """
-from typing import Literal
+from typing import Any, Dict, List, Literal, Optional
 from typing import Generator
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, gettempdir
 from contextlib import contextmanager
+import subprocess
+import csv
+import tarfile
 import shutil
+import fcntl
+import os
+from io import BytesIO, StringIO
+from shlex import quote
+from uuid import uuid4
 
 from fabric import Connection
 import mappyfile
 
 from .utils.settings import settings
 from .utils.metadata_models import FileUploadMetadata
+from .config import config
+from .ssh import get_pool
+from .download import download, hash_file
+from .upload import StreamingUpload
+from .metrics import stage
+from .placement import place_file
+
+
+# the LAYERs are kept in one file each in the LAYERS_DIR, and are included by
+# the LAYERS_FILE, which itself is included by the MAINFILE
+LAYERS_DIR = "layers"
+LAYERS_FILE = "layers.map"
+
+# the tile index of all processed rasters, if they are published as one layer
+TILEINDEX_FILE = "tileindex.gpkg"
+TILEINDEX_TABLE = "tiles"
 
 
 @contextmanager
 def ssh_connect(server: Literal['storage'] | Literal['mapserver'] = 'storage') -> Generator[Connection, None, None]:
-    # check which server to connect to
-    if server == 'storage':
-        serv = f"{settings.storage_ssh_user}@{settings.storage_ssh_host}"
-        args = dict(password=settings.storage_ssh_password)
-    elif server == 'mapserver':
-        serv = f"{settings.mapserver_ssh_user}@{settings.mapserver_ssh_host}"
-        args = dict(password=settings.mapserver_ssh_password)
-    try:
-        connection = Connection(serv, connect_kwargs=args)
+    # borrow a persistent connection from the pool of the server
+    with get_pool(server).connection() as connection:
         yield connection
-    finally:
-        connection.close()
 
 
 def file_exists(c: Connection, path: str) -> bool:
@@ -47,29 +62,52 @@ def file_exists(c: Connection, path: str) -> bool:
         return False
     
 
-@contextmanager
-def fetch_raw_raster(metadata: FileUploadMetadata) -> Generator[str, None, None]:
+def download_raw_raster(metadata: FileUploadMetadata, digest: Optional[Any] = None) -> str:
     """
-    Check if the file is locally available, then return the path to the file.
-    If not, fetch the file into a temporary path and return that
+    Return a local path to the raw raster. If the file is not locally available,
+    it is downloaded into a temporary path first, which has to be removed with
+    release_raw_raster. If a hashlib object is passed as digest, it is updated
+    with the content of the raw raster.
     """
     # check if the file is locally available
     if settings.storage_local:
-        # we are local
-        try:
-            yield metadata.raw_path
-        finally:
-            pass
-    else:
-        # otherwise we need to ssh SFTP the file form the server
-        with ssh_connect() as c:
-            with NamedTemporaryFile(delete=False) as tmp:
-                c.get(metadata.raw_path, tmp.name)
+        if digest is not None:
+            hash_file(metadata.raw_path, digest)
+        return metadata.raw_path
 
-        try:
-            yield tmp.name
-        finally:
-            shutil.rmtree(tmp.name)
+    # otherwise we need to SFTP the file from the server. The partial file has a 
+    # stable name, so that an interrupted download can be resumed
+    local_path = Path(config.download_dir or gettempdir()) / f"{metadata.file_id}.part"
+    with stage("fetch"):
+        download(
+            metadata.raw_path,
+            str(local_path),
+            workers=config.download_workers,
+            chunk_size=config.download_chunk_size * 2**20,
+            verify=config.download_verify,
+            digest=digest
+        )
+
+    return str(local_path)
+
+
+def release_raw_raster(metadata: FileUploadMetadata, local_path: str):
+    # only remove downloaded copies
+    if not settings.storage_local:
+        Path(local_path).unlink(missing_ok=True)
+
+
+@contextmanager
+def fetch_raw_raster(metadata: FileUploadMetadata, digest: Optional[Any] = None) -> Generator[str, None, None]:
+    """
+    Check if the file is locally available, then return the path to the file.
+    If not, fetch the file into a temporary path and return that
+    """
+    local_path = download_raw_raster(metadata, digest)
+    try:
+        yield local_path
+    finally:
+        release_raw_raster(metadata, local_path)
 
 
 @contextmanager
@@ -94,7 +132,145 @@ def fetch_processed_raster(metadata: FileUploadMetadata) -> Generator[str, None,
         try:
             yield tmp.name
         finally:
-            shutil.rmtree(tmp.name)
+            os.unlink(tmp.name)
+
+
+def link_processed_raster(src: str, dst: str):
+    """
+    Make the processed raster at src available at dst as well, without copying
+    it if the filesystem of the MapServer allows it.
+    """
+    if settings.mapserver_local:
+        Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        place_file(src, dst, keep_source=True)
+    else:
+        tmp_path = str(Path(dst).with_name(f".{Path(dst).name}.tmp"))
+        cmd = f"ln -f {quote(src)} {quote(tmp_path)} 2>/dev/null || cp --reflink=auto {quote(src)} {quote(tmp_path)}"
+        with ssh_connect(server='mapserver') as c:
+            c.run(f"mkdir -p {quote(str(Path(dst).parent))} && ({cmd}) && mv -f {quote(tmp_path)} {quote(dst)}", hide=True)
+
+
+def remove_processed_raster(path: str):
+    if settings.mapserver_local:
+        Path(path).unlink(missing_ok=True)
+    else:
+        with ssh_connect(server='mapserver') as c:
+            c.run(f"rm -f {quote(path)}", hide=True)
+
+
+def processed_raster_path(metadata: FileUploadMetadata) -> str:
+    """
+    The final location of the processed raster, local to the MapServer.
+    """
+    return str(Path(settings.processed_path) / metadata.file_id)
+
+
+@contextmanager
+def processed_raster_target(metadata: FileUploadMetadata) -> Generator[str, None, None]:
+    """
+    Yield a local path to write the processed raster into. If the MapServer is local,
+    this is a temporary file next to the final location, which is renamed once the 
+    file is complete. Otherwise the file is uploaded via SFTP while it is written,
+    and moved into place on the server once it is complete.
+    Nothing is placed if an exception is raised while writing.
+    """
+    target_path = Path(processed_raster_path(metadata))
+
+    if settings.mapserver_local:
+        # write next to the target, so that the rename stays on the same filesystem
+        tmp_path = target_path.with_name(f".{target_path.name}.tmp")
+        try:
+            yield str(tmp_path)
+            with stage("upload"):
+                os.replace(tmp_path, target_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    else:
+        with NamedTemporaryFile(suffix=".tif") as tmp:
+            upload = StreamingUpload(tmp.name, str(target_path), server='mapserver', chunk_size=config.upload_chunk_size * 2**20)
+            upload.start()
+            try:
+                yield tmp.name
+            except BaseException:
+                upload.abort()
+                raise
+            with stage("upload"):
+                upload.finish()
+
+
+def processed_raster_tmp_path(metadata: FileUploadMetadata) -> str:
+    """
+    A local path to write the processed raster into before upload_processed_raster
+    moves it into place. For a local MapServer, it is next to the final location.
+    """
+    if settings.mapserver_local:
+        target_path = Path(processed_raster_path(metadata))
+        return str(target_path.with_name(f".{target_path.name}.tmp"))
+
+    return str(Path(config.download_dir or gettempdir()) / f"{metadata.file_id}.processed")
+
+
+def upload_processed_raster(metadata: FileUploadMetadata, local_path: str) -> str:
+    """
+    Move the finished processed raster from processed_raster_tmp_path to its final
+    location. The target is replaced in a single step on the MapServer.
+    """
+    target_path = processed_raster_path(metadata)
+
+    with stage("upload"):
+        if settings.mapserver_local:
+            os.replace(local_path, target_path)
+        else:
+            upload = StreamingUpload(local_path, target_path, server='mapserver', chunk_size=config.upload_chunk_size * 2**20)
+            upload.start()
+            try:
+                upload.finish()
+            finally:
+                Path(local_path).unlink(missing_ok=True)
+
+    return target_path
+
+
+def put_tiles(local_dir: str, name: str) -> str:
+    """
+    Move a rendered tile directory to name in the tiles_path of the MapServer.
+    An existing directory of the same name is swapped out in two renames,
+    so the tiles are never missing for more than a moment.
+
+    Returns the path of the tile directory
+    """
+    target_path = Path(config.tiles_path) / name
+    tmp_path = target_path.with_name(f".{name}.tmp")
+    old_path = target_path.with_name(f".{name}.old")
+
+    if settings.mapserver_local:
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        shutil.move(local_dir, tmp_path)
+        if target_path.exists():
+            os.rename(target_path, old_path)
+        os.rename(tmp_path, target_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    else:
+        # send all tiles in a single archive and unpack it on the server
+        with NamedTemporaryFile(suffix=".tar") as archive:
+            with tarfile.open(archive.name, "w") as tar:
+                tar.add(local_dir, arcname=".")
+            remote_archive = f"{tmp_path}.tar"
+            with ssh_connect(server='mapserver') as c:
+                c.put(archive.name, remote_archive)
+                t, o, a = quote(str(target_path)), quote(str(old_path)), quote(str(tmp_path))
+                c.run(
+                    f"rm -rf {a} {o} && mkdir -p {a} && tar -xf {quote(remote_archive)} -C {a} && rm -f {quote(remote_archive)} && "
+                    f"(if [ -d {t} ]; then mv {t} {o}; fi) && mv {a} {t} && rm -rf {o}",
+                    hide=True
+                )
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    return str(target_path)
+
 
 def put_processed_raster(metadata: FileUploadMetadata, local_path: Path) -> str:
     """
@@ -107,8 +283,8 @@ def put_processed_raster(metadata: FileUploadMetadata, local_path: Path) -> str:
 
     # derive the assusmed path, if we are local
     if settings.mapserver_local:
-        # we are local
-        shutil.copy(local_path, str(target_path))
+        # we are local, link or clone the file if possible
+        place_file(local_path, str(target_path), keep_source=True)
 
     # otherwise we need to ssh SFTP the file from the server
     else:
@@ -118,6 +294,13 @@ def put_processed_raster(metadata: FileUploadMetadata, local_path: Path) -> str:
     return str(target_path)
 
 
+def archived_raster_path(metadata: FileUploadMetadata) -> str:
+    """
+    The location of the raw raster on the storage server, once it is archived.
+    """
+    return str(Path(settings.archive_path) / metadata.file_id)
+
+
 def archive_raster(metadata: FileUploadMetadata) -> str:
     """
     Copy the file in the specified archive location and remove from the
@@ -125,12 +308,12 @@ def archive_raster(metadata: FileUploadMetadata) -> str:
 
     """
     # build the archive path
-    archive_path = settings.archive_path / metadata.file_id
+    archive_path = archived_raster_path(metadata)
 
     # check if the target path exists locally
     if settings.storage_local:
-        # we are local
-        shutil.copy(metadata.raw_path, str(archive_path))
+        # we are local, move the file just like on the remote server
+        place_file(metadata.raw_path, str(archive_path))
     
     else:
         with ssh_connect() as c:
@@ -144,10 +327,10 @@ def get_mapfile() -> dict:
     if settings.mapserver_local:
         if (settings.mapfile_path / "MAINFILE.map").exists():
             with open(settings.mapfile_path / "MAINFILE.map") as f:
-                mappy = mappyfile.load(f)
+                mappy = mappyfile.load(f, expand_includes=False)
         else:
             with open(Path(__file__).parent / "MAINFILE.map", "r") as f:
-                mappy = mappyfile.load(f)
+                mappy = mappyfile.load(f, expand_includes=False)
 
                 # inject the correct wms online_resource path
                 mappy["web"]["metadata"]["wms_onlineresource"] = settings.ows_base_url
@@ -158,7 +341,7 @@ def get_mapfile() -> dict:
             # check if it exists
             if not file_exists(c, str(settings.mapfile_path / "MAINFILE.map")):
                 with open(Path(__file__).parent / "MAINFILE.map", "r") as f:
-                    mappy = mappyfile.load(f)
+                    mappy = mappyfile.load(f, expand_includes=False)
 
                     # inject the correct wms online_resource path
                     mappy["web"]["metadata"]["wms_onlineresource"] = settings.ows_base_url
@@ -166,21 +349,185 @@ def get_mapfile() -> dict:
                 with NamedTemporaryFile() as tmp:
                     c.get(str(settings.mapfile_path / "MAINFILE.map"), tmp.name)
                     with open(tmp.name, "r") as f:
-                        mappy = mappyfile.load(f)
+                        mappy = mappyfile.load(f, expand_includes=False)
                     
     # return the object
     return mappy
 
 
 def put_mapfile(mappy: dict) -> str:
+    """
+    Save the MAINFILE. It is written next to the target and renamed into place,
+    so MapServer never reads a partial file.
+    """
+    local_path = settings.mapfile_path / "MAINFILE.map"
+    tmp_path = local_path.with_name(f".{local_path.name}.{uuid4().hex}.tmp")
+
     # check if the MAINFILE exists locally
+    if settings.mapserver_local:
+        mappyfile.save(mappy, str(tmp_path))
+        os.replace(tmp_path, local_path)
+    else:
+        with ssh_connect(server='mapserver') as c:
+            with NamedTemporaryFile() as tmp:
+                mappyfile.save(mappy, tmp.name)
+                c.put(tmp.name, str(tmp_path))
+            c.sftp().posix_rename(str(tmp_path), str(local_path))
+
+    return str(local_path)
+
+
+def include_in_mapfile(relative_path: str):
+    """
+    Add an INCLUDE of relative_path to the MAINFILE, if it is not included yet.
+    A missing MAINFILE is created from the template, which might already include
+    relative_path. The MAINFILE is changed under the lock of the layers file, so
+    several processors starting at once don't overwrite each other, and it is
+    replaced by a rename.
+    """
     local_path = settings.mapfile_path / "MAINFILE.map"
+    lock_path = settings.mapfile_path / f".{LAYERS_FILE}.lock"
+
     if settings.mapserver_local:
-        mappyfile.save(mappy, str(local_path))
-        return str(local_path)
+        settings.mapfile_path.mkdir(parents=True, exist_ok=True)
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                exists = local_path.exists()
+                mappy = get_mapfile()
+                if relative_path not in mappy.get("include", []):
+                    mappy.setdefault("include", []).append(relative_path)
+                elif exists:
+                    return
+                put_mapfile(mappy)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
     else:
+        with ssh_connect(server='mapserver') as c:
+            exists = file_exists(c, str(local_path))
+        mappy = get_mapfile()
+        if relative_path not in mappy.get("include", []):
+            mappy.setdefault("include", []).append(relative_path)
+        elif exists:
+            return
+
+        # the INCLUDE is the only change made to an existing MAINFILE, so the new
+        # file only replaces the MAINFILE if no one else added the INCLUDE meanwhile
+        tmp_path = local_path.with_name(f".{local_path.name}.{uuid4().hex}.tmp")
         with ssh_connect(server='mapserver') as c:
             with NamedTemporaryFile() as tmp:
                 mappyfile.save(mappy, tmp.name)
-                c.put(tmp.name, str(settings.mapfile_path / "MAINFILE.map"))
-                
\ No newline at end of file
+                c.put(tmp.name, str(tmp_path))
+            main, tmp, lock = quote(str(local_path)), quote(str(tmp_path)), quote(str(lock_path))
+            pattern = quote(f'^[[:space:]]*INCLUDE[[:space:]]+"{relative_path}"')
+            cmd = f"grep -qiE {pattern} {main} 2>/dev/null || mv -f {tmp} {main}"
+            c.run(f"mkdir -p {quote(str(settings.mapfile_path))} && flock {lock} sh -c {quote(cmd)}; rm -f {tmp}", hide=True)
+
+
+def put_layerfile(name: str, text: str) -> str:
+    """
+    Save the text of a single LAYER into its own file in the layers directory
+    next to the MAINFILE. The file is replaced atomically.
+
+    Returns the path of the layer file relative to the MAINFILE
+    """
+    relative_path = f"{LAYERS_DIR}/{name}.map"
+    target_path = settings.mapfile_path / relative_path
+    tmp_path = target_path.with_name(f".{target_path.name}.tmp")
+
+    if settings.mapserver_local:
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, target_path)
+    else:
+        with ssh_connect(server='mapserver') as c:
+            c.run(f"mkdir -p {quote(str(target_path.parent))}", hide=True)
+            c.sftp().putfo(BytesIO(text.encode()), str(tmp_path))
+            c.sftp().posix_rename(str(tmp_path), str(target_path))
+
+    return relative_path
+
+
+def create_layers_file():
+    """
+    Create the (empty) layers file, if it does not exist yet.
+    """
+    layers_path = settings.mapfile_path / LAYERS_FILE
+    if settings.mapserver_local:
+        layers_path.parent.mkdir(parents=True, exist_ok=True)
+        layers_path.touch(exist_ok=True)
+    else:
+        with ssh_connect(server='mapserver') as c:
+            c.run(f"touch {quote(str(layers_path))}", hide=True)
+
+
+def include_layerfile(relative_path: str):
+    """
+    Add an INCLUDE of the layer file to the layers file, which is included by
+    the MAINFILE. The layers file is locked while it is changed, so concurrent 
+    workers (and processors) don't overwrite each other. The include is only 
+    added once.
+    """
+    line = f'INCLUDE "{relative_path}"'
+    layers_path = settings.mapfile_path / LAYERS_FILE
+    lock_path = settings.mapfile_path / f".{LAYERS_FILE}.lock"
+
+    if settings.mapserver_local:
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(layers_path, "a+") as f:
+                    f.seek(0)
+                    if line not in f.read().splitlines():
+                        f.write(line + "\n")
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    else:
+        with ssh_connect(server='mapserver') as c:
+            layers, lock = quote(str(layers_path)), quote(str(lock_path))
+            cmd = f"grep -qxF {quote(line)} {layers} || echo {quote(line)} >> {layers}"
+            c.run(f"flock {lock} sh -c {quote(cmd)}", hide=True)
+
+
+def append_tileindex(feature_collection: str, file_id: str, query: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    Add the footprint features to the tile index next to the MAINFILE, replacing the
+    ones of the same file_id. The GeoPackage keeps an R-tree index on the footprints,
+    so MapServer only opens the rasters within the requested extent. The ogr tools
+    run on the MapServer host if it is remote, and the index is locked while it
+    is changed. New properties of the features are added as columns.
+    If given, the SQL query is run on the updated index within the same lock.
+
+    Returns the rows of the query, empty if it failed or was not given
+    """
+    index_path = quote(str(settings.mapfile_path / TILEINDEX_FILE))
+    lock_path = quote(str(settings.mapfile_path / f".{TILEINDEX_FILE}.lock"))
+    delete = quote(f"DELETE FROM {TILEINDEX_TABLE} WHERE file_id = '{file_id.replace(chr(39), chr(39) * 2)}'")
+
+    def command(features_path: str) -> str:
+        # the delete fails if the index does not exist yet, which is fine
+        cmd = (
+            f"(ogrinfo -q {index_path} -sql {delete} > /dev/null 2>&1 || true) && "
+            f"ogr2ogr -f GPKG -append -addfields -nln {TILEINDEX_TABLE} {index_path} {quote(features_path)}"
+        )
+        # the query fails if it uses columns no feature has had yet
+        if query is not None:
+            cmd += f" && (ogr2ogr -f CSV /vsistdout/ {index_path} -sql {quote(query)} 2> /dev/null || true)"
+        return f"flock {lock_path} sh -c {quote(cmd)}"
+
+    if settings.mapserver_local:
+        with NamedTemporaryFile("w", suffix=".geojson") as tmp:
+            tmp.write(feature_collection)
+            tmp.flush()
+            output = subprocess.run(command(tmp.name), shell=True, check=True, capture_output=True, text=True).stdout
+    else:
+        with ssh_connect(server='mapserver') as c:
+            features_path = f"/tmp/{TILEINDEX_TABLE}-{uuid4().hex}.geojson"
+            c.sftp().putfo(BytesIO(feature_collection.encode()), features_path)
+            try:
+                output = c.run(command(features_path), hide=True).stdout
+            finally:
+                c.sftp().remove(features_path)
+
+    return list(csv.DictReader(StringIO(output))) if query is not None else []
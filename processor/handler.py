@@ -2,105 +2,229 @@
 This is the actual file handler that manages the updating of the metadata files
 
 """
+from typing import Any, Dict, Generator, List, Optional, Tuple
+from pathlib import Path
+import hashlib
 import time
-from tempfile import NamedTemporaryFile
-from concurrent.futures import ThreadPoolExecutor
+import os
 
 import prometheus_client
+from rasterio.enums import Resampling
+from rasterio.coords import BoundingBox
 
 from .utils.settings import settings
-from .metadata import get_metadata, list_pending_uuids
+from .config import config
+from .metadata import get_metadata, claim_pending, list_processed, MetadataWriter
+from .leases import get_leases
 from .auth import supabase_client
 from .utils.metadata_models import FileUploadMetadata, StatusEnum
-from .resample import resample
+from .pool import resample_in_pool, pool_workers
+from .resample import estimate_memory
+from .admission import get_admission
+from .pipeline import Pipeline, Stage
 from .mapserver import create_wms_source
-from .files import put_processed_raster, fetch_raw_raster, archive_raster
-from .logger import logger
+from .tiles import create_tile_source
+from .files import processed_raster_target, processed_raster_path, fetch_raw_raster, archive_raster, archived_raster_path
+from .files import download_raw_raster, release_raw_raster, processed_raster_tmp_path, upload_processed_raster
+from .cache import get_cache, cache_key
+from .logger import logger, file_context
+from .metrics import stage, jobs_in_flight, raw_bytes, processed_bytes, compression_ratio, cache_requests
 
 
 # create a prometheus histogram for the processing time
 processing_time = prometheus_client.Histogram('processor_processing_time', 'Time taken to process a file', unit='seconds')
 
 
-def dispatch_pending_files(wait: bool = True):
+def preprocess_file(uuid: str) -> FileUploadMetadata:
+    # make sure no other node is processing the file, files of crashed nodes are pending again
+    leases = get_leases()
+    leases.reclaim()
+    if len(leases.acquire([uuid])) == 0:
+        logger.info(f"Skipping {uuid}, it is leased by another node.")
+        return get_metadata(uuid=uuid)
+
+    try:
+        # claim the file, unless it was processed already, e.g. by a job run twice
+        with supabase_client() as client:
+            response = client.table(settings.metadata_table) \
+                .update({"status": StatusEnum.processing.value}) \
+                .eq("uuid", uuid) \
+                .eq("status", StatusEnum.pending.value) \
+                .execute()
+        if len(response.data) == 0:
+            logger.info(f"Skipping {uuid}, it is not pending anymore.")
+            return get_metadata(uuid=uuid)
+        metadata = FileUploadMetadata(**response.data[0])
+
+        # process the file and update the metadata
+        updates = process_file(uuid, metadata)
+        with stage("backend"), supabase_client() as client:
+            client.table(settings.metadata_table).update(updates).eq("uuid", uuid).execute()
+    finally:
+        leases.release([uuid])
+    
+    return metadata
+
+
+def resample_raster(src_file: str, target_path: str) -> Tuple[BoundingBox, List[dict], int]:
     """
-    Load a list of all pending files on the server
+    Resample the raw raster at src_file into target_path with the current settings.
 
-    The create a new Thread for each file and start the preprocessing
+    Returns the bounding box, the band statistics and the size of the processed raster
     """
-    # get the list of pending files
-    uuids = list_pending_uuids()
-    
-    # start a new thread for each file
-    with ThreadPoolExecutor() as executor:
-        # map the uuids to the preprocessing function
-        executor.map(preprocess_file, uuids)
+    # wait until the raster fits into the memory budget
+    cost = estimate_memory(src_file, settings.scale_factor, settings.processor_image_driver, config.resample_max_memory)
+    with get_admission().admit(cost), stage("resample"):
+        bbox, band_stats = resample_in_pool(
+            src_file,
+            target_path,
+            scale_factor=settings.scale_factor,
+            compress=settings.processor_compression,
+            jpeg_quality=settings.compression_quality,
+            driver=settings.processor_image_driver,
+            max_memory=config.resample_max_memory,
+            overview_resampling=Resampling[config.overview_resampling],
+            blocksize=config.cog_blocksize
+        )
 
-        # wait for all threads to finish
-        executor.shutdown(wait=wait)
+    # record the sizes
+    raw_size, processed_size = os.path.getsize(src_file), os.path.getsize(target_path)
+    raw_bytes.inc(raw_size)
+    processed_bytes.inc(processed_size)
+    compression_ratio.observe(raw_size / max(processed_size, 1))
 
+    return bbox, band_stats, processed_size
 
-def preprocess_file(uuid: str) -> FileUploadMetadata:
-    # get the current metadata for the given uuid
-    metadata = get_metadata(uuid=uuid)
 
-    # update the status to processing
-    with supabase_client() as client:
-        client.table(settings.metadata_table).update({"status": StatusEnum.processing.value}).eq("uuid", uuid).execute()
-        metadata.status = StatusEnum.processing.value
-    
-    # START - resampling
-    t1 = time.time()
+def resample_file(metadata: FileUploadMetadata, src_file: str) -> Tuple[BoundingBox, List[dict], int]:
+    """
+    Resample the fetched raw raster and write the result straight to its final
+    location.
+
+    Returns the bounding box, the band statistics and the size of the processed raster
+    """
+    with processed_raster_target(metadata) as target_path:
+        return resample_raster(src_file, target_path)
+
+
+def raw_digest() -> Optional[Any]:
+    # the raw raster is only hashed while it is fetched if the cache is used
+    return hashlib.sha256() if get_cache() is not None else None
+
+
+def lookup_cache(uuid: str, metadata: FileUploadMetadata, digest: Optional[Any]) -> Tuple[Optional[Tuple[BoundingBox, List[dict]]], Optional[str]]:
+    """
+    Reuse the output of an identical upload processed before. The digest is the
+    hashlib object of the fetched raw raster, as returned by raw_digest.
+
+    Returns the cached bounding box and band statistics, or None, and the cache key
+    """
+    cache = get_cache()
+    if cache is None or digest is None:
+        return None, None
+
+    try:
+        with stage("cache"):
+            key = cache_key(digest.hexdigest())
+            cached = cache.get(key, processed_raster_path(metadata))
+        cache_requests.labels(result="hit" if cached is not None else "miss").inc()
+    except Exception as e:
+        # the cache is only a shortcut, so process the file anyway
+        logger.warning(f"Could not look up {uuid} in the cache: {e}")
+        return None, None
+
+    if cached is not None:
+        logger.info(f"Reusing the processed raster of an identical upload for {uuid}.")
+    return cached, key
+
+
+def store_cache(uuid: str, key: Optional[str], metadata: FileUploadMetadata, band_stats: List[dict], processed_size: int):
+    if key is None:
+        return
+
     try:
-        # get the file
-        with NamedTemporaryFile() as target_path:
-            with fetch_raw_raster(metadata) as src_file:
-                # resample the file
-                bbox = resample(
-                    src_file,
-                    target_path.name,
-                    scale_factor=settings.scale_factor,
-                    compress=settings.processor_compression,
-                    jpeg_quality=settings.compression_quality,
-                    driver=settings.processor_image_driver
-                )
-
-                # update the metadata
-                metadata.bbox = bbox
+        get_cache().put(key, processed_raster_path(metadata), metadata.bbox, band_stats, processed_size)
+    except Exception as e:
+        logger.warning(f"Could not add {uuid} to the cache: {e}")
+
+
+def process_file(uuid: str, metadata: FileUploadMetadata) -> dict:
+    """
+    Run the processing pipeline for a file that is already flagged as processing.
+    All log records emitted while processing carry the file_id of the metadata.
+
+    Returns the updates for the metadata row of the file
+    """
+    with file_context(metadata), jobs_in_flight.track_inprogress():
+        # START - resampling
+        t1 = time.time()
+        band_stats = []
+        try:
+            digest = raw_digest()
+            with fetch_raw_raster(metadata, digest) as src_file:
+                cached, key = lookup_cache(uuid, metadata, digest)
+                if cached is not None:
+                    metadata.bbox, band_stats = cached
+                else:
+                    metadata.bbox, band_stats, processed_size = resample_file(metadata, src_file)
+                    store_cache(uuid, key, metadata, band_stats, processed_size)
             
-            # put the file to the right location
-            processed_path = put_processed_raster(metadata, target_path.name)
-            metadata.processed_path = processed_path
+            # the file is in place now
+            metadata.processed_path = processed_raster_path(metadata)
         
-    except Exception as e:
-        logger.error(str(e))
-        # update the status to errored
-        metadata.status = StatusEnum.errored
+        except Exception as e:
+            logger.error(str(e))
+            # update the status to errored
+            metadata.status = StatusEnum.errored
         
-    finally:
-        t2 = time.time()
-        metadata.compress_time = t2 - t1
+        finally:
+            t2 = time.time()
+            metadata.compress_time = t2 - t1
 
-        processing_time.observe(t2 - t1)
-    # FINISH - resampling
+            processing_time.observe(t2 - t1)
+        # FINISH - resampling
         
+        return publish_file(uuid, metadata, band_stats)
+
+
+def publish_file(uuid: str, metadata: FileUploadMetadata, band_stats: List[dict], archive: bool = True) -> dict:
+    """
+    Archive the raw raster and create the WMS source of a processed file.
+    Files reprocessed from the archive are published with archive=False.
+
+    Returns the updates for the metadata row of the file
+    """
     # START - copy the file
-    try:
-        archive_raster(metadata)
-    except Exception as e:
-        logger.error(str(e))
-        metadata.status = StatusEnum.errored
+    if archive:
+        try:
+            with stage("archive"):
+                archive_raster(metadata)
+        except Exception as e:
+            logger.error(str(e))
+            metadata.status = StatusEnum.errored
     # END - copy the file
-        
+    
     # START - create the WMS source
     try:
-        wms_url = create_wms_source(metadata=metadata)
+        with stage("mapfile"):
+            wms_url = create_wms_source(metadata=metadata, band_stats=band_stats)
         metadata.wms_source = wms_url
     except Exception as e:
         logger.error(str(e))
         metadata.status = StatusEnum.errored
     # END - create the WMS source
-        
+
+    # START - render the static tiles
+    tile_source = None
+    if config.tiles_path is not None:
+        try:
+            with stage("tiles"):
+                tile_source = create_tile_source(metadata=metadata, band_stats=band_stats)
+        except Exception as e:
+            # the WMS still serves the file
+            logger.error(f"Could not render the tiles: {e}")
+    # END - render the static tiles
+    
     # finally set the flag to processed
     metadata.status = StatusEnum.processed
     logger.debug(f"Final metadata state: {metadata}")
@@ -111,12 +235,233 @@ def preprocess_file(uuid: str) -> FileUploadMetadata:
         "compress_time": metadata.compress_time,
         "processed_path": metadata.processed_path,
         "wms_source": metadata.wms_source,
-        "bbox": f"BOX({metadata.bbox.bottom} {metadata.bbox.left}, {metadata.bbox.top} {metadata.bbox.right})"
+        "bbox": f"BOX({metadata.bbox.bottom} {metadata.bbox.left}, {metadata.bbox.top} {metadata.bbox.right})",
     }
+    if config.store_band_stats:
+        updates["band_stats"] = band_stats
+    if tile_source is not None and config.store_tile_source:
+        updates["tile_source"] = tile_source
     logger.debug(f"Updates sent to backend: {updates}")
-    
-    with supabase_client() as client:
-        client.table(settings.metadata_table).update(updates).eq("uuid", uuid).execute()
     logger.info(f"Finished processing {uuid} in {metadata.compress_time} seconds.")
-    
-    return metadata
+
+    return updates
+
+
+class FileJob:
+    """
+    The state of one file on its way through the pipeline.
+    """
+    def __init__(self, uuid: str, row: dict):
+        self.uuid = uuid
+        self.row = row
+        self.metadata = FileUploadMetadata(**row)
+        self.band_stats: List[dict] = []
+        self.cache_key: Optional[str] = None
+        self.cached = False
+        self.src_file: Optional[str] = None
+        self.tmp_path: Optional[str] = None
+        self.processed_size = 0
+        self.t1: Optional[float] = None
+        self.t2: Optional[float] = None
+        self.error: Optional[Exception] = None
+
+
+def claimed_jobs(batch_size: int) -> Generator[FileJob, None, None]:
+    # claim the next batch only when the pipeline asks for more files
+    while True:
+        rows = claim_pending(limit=batch_size)
+        if len(rows) == 0:
+            return
+        logger.info(f"Claimed {len(rows)} pending files.")
+
+        for uuid, row in rows.items():
+            yield FileJob(uuid, row)
+
+
+def dispatch_pending_files(batch_size: int = config.claim_batch_size):
+    """
+    Claim the pending files on the server in batches of batch_size
+
+    The files are processed as a pipeline, so that the download of one file
+    overlaps with the resampling of another. The results are written back to
+    the backend in batches
+    """
+    writer = MetadataWriter(batch_size=batch_size)
+
+    def publish(job: FileJob) -> FileJob:
+        with file_context(job.metadata):
+            try:
+                # failed files are neither archived nor published
+                if job.error is not None:
+                    logger.error(f"Could not process {job.uuid}: {job.error}")
+                    updates = {"status": StatusEnum.errored.value}
+                else:
+                    job.metadata.compress_time = job.t2 - job.t1
+                    processing_time.observe(job.metadata.compress_time)
+                    updates = publish_file(job.uuid, job.metadata, job.band_stats)
+            except Exception as e:
+                logger.error(f"Could not publish {job.uuid}: {e}")
+                updates = {"status": StatusEnum.errored.value}
+            finally:
+                jobs_in_flight.dec()
+
+        with stage("backend"):
+            writer.add(job.uuid, updates)
+        return job
+
+    pipeline = Pipeline([
+        Stage("fetch", fetch_step, workers=config.pipeline_fetch_workers, queue_size=config.pipeline_queue_size),
+        Stage("resample", resample_step, workers=config.pipeline_resample_workers or pool_workers(), queue_size=config.pipeline_queue_size),
+        Stage("upload", upload_step, workers=config.pipeline_upload_workers, queue_size=config.pipeline_queue_size),
+        Stage("publish", publish, workers=config.pipeline_publish_workers, queue_size=config.pipeline_queue_size, run_failed=True),
+    ])
+    pipeline.run(claimed_jobs(batch_size))
+
+    # write the rest
+    with stage("backend"):
+        writer.flush()
+
+
+# the columns of the metadata row that change when a file is reprocessed
+REPROCESSED_COLUMNS = ("processed_path", "wms_source", "bbox", "band_stats", "compress_time", "tile_source")
+
+
+def reprocessed_jobs(
+    filters: Optional[Dict[str, Any]],
+    file_ids: Optional[List[str]],
+    start_after: Optional[str],
+    limit: Optional[int],
+    batch_size: int
+) -> Generator[FileJob, None, None]:
+    # page through the processed files and lease them, the status is left unchanged
+    leases = get_leases()
+    count = 0
+    while limit is None or count < limit:
+        rows = list_processed(filters, file_ids, start_after=start_after, limit=batch_size)
+        if limit is not None:
+            rows = rows[:limit - count]
+        if len(rows) == 0:
+            return
+        start_after = rows[-1]['uuid']
+
+        acquired = set(leases.acquire([row['uuid'] for row in rows]))
+        logger.info(f"Reprocessing {len(acquired)} of {len(rows)} files up to uuid {start_after}.")
+
+        for row in rows:
+            if row['uuid'] not in acquired:
+                logger.info(f"Skipping {row['uuid']}, it is leased by another node.")
+                continue
+
+            # the raw raster was moved into the archive after the first processing
+            job = FileJob(row['uuid'], row)
+            job.metadata.raw_path = archived_raster_path(job.metadata)
+            count += 1
+            yield job
+
+
+def reprocess_files(
+    filters: Optional[Dict[str, Any]] = None,
+    file_ids: Optional[List[str]] = None,
+    start_after: Optional[str] = None,
+    limit: Optional[int] = None,
+    batch_size: int = config.claim_batch_size
+):
+    """
+    Encode processed files again from their archived raw rasters, ie. after the
+    scale_factor, compression or quality settings changed. The files can be selected
+    by column values in filters and by file_ids. They are processed in order of their
+    uuid, so that an interrupted run can be continued with start_after set to the last
+    uuid logged.
+
+    The new raster replaces the old one in a single rename and the WMS layer is replaced
+    after it, so the files are served throughout. If a file fails, the old raster and
+    layer are kept. The metadata rows are written in batches, at most
+    reprocess_write_rate batches per second
+    """
+    writer = MetadataWriter(batch_size=batch_size, rate=config.reprocess_write_rate)
+
+    def publish(job: FileJob) -> FileJob:
+        updates = None
+        with file_context(job.metadata):
+            try:
+                if job.error is not None:
+                    logger.error(f"Could not reprocess {job.uuid}, keeping the current raster: {job.error}")
+                else:
+                    job.metadata.compress_time = job.t2 - job.t1
+                    published = publish_file(job.uuid, job.metadata, job.band_stats, archive=False)
+
+                    # the row was read long ago, so only the columns that changed are written
+                    updates = {column: value for column, value in published.items() if column in REPROCESSED_COLUMNS}
+            except Exception as e:
+                logger.error(f"Could not publish {job.uuid}: {e}")
+            finally:
+                jobs_in_flight.dec()
+
+        # the row is unchanged, so just let the file go
+        if updates is None:
+            get_leases().release([job.uuid])
+            return job
+
+        with stage("backend"):
+            writer.add(job.uuid, updates)
+        return job
+
+    pipeline = Pipeline([
+        Stage("fetch", fetch_step, workers=config.pipeline_fetch_workers, queue_size=config.pipeline_queue_size),
+        Stage("resample", resample_step, workers=config.reprocess_workers or pool_workers(), queue_size=config.pipeline_queue_size),
+        Stage("upload", upload_step, workers=config.pipeline_upload_workers, queue_size=config.pipeline_queue_size),
+        Stage("publish", publish, workers=config.pipeline_publish_workers, queue_size=config.pipeline_queue_size, run_failed=True),
+    ])
+    pipeline.run(reprocessed_jobs(filters, file_ids, start_after, limit, batch_size))
+
+    # write the rest
+    with stage("backend"):
+        writer.flush()
+
+
+def fetch_step(job: FileJob) -> FileJob:
+    """
+    Make the raw raster available locally and look it up in the cache.
+    """
+    job.t1 = time.time()
+    jobs_in_flight.inc()
+
+    with file_context(job.metadata):
+        digest = raw_digest()
+        job.src_file = download_raw_raster(job.metadata, digest)
+        cached, job.cache_key = lookup_cache(job.uuid, job.metadata, digest)
+        if cached is not None:
+            job.metadata.bbox, job.band_stats = cached
+            job.cached = True
+            release_raw_raster(job.metadata, job.src_file)
+            job.src_file = None
+
+    return job
+
+
+def resample_step(job: FileJob) -> FileJob:
+    if job.cached:
+        return job
+
+    with file_context(job.metadata):
+        job.tmp_path = processed_raster_tmp_path(job.metadata)
+        try:
+            job.metadata.bbox, job.band_stats, job.processed_size = resample_raster(job.src_file, job.tmp_path)
+        except Exception:
+            Path(job.tmp_path).unlink(missing_ok=True)
+            raise
+        finally:
+            release_raw_raster(job.metadata, job.src_file)
+
+    return job
+
+
+def upload_step(job: FileJob) -> FileJob:
+    with file_context(job.metadata):
+        if not job.cached:
+            upload_processed_raster(job.metadata, job.tmp_path)
+            store_cache(job.uuid, job.cache_key, job.metadata, job.band_stats, job.processed_size)
+        job.metadata.processed_path = processed_raster_path(job.metadata)
+        job.t2 = time.time()
+
+    return job
@@ -0,0 +1,200 @@
+"""
+A persistent job queue and a bounded scheduler for the preprocessing.
+
+Dispatched uuids are stored in a local SQLite database, so that they survive a
+restart of the processor. A fixed number of worker threads claims the queued jobs
+by priority and runs them. Each uuid is only queued once at a time and jobs that
+were running when the processor stopped are queued again on the next start.
+Finished jobs are kept for the retention period and deleted afterwards.
+
+"""
+from typing import Callable, Optional, List
+from contextlib import contextmanager
+import sqlite3
+import threading
+import time
+
+from .logger import logger
+
+
+class JobQueue:
+    def __init__(self, path: str, retention: float = 7 * 24 * 3600):
+        self.path = path
+        self.retention = retention
+
+        # use the write-ahead log, so that reading the queue does not block the workers
+        con = sqlite3.connect(self.path)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.close()
+
+        # create the jobs table
+        with self.connect() as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    uuid TEXT PRIMARY KEY,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    enqueued_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT
+                )
+            """)
+            con.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, enqueued_at)")
+
+    @contextmanager
+    def connect(self, immediate: bool = False):
+        """
+        Open a connection and run a single transaction. With immediate=True, the
+        write lock is acquired right away, so that concurrent claims can't select
+        the same job.
+        """
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            con.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            yield con
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    def put(self, uuid: str, priority: int = 0) -> bool:
+        """
+        Queue the uuid. If it is already queued, only the priority is raised.
+        Returns False if the uuid was already queued or running.
+        """
+        with self.connect(immediate=True) as con:
+            row = con.execute("SELECT status, priority FROM jobs WHERE uuid = ?", (uuid,)).fetchone()
+
+            # the job is new or has finished before, so (re-)queue it
+            if row is None or row[0] in ('done', 'failed'):
+                con.execute(
+                    "INSERT OR REPLACE INTO jobs (uuid, priority, status, enqueued_at) VALUES (?, ?, 'queued', ?)",
+                    (uuid, priority, time.time())
+                )
+                return True
+
+            # the job is waiting, raise the priority if needed
+            if row[0] == 'queued' and priority > row[1]:
+                con.execute("UPDATE jobs SET priority = ? WHERE uuid = ?", (priority, uuid))
+
+            return False
+
+    def claim(self) -> Optional[str]:
+        """
+        Mark the queued job with the highest priority as running and return its uuid.
+        """
+        with self.connect(immediate=True) as con:
+            row = con.execute(
+                "SELECT uuid FROM jobs WHERE status = 'queued' ORDER BY priority DESC, enqueued_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+
+            con.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE uuid = ?",
+                (time.time(), row[0])
+            )
+            return row[0]
+
+    def finish(self, uuid: str, error: Optional[str] = None):
+        """
+        Mark the job as done, or as failed if an error is given. Jobs finished
+        longer than the retention ago are deleted.
+        """
+        now = time.time()
+        with self.connect() as con:
+            con.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE uuid = ?",
+                ('failed' if error is not None else 'done', now, error, uuid)
+            )
+            con.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (now - self.retention,)
+            )
+
+    def recover(self) -> int:
+        """
+        Queue all jobs again that were interrupted while running.
+        Returns the number of recovered jobs.
+        """
+        with self.connect(immediate=True) as con:
+            cur = con.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+            return cur.rowcount
+
+    def list(self, status: str = 'queued') -> List[str]:
+        with self.connect() as con:
+            rows = con.execute(
+                "SELECT uuid FROM jobs WHERE status = ? ORDER BY priority DESC, enqueued_at", (status,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+class Scheduler:
+    """
+    Run the jobs of a JobQueue on a fixed number of long-lived worker threads.
+    """
+    def __init__(self, queue: JobQueue, worker: Callable[[str], object], max_workers: int = 5, poll_interval: float = 5.0):
+        self.queue = queue
+        self.worker = worker
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+
+        self._wakeup = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        # queue the jobs again, that were running when we stopped the last time
+        recovered = self.queue.recover()
+        if recovered > 0:
+            logger.info(f"Recovered {recovered} interrupted preprocessing jobs from the queue.")
+
+        self._stopped.clear()
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._run, name=f"scheduler-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait: bool = True):
+        """
+        Stop the workers after their current job. Unstarted jobs stay in the queue.
+        """
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def submit(self, uuid: str, priority: int = 0) -> bool:
+        """
+        Queue the uuid and wake up an idle worker. Returns immediately.
+        """
+        queued = self.queue.put(uuid, priority=priority)
+        with self._wakeup:
+            self._wakeup.notify()
+
+        return queued
+
+    def _run(self):
+        while not self._stopped.is_set():
+            uuid = self.queue.claim()
+
+            # nothing to do, wait for the next submit
+            if uuid is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=self.poll_interval)
+                continue
+
+            try:
+                self.worker(uuid)
+                self.queue.finish(uuid)
+            except Exception as e:
+                logger.error(f"Preprocessing job {uuid} failed: {str(e)}")
+                self.queue.finish(uuid, error=str(e))
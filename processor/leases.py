@@ -0,0 +1,193 @@
+"""
+Leases on files, so that several processor nodes can share one metadata table.
+
+Before a node starts processing a file, it inserts a lease row for the uuid into
+the lease table. The uuid is the primary key, so only one node can hold the lease
+and the other inserts are ignored. The holder renews its leases in the background.
+If a node crashes, its leases expire and any node reclaims them by deleting the
+expired lease and flagging the file as pending again.
+
+The lease table needs to exist in the backend:
+
+    CREATE TABLE processor_leases (
+        uuid TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at TIMESTAMPTZ NOT NULL,
+        heartbeat_at TIMESTAMPTZ NOT NULL
+    );
+
+"""
+from typing import List, Optional, Set
+from datetime import datetime, timedelta, timezone
+import threading
+import logging
+import socket
+import uuid as uuidlib
+import os
+
+from .utils.settings import settings
+from .utils.metadata_models import StatusEnum
+from .auth import supabase_client
+from .config import config
+
+
+logger = logging.getLogger("processor")
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuidlib.uuid4().hex[:8]}"
+
+
+class LeaseManager:
+    def __init__(self, owner: str, ttl: float = 120.0, heartbeat_interval: float = 30.0, table: str = "processor_leases"):
+        self.owner = owner
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.table = table
+
+        # the uuids this node holds a lease for
+        self._held: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _lease(self, uuid: str) -> dict:
+        now = datetime.now(timezone.utc)
+        return dict(
+            uuid=uuid,
+            owner=self.owner,
+            expires_at=(now + timedelta(seconds=self.ttl)).isoformat(),
+            heartbeat_at=now.isoformat()
+        )
+
+    def reclaim(self) -> List[str]:
+        """
+        Remove the expired leases of other nodes and flag their files as pending again.
+
+        Returns the reclaimed uuids
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        with supabase_client() as client:
+            # the delete only matches leases that are still expired, so a lease
+            # renewed in the meantime is kept
+            response = client.table(self.table).delete().lt("expires_at", now).execute()
+            uuids = [row['uuid'] for row in response.data]
+            if len(uuids) == 0:
+                return []
+
+            client.table(settings.metadata_table) \
+                .update({"status": StatusEnum.pending.value}) \
+                .in_("uuid", uuids) \
+                .eq("status", StatusEnum.processing.value) \
+                .execute()
+
+        logger.warning(f"Reclaimed {len(uuids)} files with expired leases: {uuids}")
+        return uuids
+
+    def acquire(self, uuids: List[str]) -> List[str]:
+        """
+        Try to take the lease on each of the uuids.
+
+        Returns the uuids this node holds a lease for now
+        """
+        if len(uuids) == 0:
+            return []
+
+        # existing leases are left untouched and not returned
+        with supabase_client() as client:
+            response = client.table(self.table).upsert(
+                [self._lease(uuid) for uuid in uuids],
+                on_conflict="uuid",
+                ignore_duplicates=True
+            ).execute()
+        acquired = [row['uuid'] for row in response.data if row['owner'] == self.owner]
+
+        with self._lock:
+            self._held.update(acquired)
+        self.start()
+        return acquired
+
+    def renew(self):
+        """
+        Extend the expiry of all leases this node holds.
+        """
+        with self._lock:
+            held = list(self._held)
+        if len(held) == 0:
+            return
+
+        lease = self._lease("")
+        with supabase_client() as client:
+            response = client.table(self.table) \
+                .update(dict(expires_at=lease['expires_at'], heartbeat_at=lease['heartbeat_at'])) \
+                .in_("uuid", held) \
+                .eq("owner", self.owner) \
+                .execute()
+        renewed = {row['uuid'] for row in response.data}
+
+        # a lease that could not be renewed was reclaimed by another node
+        lost = set(held) - renewed
+        if len(lost) > 0:
+            logger.error(f"Lost the leases on {sorted(lost)}. Another node might process them as well.")
+            with self._lock:
+                self._held -= lost
+
+    def release(self, uuids: List[str]):
+        """
+        Give up the leases after the files are processed.
+        """
+        with self._lock:
+            self._held -= set(uuids)
+        if len(uuids) == 0:
+            return
+
+        with supabase_client() as client:
+            client.table(self.table).delete().in_("uuid", uuids).eq("owner", self.owner).execute()
+
+    def abandon(self, uuids: List[str]):
+        """
+        Stop renewing the leases, so that they expire and the files are reclaimed.
+        """
+        with self._lock:
+            self._held -= set(uuids)
+
+    def _heartbeat(self):
+        while not self._stopped.wait(timeout=self.heartbeat_interval):
+            try:
+                self.renew()
+            except Exception as e:
+                # keep beating, the lease only expires after several missed heartbeats
+                logger.error(f"Could not renew the leases: {e}")
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+__LEASES: Optional[LeaseManager] = None
+__LOCK = threading.Lock()
+
+
+def get_leases() -> LeaseManager:
+    """
+    Return the lease manager of this node and create it on first use.
+    """
+    global __LEASES
+
+    with __LOCK:
+        if __LEASES is None:
+            __LEASES = LeaseManager(
+                owner=config.node_id or default_owner(),
+                ttl=config.lease_ttl,
+                heartbeat_interval=config.lease_heartbeat_interval
+            )
+
+    return __LEASES
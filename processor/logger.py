@@ -1,15 +1,60 @@
-from typing import Optional
+from typing import Generator, List, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
 import logging
+import queue
+import time
+import sys
 
 from .auth import supabase_client
 from .utils.metadata_models import FileUploadMetadata
+from .config import config
+
+
+# the file the current thread is working on, added to all log records
+current_file_id: ContextVar[Optional[str]] = ContextVar("current_file_id", default=None)
+
+
+@contextmanager
+def file_context(metadata: FileUploadMetadata) -> Generator[None, None, None]:
+    """
+    Attach the file_id of the metadata to all records logged within this context.
+    """
+    token = current_file_id.set(metadata.file_id)
+    try:
+        yield
+    finally:
+        current_file_id.reset(token)
+
 
 # create a custom supabase handler
 class SupabaseHandler(logging.Handler):
-    def __init__(self):
+    """
+    Ship the log records to the logs table in the background. Records are queued
+    and inserted in batches of up to batch_size rows or after flush_interval seconds.
+    If the backend can't keep up and the queue is full, the overflow policy decides
+    to drop the oldest or the newest records, or to block the logging thread.
+    """
+    def __init__(
+        self,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        queue_size: int = 10000,
+        overflow: str = 'drop_oldest'
+    ):
         super().__init__()
-        # set some caching options - can't find a better way right now
-        self.last_metadata: Optional[FileUploadMetadata] = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.dropped = 0
+
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._flushed = threading.Condition()
+        self._pending = 0
+        self._thread = threading.Thread(target=self._ship, name="log-shipper", daemon=True)
+        self._thread.start()
 
     def emit(self, record: logging.LogRecord) -> None:
         # set the base information
@@ -21,18 +66,89 @@ class SupabaseHandler(logging.Handler):
             origin_line=record.lineno,
         )
 
-        # check if we have a metadata object
-        if self.last_metadata is not None:
-            log.update(
-                file_id=self.last_metadata.file_id,
-            )
-            self.last_metadata = None
+        # add the file the logging thread is working on
+        file_id = current_file_id.get()
+        if file_id is not None:
+            log.update(file_id=file_id)
+
+        self._enqueue(log)
+
+    def _enqueue(self, log: dict):
+        with self._flushed:
+            self._pending += 1
+        try:
+            if self.overflow == 'block':
+                self._queue.put(log)
+            elif self.overflow == 'drop_newest':
+                self._queue.put_nowait(log)
+            else:
+                # make room by dropping the oldest record
+                while True:
+                    try:
+                        self._queue.put_nowait(log)
+                        break
+                    except queue.Full:
+                        try:
+                            self._queue.get_nowait()
+                            self._done(1, dropped=True)
+                        except queue.Empty:
+                            pass
+        except queue.Full:
+            self._done(1, dropped=True)
+
+    def _done(self, n: int, dropped: bool = False):
+        with self._flushed:
+            self._pending -= n
+            if dropped:
+                self.dropped += n
+            self._flushed.notify_all()
+
+    def _next_batch(self) -> List[dict]:
+        # collect records until the batch is full or the time window closed
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                # once stopped or the window closed, only take what is already queued
+                if self._stopped.is_set() or timeout <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _ship(self):
+        while not (self._stopped.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if not batch:
+                continue
+
+            try:
+                # connect to the database and insert the whole batch
+                with supabase_client() as client:
+                    for log in batch:
+                        log.update(user_id=client.user_id)
+                    client.table("logs").insert(batch).execute()
+                self._done(len(batch))
+            except Exception as e:
+                # never log from here, that would queue more records
+                print(f"Could not ship {len(batch)} log records: {e}", file=sys.stderr)
+                self._done(len(batch), dropped=True)
+
+    def flush(self, timeout: float = 10.0) -> None:
+        """
+        Wait until all queued records are shipped.
+        """
+        with self._flushed:
+            self._flushed.wait_for(lambda: self._pending <= 0, timeout=timeout)
 
-        # connect to the database and log
-        with supabase_client() as client:
-            # get the user
-            log.update(user_id=client.user_id)
-            client.table("logs").insert(log).execute()
+    def close(self) -> None:
+        self.flush()
+        self._stopped.set()
+        self._thread.join(timeout=self.flush_interval + 1)
+        super().close()
 
 # create the logger
 logger = logging.getLogger("processor")
@@ -44,8 +160,13 @@ logger.setLevel(logging.DEBUG)
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.DEBUG)
 
-supabase_handler = SupabaseHandler()
-supabase_handler.setLevel(logging.INFO) 
+supabase_handler = SupabaseHandler(
+    batch_size=config.log_batch_size,
+    flush_interval=config.log_flush_interval,
+    queue_size=config.log_queue_size,
+    overflow=config.log_overflow
+)
+supabase_handler.setLevel(logging.INFO)
 
 
 # create a formatter for the console handler
@@ -56,4 +177,4 @@ console_handler.setFormatter(console_formatter)
 
 # add the console handler to the logger
 logger.addHandler(console_handler)
-logger.addHandler(supabase_handler)
\ No newline at end of file
+logger.addHandler(supabase_handler)
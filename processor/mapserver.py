@@ -3,54 +3,214 @@ Create a MAPFILE for MapServer for each preprocssed dataset.
 
 The MAPFILE is a text file that contains the instructions for MapServer to render the data.
 """
+from typing import List, Optional
+import threading
+import json
+
+import mappyfile
+
 from .metadata import FileUploadMetadata
-from .files import get_mapfile, put_mapfile
+from .files import include_in_mapfile, put_layerfile, include_layerfile, create_layers_file, append_tileindex
+from .files import LAYERS_FILE, TILEINDEX_FILE, TILEINDEX_TABLE
 from .utils.settings import settings
+from .config import config
+
+
+# the union of the clip values of the first three bands of all rasters in the tile index
+TILEINDEX_CLIP_QUERY = "SELECT " + ", ".join(
+    f"MIN(clip_low_{band}) AS low_{band}, MAX(clip_high_{band}) AS high_{band}" for band in (1, 2, 3)
+) + f" FROM {TILEINDEX_TABLE}"
+
+__MAINFILE_READY = False
+__TILEINDEX_READY = False
+__LOCK = threading.Lock()
+
+
+def ensure_layers_include():
+    """
+    Make sure the MAINFILE exists and includes the layers file. This is only
+    checked once per process, as the MAINFILE is not changed afterwards.
+    """
+    global __MAINFILE_READY
+
+    with __LOCK:
+        if __MAINFILE_READY:
+            return
+
+        # create the layers file before MapServer tries to include it. An
+        # existing MAINFILE might still have all layers inline
+        create_layers_file()
+        include_in_mapfile(LAYERS_FILE)
+
+        __MAINFILE_READY = True
+
+
+def layer_processing(band_stats: Optional[List[dict]] = None) -> List[str]:
+    """
+    Use the precomputed clip values of the bands as fixed scaling. Without
+    statistics, MapServer has to calculate the scaling for each request.
+    """
+    processing = ["BANDS=1,2,3"]
+    if band_stats is not None and len(band_stats) >= 3:
+        processing.extend([f"SCALE_{s['band']}={s['clip'][0]},{s['clip'][1]}" for s in band_stats[:3]])
+    else:
+        processing.append("SCALE=AUTO")
+
+    return processing
 
 
-def add_wms_layer(metadata: FileUploadMetadata):
-    # load the mapfile, we want to use
-    mappy = get_mapfile()
+def add_wms_layer(metadata: FileUploadMetadata, band_stats: Optional[List[dict]] = None):
+    # make sure the MAINFILE includes the layers
+    ensure_layers_include()
 
-    # create the layer dictionary
+    # create the layer dictionary. The nodata areas are transparent by the
+    # mask of the processed file, so there is no need for an OFFSITE color
     layer = {
         "__type__": "layer",
         "type": "raster",
         "name": metadata.file_id,
         "status": "on",
         "data": metadata.processed_path,
-        "processing": ["BANDS=1,2,3", "SCALE=AUTO"],
-        "offsite": [0, 0, 0],
+        "processing": layer_processing(band_stats),
         "metadata": {
             "wms_title": metadata.file_id,
         },
         "template": "empty"
     }
 
-    # check if the mapfile already has layers
-    if "layers" not in mappy:
-        mappy["layers"] = [layer]
-    else:
-        mappy["layers"].append(layer)
+    # save the layer into its own file and include it, this does not
+    # depend on the number of layers already registered
+    relative_path = put_layerfile(metadata.file_id, mappyfile.dumps(layer))
+    include_layerfile(relative_path)
 
-    # put the layerfile back to the mapserver
-    put_mapfile(mappy)
 
+def tileindex_layers(band_stats: Optional[List[dict]] = None) -> str:
+    """
+    The layers serving all rasters of the tile index. The index itself is a hidden
+    polygon layer, which can be filtered to a single file by adding a file_id
+    parameter to the WMS request. The raster layer is scaled by the band_stats.
+    """
+    index_name = f"{config.tileindex_layer}_index"
+    index_layer = {
+        "__type__": "layer",
+        "type": "polygon",
+        "name": index_name,
+        "status": "off",
+        "connectiontype": "ogr",
+        "connection": TILEINDEX_FILE,
+        "data": TILEINDEX_TABLE,
+        "filter": '( ( "[file_id]" = "%file_id%" ) OR ( "%file_id%" = "all" ) )',
+        "validation": {
+            "__type__": "validation",
+            "file_id": "^[A-Za-z0-9_.-]+$",
+            "default_file_id": "all",
+        },
+    }
+    raster_layer = {
+        "__type__": "layer",
+        "type": "raster",
+        "name": config.tileindex_layer,
+        "status": "on",
+        "tileindex": index_name,
+        "tileitem": "location",
+        "processing": layer_processing(band_stats),
+        "metadata": {
+            "wms_title": config.tileindex_layer,
+        },
+        "template": "empty"
+    }
+
+    return "\n".join([mappyfile.dumps(index_layer), mappyfile.dumps(raster_layer)])
+
+
+def include_tileindex_layer(relative_path: str):
+    """
+    Include the layer file of the tile index. This is only done once per process,
+    as the include does not change when the layer file is replaced.
+    """
+    global __TILEINDEX_READY
+
+    # make sure the MAINFILE includes the layers
+    ensure_layers_include()
+
+    with __LOCK:
+        if __TILEINDEX_READY:
+            return
+
+        include_layerfile(relative_path)
+        __TILEINDEX_READY = True
 
-def create_wms_source(metadata: FileUploadMetadata) -> str:
+
+def tileindex_band_stats(rows: List[dict]) -> Optional[List[dict]]:
+    """
+    The clip values covering the clip values of all rasters in the tile index, as
+    returned by TILEINDEX_CLIP_QUERY. A single layer can only be scaled one way, so
+    this is the range that cuts off none of the rasters.
+    """
+    if len(rows) == 0 or any(rows[0].get(f"{bound}_{band}", "") == "" for band in (1, 2, 3) for bound in ("low", "high")):
+        return None
+
+    return [{"band": band, "clip": [float(rows[0][f"low_{band}"]), float(rows[0][f"high_{band}"])]} for band in (1, 2, 3)]
+
+
+def add_tileindex_entry(metadata: FileUploadMetadata, band_stats: Optional[List[dict]] = None):
+    # the footprint of the processed raster in EPSG:4326
+    left, bottom, right, top = metadata.bbox.left, metadata.bbox.bottom, metadata.bbox.right, metadata.bbox.top
+    properties = {
+        "location": metadata.processed_path,
+        "file_id": metadata.file_id,
+    }
+
+    # keep the clip values of the raster, so the layer can be scaled for all of them
+    if band_stats is not None and len(band_stats) >= 3:
+        for s in band_stats[:3]:
+            properties[f"clip_low_{s['band']}"] = float(s["clip"][0])
+            properties[f"clip_high_{s['band']}"] = float(s["clip"][1])
+
+    feature = {
+        "type": "Feature",
+        "properties": properties,
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[left, bottom], [right, bottom], [right, top], [left, top], [left, bottom]]],
+        },
+    }
+
+    rows = append_tileindex(
+        json.dumps({"type": "FeatureCollection", "features": [feature]}),
+        metadata.file_id,
+        query=TILEINDEX_CLIP_QUERY
+    )
+
+    # rewrite the layers with the scaling of the updated index, before they are included.
+    # If another processor adds a raster meanwhile, the last rewrite might miss one
+    # of them, until the next raster is added
+    relative_path = put_layerfile(config.tileindex_layer, tileindex_layers(tileindex_band_stats(rows)))
+    include_tileindex_layer(relative_path)
+
+
+def create_wms_source(metadata: FileUploadMetadata, band_stats: Optional[List[dict]] = None) -> str:
     """
     Takes a UUID for a metadata entry and creates a LAYER for that file in the 
     MAPFILE for MapServer. The MapServer is configured to serve a WMS for the 
     preproccessed image at the configured processed file location, which is always 
     local to the MapServer instance. Finally, the WMS source URL serving exactly this layer
     is saved back to the metadata entry.
+    With WMS_PUBLISHING=tileindex, the file is added to the tile index of a single layer
+    instead, and the WMS source URL filters that layer to the file.
+    The band statistics of the processed file are used to scale the layer. The
+    layer of the tile index is scaled by the clip values of all its rasters.
 
     """
-    # add the WMS layer to the mapfile
-    add_wms_layer(metadata)
+    # add the raster to the tile index, served by a single layer filtered to the file
+    if config.wms_publishing == 'tileindex':
+        add_tileindex_entry(metadata, band_stats)
+        wms_url = f"{settings.ows_base_url}LAYERS={config.tileindex_layer}&file_id={metadata.file_id}"
 
-    # create the WMS source URL
-    wms_url = f"{settings.ows_base_url}LAYERS={metadata.file_id}"
+    # or add a WMS layer for the file to the mapfile
+    else:
+        add_wms_layer(metadata, band_stats)
+        wms_url = f"{settings.ows_base_url}LAYERS={metadata.file_id}"
 
     return wms_url
 
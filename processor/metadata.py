@@ -1,8 +1,16 @@
-from typing import List
+from typing import Any, Dict, List, Optional
+import threading
+import logging
+import time
 
 from .utils.settings import settings
 from .utils.metadata_models import FileUploadMetadata, StatusEnum
 from .auth import supabase_client
+from .leases import get_leases
+
+
+logger = logging.getLogger("processor")
+
 
 def list_pending_uuids() -> List[str]:
     # we can load these without authentication
@@ -22,3 +30,130 @@ def get_metadata(uuid: str) -> FileUploadMetadata:
         metadata = FileUploadMetadata(**response.data)
     
     return metadata
+
+
+def claim_pending(limit: int = 20) -> Dict[str, dict]:
+    """
+    Flag up to limit pending files as processing and return their full metadata rows
+    by uuid. Other nodes are kept away by a lease on each returned file, which has to
+    be released after processing. Files of crashed nodes are reclaimed first.
+    """
+    leases = get_leases()
+    leases.reclaim()
+
+    with supabase_client() as client:
+        # find candidates
+        response = client.table(settings.metadata_table).select("uuid").eq("status", StatusEnum.pending.value).limit(limit).execute()
+        uuids = leases.acquire([row['uuid'] for row in response.data])
+        if len(uuids) == 0:
+            return {}
+
+        # claim them and get the updated rows back in the same request
+        response = client.table(settings.metadata_table) \
+            .update({"status": StatusEnum.processing.value}) \
+            .in_("uuid", uuids) \
+            .eq("status", StatusEnum.pending.value) \
+            .execute()
+    rows = {row['uuid']: row for row in response.data}
+
+    # files that were not pending anymore
+    leases.release([uuid for uuid in uuids if uuid not in rows])
+
+    return rows
+
+
+def list_processed(filters: Optional[Dict[str, Any]] = None, file_ids: Optional[List[str]] = None, start_after: Optional[str] = None, limit: int = 20) -> List[dict]:
+    """
+    Return up to limit full metadata rows of processed files, optionally filtered by
+    column values and file_ids. The rows are ordered by uuid and start after the uuid
+    start_after, so that the whole table can be paged through.
+    """
+    with supabase_client() as client:
+        query = client.table(settings.metadata_table).select("*").eq("status", StatusEnum.processed.value)
+        for column, value in (filters or {}).items():
+            query = query.eq(column, value)
+        if file_ids is not None:
+            query = query.in_("file_id", list(file_ids))
+        if start_after is not None:
+            query = query.gt("uuid", start_after)
+        response = query.order("uuid").limit(limit).execute()
+
+    return response.data
+
+
+def update_metadata_batch(updates: Dict[str, dict]) -> List[str]:
+    """
+    Write the changed columns of several files by uuid with one client. Only the
+    given columns are updated, so changes made to other columns in the meantime
+    are kept. A failed update does not stop the others.
+
+    Returns the uuids whose update failed
+    """
+    failed = []
+    if len(updates) == 0:
+        return failed
+
+    with supabase_client() as client:
+        for uuid, columns in updates.items():
+            try:
+                client.table(settings.metadata_table).update(columns).eq("uuid", uuid).execute()
+            except Exception as e:
+                logger.error(f"Could not update the metadata of {uuid}: {e}")
+                failed.append(uuid)
+
+    return failed
+
+
+class MetadataWriter:
+    """
+    Collect the changed columns of finished files and write them in batches
+    of batch_size with update_metadata_batch. The leases of the files are released
+    once their columns are written, or left to expire if the write failed.
+    If rate is given, at most rate batches are written per second.
+    """
+    def __init__(self, batch_size: int = 20, rate: Optional[float] = None):
+        self.batch_size = batch_size
+        self.rate = rate
+        self._updates: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._next_write = 0.0
+
+    def add(self, uuid: str, updates: dict):
+        with self._lock:
+            self._updates.setdefault(uuid, {}).update(updates)
+            if len(self._updates) < self.batch_size:
+                return
+            batch, self._updates = self._updates, {}
+        self._write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._updates = self._updates, {}
+        self._write(batch)
+
+    def _write(self, batch: Dict[str, dict]):
+        if len(batch) == 0:
+            return
+        self._wait()
+        try:
+            failed = update_metadata_batch(batch)
+        except Exception:
+            # let the leases expire, so the files are reclaimed and processed again
+            get_leases().abandon(list(batch))
+            raise
+
+        written = [uuid for uuid in batch if uuid not in failed]
+        get_leases().release(written)
+        if len(failed) > 0:
+            get_leases().abandon(failed)
+
+    def _wait(self):
+        # space the writes by 1 / rate seconds, the other writers queue up on the lock
+        if self.rate is None:
+            return
+        with self._rate_lock:
+            delay = self._next_write - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_write = time.monotonic() + 1 / self.rate
@@ -0,0 +1,71 @@
+"""
+Prometheus metrics of the processing pipeline.
+
+Each stage of a file's processing is timed separately, so that the /metrics endpoint
+shows which stage limits the throughput. The throughput histograms of the download
+and the resampling are defined next to the code they measure.
+
+"""
+from typing import Generator
+from contextlib import contextmanager
+import time
+
+import prometheus_client
+
+
+# stages of the pipeline: cache, fetch, resample, upload, archive, mapfile, tiles and backend
+stage_time = prometheus_client.Histogram(
+    'processor_stage_time',
+    'Time taken by each stage of the processing',
+    ['stage'],
+    unit='seconds',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+stage_errors = prometheus_client.Counter('processor_stage_errors', 'Errors raised in each stage of the processing', ['stage'])
+
+# data volumes
+raw_bytes = prometheus_client.Counter('processor_raw_bytes', 'Size of the raw rasters read')
+processed_bytes = prometheus_client.Counter('processor_processed_bytes', 'Size of the processed rasters written')
+network_bytes = prometheus_client.Counter('processor_network_bytes', 'Bytes transferred over SFTP', ['direction'])
+compression_ratio = prometheus_client.Histogram(
+    'processor_compression_ratio',
+    'Size of the raw raster divided by the size of the processed raster',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+megapixels_per_second = prometheus_client.Histogram(
+    'processor_megapixels_per_second',
+    'Source megapixels resampled per second',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+
+# lookups of the processed raster cache
+cache_requests = prometheus_client.Counter('processor_cache_requests', 'Lookups in the cache of processed rasters', ['result'])
+
+# jobs
+jobs_in_flight = prometheus_client.Gauge('processor_jobs_in_flight', 'Files that are processed right now')
+jobs_queued = prometheus_client.Gauge('processor_jobs_queued', 'Files waiting in the dispatch queue')
+stage_queue = prometheus_client.Gauge('processor_stage_queue', 'Files waiting in front of each pipeline stage', ['stage'])
+
+# memory admission of the resampling
+memory_admitted = prometheus_client.Gauge('processor_memory_admitted', 'Estimated memory of the running resampling jobs in MB')
+admission_wait = prometheus_client.Histogram(
+    'processor_admission_wait',
+    'Time a resampling job waited for memory',
+    unit='seconds',
+    buckets=(0.01, 0.1, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+
+
+@contextmanager
+def stage(name: str) -> Generator[None, None, None]:
+    """
+    Time the enclosed stage and count it as an error if it raises.
+    """
+    t1 = time.time()
+    try:
+        yield
+    except Exception:
+        stage_errors.labels(stage=name).inc()
+        raise
+    finally:
+        stage_time.labels(stage=name).observe(time.time() - t1)
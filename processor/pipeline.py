@@ -0,0 +1,132 @@
+"""
+Run the processing of many files as a pipeline of stages.
+
+Each stage has its own pool of worker threads, sized for the resource it uses: the
+network for fetching and uploading, the CPU for resampling, the backend for the
+metadata and the mapfile. The stages are connected by bounded queues. While one
+file is resampled, the next one is already downloaded, and a stage that is full
+makes the stages in front of it wait, so only a few files are on disk at a time.
+
+"""
+from typing import Any, Callable, Iterable, List, Optional
+import threading
+import logging
+import queue
+
+from .metrics import stage_queue
+
+
+logger = logging.getLogger("processor")
+
+# marks the end of the input on a queue
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of the pipeline. func is called with each item and returns the item
+    for the next stage. If func raises, the exception is stored in item.error and
+    the following stages skip the item, unless they are created with run_failed=True.
+    """
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1, queue_size: int = 2, run_failed: bool = False):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.run_failed = run_failed
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+
+    def _forward(self, index: int, item: Any, outbox: Optional[queue.Queue], results: List[Any], lock: threading.Lock):
+        # blocks while the next stage is busy
+        if outbox is not None:
+            outbox.put(item)
+            stage_queue.labels(stage=self.stages[index + 1].name).set(outbox.qsize())
+        else:
+            with lock:
+                results.append(item)
+
+    def _work(self, index: int, inbox: queue.Queue, outbox: Optional[queue.Queue], results: List[Any], remaining: List[int], done: List[int], lock: threading.Lock):
+        stage = self.stages[index]
+        try:
+            while True:
+                item = inbox.get()
+                stage_queue.labels(stage=stage.name).set(inbox.qsize())
+                if item is _DONE:
+                    with lock:
+                        done[index] += 1
+                    break
+
+                if getattr(item, "error", None) is None or stage.run_failed:
+                    try:
+                        item = stage.func(item)
+                    except Exception as e:
+                        logger.error(f"Stage {stage.name} failed: {e}")
+                        item.error = e
+
+                self._forward(index, item, outbox, results, lock)
+        finally:
+            with lock:
+                remaining[index] -= 1
+                last = remaining[index] == 0
+
+            if last:
+                # workers that died left their end markers, and maybe items, in the
+                # inbox. The last worker takes them, so the stage in front does not
+                # block on a full queue. The items it could not process are failed
+                while done[index] < stage.workers:
+                    item = inbox.get()
+                    if item is _DONE:
+                        done[index] += 1
+                        continue
+                    if getattr(item, "error", None) is None:
+                        item.error = RuntimeError(f"Stage {stage.name} has no workers left")
+                    self._forward(index, item, outbox, results, lock)
+
+                # tell all workers of the next stage to stop, even if this worker
+                # died, so that run() does not wait forever
+                if outbox is not None:
+                    for _ in range(self.stages[index + 1].workers):
+                        outbox.put(_DONE)
+
+    def run(self, items: Iterable[Any]) -> List[Any]:
+        """
+        Pass all items through the stages and wait until they are done.
+
+        Returns the items in the order they finished
+        """
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        results: List[Any] = []
+        remaining = [stage.workers for stage in self.stages]
+        done = [0 for _ in self.stages]
+        lock = threading.Lock()
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index, queues[index], outbox, results, remaining, done, lock),
+                    name=f"pipeline-{stage.name}-{n}",
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        # feed the items, this blocks while the first stage is busy
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            # let the items already fed finish, even if the input failed
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+
+        return results
@@ -0,0 +1,80 @@
+"""
+Place files on the local filesystem without copying their content if possible.
+
+Within a filesystem, files are moved by renaming them, and copies are made as
+hardlinks or reflinks, which only touch metadata. Only between devices, the content
+is copied, using the kernel's zero-copy file copy where available.
+
+"""
+from typing import Literal
+from pathlib import Path
+import logging
+import shutil
+import errno
+import fcntl
+import os
+
+
+# the FICLONE ioctl creates a copy-on-write clone (reflink) of a file on btrfs, xfs and others
+FICLONE = 0x40049409
+
+logger = logging.getLogger("processor")
+
+
+def reflink(src: Path, dst: Path):
+    """
+    Clone src into dst. Raises OSError if the filesystem does not support reflinks.
+    """
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            dst.unlink(missing_ok=True)
+            raise
+
+
+def place_file(src: str, dst: str, keep_source: bool = False) -> Literal['rename', 'hardlink', 'reflink', 'copy']:
+    """
+    Move (or with keep_source=True copy) src to dst. The target is replaced atomically,
+    so readers of dst see either the old or the new file.
+
+    Returns the method used to place the file
+    """
+    src, dst = Path(src), Path(dst)
+
+    # moving within a filesystem is a single rename
+    if not keep_source:
+        try:
+            os.replace(src, dst)
+            logger.debug(f"Placed {src} at {dst} using rename.")
+            return 'rename'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    # otherwise create the file next to the target and rename it into place
+    tmp_path = dst.with_name(f".{dst.name}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(src, tmp_path)
+            method = 'hardlink'
+        except OSError:
+            try:
+                reflink(src, tmp_path)
+                method = 'reflink'
+            except OSError:
+                # uses copy_file_range / sendfile on Linux
+                shutil.copyfile(src, tmp_path)
+                method = 'copy'
+        os.replace(tmp_path, dst)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    # the move crossed devices, so remove the source after the copy
+    if not keep_source:
+        src.unlink()
+
+    logger.debug(f"Placed {src} at {dst} using {method}.")
+    return method
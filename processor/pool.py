@@ -0,0 +1,119 @@
+"""
+Process pool for the CPU bound resampling stage.
+
+The files are processed on threads, as most of the work is waiting for the backend
+and the SSH servers. The resampling, reprojection and encoding are handed over to
+a shared pool of worker processes, each of them using num_threads GDAL threads,
+to make use of all cores, both within a single file and across files.
+
+"""
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import logging
+import time
+import os
+
+import rasterio
+import prometheus_client
+from rasterio.coords import BoundingBox
+from rasterio.enums import ColorInterp
+
+from .resample import resample
+from .statistics import BandStatistics
+from .config import config
+from .metrics import megapixels_per_second
+
+
+__EXECUTOR: Optional[ProcessPoolExecutor] = None
+__LOCK = threading.Lock()
+
+# the worker processes do not log, so we only need a reference to the processor logger here
+logger = logging.getLogger("processor")
+
+# create a prometheus histogram for the resampling throughput
+resample_throughput = prometheus_client.Histogram(
+    'processor_resample_throughput', 
+    'Source megapixels resampled per second and core', 
+    buckets=(0.5, 1, 2, 5, 10, 20, 50, 100, 200)
+)
+
+
+def pool_workers() -> int:
+    """
+    Number of worker processes in the pool
+    """
+    return config.resample_workers or os.cpu_count() or 1
+
+
+def worker_threads() -> int:
+    """
+    Number of GDAL threads used by each worker process. By default, the CPUs
+    are shared among the worker processes.
+    """
+    return config.resample_threads or max(1, (os.cpu_count() or 1) // pool_workers())
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Return the shared process pool and create it on first use.
+    """
+    global __EXECUTOR
+
+    with __LOCK:
+        if __EXECUTOR is None:
+            # GDAL does not survive a fork from a multi-threaded process, so we spawn the workers
+            __EXECUTOR = ProcessPoolExecutor(
+                max_workers=pool_workers(),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+    
+    return __EXECUTOR
+
+
+def shutdown(wait: bool = True):
+    """
+    Shut the process pool down. A new one is created on the next use.
+    """
+    global __EXECUTOR
+
+    with __LOCK:
+        if __EXECUTOR is not None:
+            __EXECUTOR.shutdown(wait=wait)
+            __EXECUTOR = None
+
+
+def _resample_job(input_file: str, output_file: str, **kwargs) -> tuple[BoundingBox, List[dict], int, float]:
+    # get the number of source pixels to calculate the throughput
+    with rasterio.open(input_file) as src:
+        pixels = src.width * src.height
+        bands = [interp for interp in src.colorinterp if interp != ColorInterp.alpha]
+        statistics = BandStatistics(len(bands), src.dtypes[0], src.nodata)
+
+    t1 = time.time()
+    bbox = resample(input_file, output_file, statistics=statistics, **kwargs)
+    t2 = time.time()
+
+    return bbox, statistics.result(tuple(config.scale_percentiles)), pixels, t2 - t1
+
+
+def resample_in_pool(input_file: str, output_file: str, **kwargs) -> tuple[BoundingBox, List[dict]]:
+    """
+    Run resample in one of the worker processes and wait for the result.
+    The keyword arguments are passed on to resample, the number of threads 
+    is set from the config.
+
+    Returns the bounding box and the band statistics of the output
+    """
+    threads = worker_threads()
+    future = get_executor().submit(_resample_job, input_file, output_file, num_threads=threads, **kwargs)
+    bbox, band_stats, pixels, elapsed = future.result()
+
+    # report the throughput per core
+    throughput = pixels / 1e6 / max(elapsed, 1e-6) / threads
+    resample_throughput.observe(throughput)
+    megapixels_per_second.observe(pixels / 1e6 / max(elapsed, 1e-6))
+    logger.debug(f"Resampled {pixels / 1e6:.1f} MP in {elapsed:.1f} seconds ({throughput:.2f} MP/s per core on {threads} threads).")
+
+    return bbox, band_stats
@@ -2,10 +2,29 @@
 Resample a given GeoTiff to a specific spatial resolution.
 """
 from typing import Union, Literal, Optional
+from xml.sax.saxutils import escape
+
+import numpy as np
 import rasterio
+import rasterio.shutil
+import rasterio.warp
 import pyproj
+from affine import Affine
+from rasterio import dtypes
 from rasterio.coords import BoundingBox
-from rasterio.enums import Resampling, Compression
+from rasterio.io import MemoryFile
+from rasterio.enums import Resampling, Compression, ColorInterp
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from .statistics import BandStatistics
+
+
+# size of the overview used for the statistics of COG outputs
+STATISTICS_SIZE = 2048
+
+# memory used by a resampling worker besides the pixel buffers in MB, ie. GDAL and numpy
+BASE_MEMORY = 256
 
 
 def auto_scale_factor(raster: rasterio.DatasetReader, target_resolution: float = 0.04, referece_epsg: int = 3857) -> float:
@@ -26,6 +45,226 @@ def auto_scale_factor(raster: rasterio.DatasetReader, target_resolution: float =
     return min(xres, yres) / target_resolution
 
 
+def resolve_scale_factor(raster: rasterio.DatasetReader, scale_factor: Union[float, Literal['auto']]) -> float:
+    # check the scale factor
+    if isinstance(scale_factor, str):
+        if scale_factor.lower() == 'auto':
+            scale_factor = auto_scale_factor(raster)
+
+            # TODO: not sure how we want to handle this case:
+            if scale_factor > 1:
+                scale_factor = 1.0
+        else:
+            raise ValueError("Invalid value for scale_factor. Must be a float or 'auto'")
+    
+    return scale_factor
+
+
+def compression_options(compress: Optional[Compression] = None, jpeg_quality: Optional[int] = None, driver: str = "GTiff") -> dict:
+    # check if a compression is specified
+    options = dict()
+    if compress is not None:
+        options["compress"] = compress.upper()
+        if compress.lower() == 'jpeg':
+            # the COG driver calls the JPEG_QUALITY option just QUALITY
+            quality_key = "quality" if driver.upper() == "COG" else "jpeg_quality"
+            options[quality_key] = jpeg_quality if jpeg_quality is not None else 90
+    
+    return options
+
+
+def target_grid(src: rasterio.DatasetReader, scale_factor: float, dst_crs: str = "EPSG:4326") -> tuple[Affine, int, int]:
+    """
+    Calculate the transform, width and height of the output raster in dst_crs
+    at the resolution given by the scale_factor.
+    """
+    return rasterio.warp.calculate_default_transform(
+        src.crs,
+        dst_crs,
+        max(1, int(src.width * scale_factor)),
+        max(1, int(src.height * scale_factor)),
+        *src.bounds
+    )
+
+
+def data_bands(vrt: WarpedVRT) -> list[int]:
+    # all bands of the warped source, except for the alpha band
+    return [i for i, interp in enumerate(vrt.colorinterp, start=1) if interp != ColorInterp.alpha]
+
+
+def read_masked(vrt: WarpedVRT, window: Optional[Window] = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Read the data bands and the mask of valid pixels from the warped source.
+    The mask is derived from the alpha band, which the warper fills from the source
+    nodata value, mask or alpha band and sets to 0 outside of the source footprint.
+    """
+    alpha = vrt.colorinterp.index(ColorInterp.alpha) + 1
+    data = vrt.read(data_bands(vrt), window=window)
+    mask = vrt.read(alpha, window=window) > 0
+
+    return data, mask
+
+
+def warped_profile(
+    vrt: WarpedVRT,
+    driver: str = "GTiff",
+    compress: Optional[Compression] = None,
+    jpeg_quality: Optional[int] = None
+) -> dict:
+    # build the write options from the warped source, the alpha band is written as mask
+    write_options = dict(
+        driver=driver,
+        height=vrt.height,
+        width=vrt.width,
+        count=len(data_bands(vrt)),
+        dtype=vrt.dtypes[0],
+        crs=vrt.crs,
+        transform=vrt.transform,
+        nodata=vrt.nodata,
+    )
+
+    # check if a compression is specified
+    write_options.update(compression_options(compress, jpeg_quality))
+
+    return write_options
+
+
+def resample_windowed(
+    vrt: WarpedVRT,
+    output_file: str,
+    driver: str = "GTiff",
+    compress: Optional[Compression] = None,
+    jpeg_quality: Optional[int] = None,
+    max_memory: int = 512,
+    statistics: Optional[BandStatistics] = None
+) -> BoundingBox:
+    """
+    Write the warped source strip by strip. Only the source window needed for each 
+    strip is read and warped, the strip height is chosen to keep the buffers below 
+    max_memory MB. The strips are added to the statistics, if given.
+
+    Returns the bounding box of the resampled and reprojected image
+
+    """
+    # budget the strip buffer with a quarter of the memory, the rest is left for the warper
+    row_bytes = vrt.width * (vrt.count + 1) * np.dtype(vrt.dtypes[0]).itemsize
+    strip_rows = int(max(1, min(vrt.height, (max_memory * 2**20) // (4 * row_bytes))))
+
+    with rasterio.open(output_file, "w", **warped_profile(vrt, driver, compress, jpeg_quality)) as dst:
+        for row_off in range(0, vrt.height, strip_rows):
+            window = Window(0, row_off, vrt.width, min(strip_rows, vrt.height - row_off))
+            strip, mask = read_masked(vrt, window=window)
+            dst.write(strip, window=window)
+            dst.write_mask(mask, window=window)
+            if statistics is not None:
+                statistics.update(strip, mask)
+
+    # return a read-only reference to the file
+    with rasterio.open(output_file, 'r') as dst:
+        return dst.bounds
+
+
+def masked_vrt(vrt: WarpedVRT, warped_path: str) -> str:
+    """
+    The VRT description of the data bands of the warped source at warped_path, with
+    its alpha band as per-dataset mask. Copies of it get an internal mask instead
+    of an extra alpha band.
+    """
+    alpha = vrt.colorinterp.index(ColorInterp.alpha) + 1
+
+    def source(band: int) -> str:
+        return f'<SimpleSource><SourceFilename relativeToVRT="0">{warped_path}</SourceFilename><SourceBand>{band}</SourceBand></SimpleSource>'
+
+    bands = [
+        f'<VRTRasterBand dataType="{dtypes.typename_fwd[dtypes.dtype_rev[vrt.dtypes[i - 1]]]}" band="{n}">'
+        f'<ColorInterp>{vrt.colorinterp[i - 1].name.capitalize()}</ColorInterp>{source(i)}</VRTRasterBand>'
+        for n, i in enumerate(data_bands(vrt), start=1)
+    ]
+    return (
+        f'<VRTDataset rasterXSize="{vrt.width}" rasterYSize="{vrt.height}">'
+        f'<SRS>{escape(vrt.crs.to_wkt())}</SRS>'
+        f'<GeoTransform>{", ".join(str(v) for v in vrt.transform.to_gdal())}</GeoTransform>'
+        + "".join(bands)
+        + f'<MaskBand><VRTRasterBand dataType="Byte">{source(alpha)}</VRTRasterBand></MaskBand>'
+        '</VRTDataset>'
+    )
+
+
+def resample_cog(
+    vrt: WarpedVRT,
+    output_file: str,
+    compress: Optional[Compression] = None,
+    jpeg_quality: Optional[int] = None,
+    overview_resampling: Resampling = Resampling.average,
+    blocksize: int = 512,
+    statistics: Optional[BandStatistics] = None
+) -> BoundingBox:
+    """
+    Write the warped source as Cloud-Optimized GeoTIFF. GDAL's COG driver reads the
+    source block by block, writes it with internal tiling and builds the overview 
+    pyramid in the same run, so MapServer can serve zoomed-out requests from the
+    overviews instead of reading the full resolution.
+    The pixels never pass through Python here, so the statistics are taken from
+    the smallest overview with at least STATISTICS_SIZE pixels on the longer side.
+    The alpha band of the warped source is passed as mask, so the COG driver stores
+    it as internal mask for any compression, like the other engines.
+
+    Returns the bounding box of the resampled and reprojected image
+
+    """
+    options = dict(
+        blocksize=blocksize,
+        overviews="AUTO",
+        overview_resampling=overview_resampling.name.upper(),
+        **compression_options(compress, jpeg_quality, driver="COG")
+    )
+
+    # the COG driver can only create copies of existing datasets. The warped source
+    # is described as VRT, so its alpha band can be referenced as mask
+    with MemoryFile(ext=".vrt") as warped:
+        rasterio.shutil.copy(vrt, warped.name, driver="VRT")
+        with MemoryFile(masked_vrt(vrt, warped.name).encode(), ext=".vrt") as memfile, memfile.open() as masked:
+            rasterio.shutil.copy(masked, output_file, driver="COG", **options)
+
+    # return a read-only reference to the file
+    with rasterio.open(output_file, 'r') as dst:
+        if statistics is not None:
+            # reading at a reduced size is served from the overviews
+            factor = max(1, max(dst.width, dst.height) // STATISTICS_SIZE)
+            out_shape = (max(1, dst.height // factor), max(1, dst.width // factor))
+            statistics.update(dst.read(out_shape=(dst.count, *out_shape)), dst.dataset_mask(out_shape=out_shape) > 0)
+        return dst.bounds
+
+
+def estimate_memory(
+    input_file: str,
+    scale_factor: Union[float, Literal['auto']] = 1 / 10,
+    driver: str = "GTiff",
+    max_memory: Optional[int] = None
+) -> int:
+    """
+    Estimate the peak memory of resample in MB from the header of the input_file.
+    """
+    with rasterio.open(input_file) as src:
+        scale_factor = resolve_scale_factor(src, scale_factor)
+        _, width, height = target_grid(src, scale_factor, dst_crs="EPSG:4326")
+        count = src.count
+        itemsize = max(np.dtype(dt).itemsize for dt in src.dtypes)
+
+    # the COG driver streams, only the overview for the statistics is held in memory
+    if driver.upper() == "COG":
+        pixels = min(width * height, STATISTICS_SIZE ** 2)
+    # the windowed engine stays within max_memory
+    elif max_memory is not None:
+        return BASE_MEMORY + max_memory
+    else:
+        pixels = width * height
+
+    # the warped pixels, the mask and the buffer GDAL writes from, plus float64
+    # copies of the valid pixels for the statistics
+    return BASE_MEMORY + int(pixels * (count * (2 * itemsize + 18) + 1) / 2**20)
+
+
 def resample(
     input_file: str,
     output_file: str,
@@ -33,76 +272,74 @@ def resample(
     method: Resampling = Resampling.bilinear,
     driver: str = "GTiff",
     compress: Optional[Compression] = None,
-    jpeg_quality: Optional[int] = None
+    jpeg_quality: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    overview_resampling: Resampling = Resampling.average,
+    blocksize: int = 512,
+    num_threads: Union[int, Literal['ALL_CPUS']] = 1,
+    statistics: Optional[BandStatistics] = None
 ) -> BoundingBox:
     """
     Resample the input_file to the given scale_factor and save the output to output_file.
+    The resampling and the reprojection to EPSG:4326 are done in a single warp, directly
+    from the source grid to the target grid. If max_memory (in MB) is given, the raster 
+    is streamed window by window and never held in memory as a whole.
+    For driver='COG' a tiled Cloud-Optimized GeoTIFF of blocksize tiles is written and 
+    its overviews are built using overview_resampling.
+    The warp and the compression use num_threads threads.
+    If a BandStatistics object is passed, the output pixels are added to it.
+    The valid pixels are stored in an internal mask, created from the source nodata
+    value, mask or alpha band and the footprint of the source.
 
     Returns the bounding box of the resampled and reprojected image
 
     """
     with rasterio.open(input_file) as src:
         # check the scale factor
-        if isinstance(scale_factor, str):
-            if scale_factor.lower() == 'auto':
-                scale_factor = auto_scale_factor(src)
-
-                # TODO: not sure how we want to handle this case:
-                if scale_factor > 1:
-                    scale_factor = 1.0
-            else:
-                raise ValueError("Invalid value for scale_factor. Must be a float or 'auto'")
-
-        # resample data to target shape while reading
-        data = src.read(
-            out_shape=(
-                src.count,
-                int(src.height * scale_factor),
-                int(src.width * scale_factor),
-            ),
-            resampling=method,
-        )
-
-        # check if the source is already EPSG:4326
-        if src.crs.to_epsg() != 4326:
-            # reproject the data to EPSG:4326
-            data, transform = rasterio.warp.reproject(
-                data,
-                src_crs=src.crs,
-                src_transform=src.transform,
-                dst_crs="EPSG:4326",
-                dst_transform=src.transform
-                * src.transform.scale(
-                    (src.width / data.shape[-1]), (src.height / data.shape[-2])
-                ),
-                resampling=method,
-            )
-        else:
-            # scale the affine transform
-            transform = src.transform * src.transform.scale(
-                (src.width / data.shape[-1]), (src.height / data.shape[-2])
-            )
-
-        # save to output file
-        write_options = dict(
-            driver=driver,
-            height=data.shape[1],
-            width=data.shape[2],
-            count=src.count,
-            dtype=data.dtype,
-            crs=src.crs,
+        scale_factor = resolve_scale_factor(src, scale_factor)
+
+        # calculate the target grid in EPSG:4326
+        transform, width, height = target_grid(src, scale_factor, dst_crs="EPSG:4326")
+
+        # let GDAL warp and compress with multiple threads, and store masks within the file
+        env_options = dict(GDAL_NUM_THREADS=str(num_threads), GDAL_TIFF_INTERNAL_MASK=True)
+        vrt_options = dict(NUM_THREADS=str(num_threads))
+
+        # let the warper create an alpha band, if the source does not have one already
+        vrt_options["add_alpha"] = ColorInterp.alpha not in src.colorinterp
+
+        # limit the GDAL block cache and warper memory, if requested
+        if max_memory is not None:
+            env_options["GDAL_CACHEMAX"] = max(16, max_memory // 4)
+            vrt_options["warp_mem_limit"] = max(16, max_memory // 2)
+
+        # warp the source on the fly into the target grid
+        with rasterio.Env(**env_options), WarpedVRT(
+            src,
+            crs="EPSG:4326",
             transform=transform,
-        )
+            width=width,
+            height=height,
+            resampling=method,
+            **vrt_options
+        ) as vrt:
+            # the COG driver streams the source by itself
+            if driver.upper() == "COG":
+                return resample_cog(vrt, output_file, compress, jpeg_quality, overview_resampling, blocksize, statistics)
 
-        # check if a compression is specified
-        if compress is not None:
-            write_options["compress"] = compress.upper()
-            if compress.lower() == 'jpeg':
-                write_options["jpeg_quality"] = jpeg_quality if jpeg_quality is not None else 90
-        
-        # write the file
-        with rasterio.open(output_file, "w", **write_options) as dst:
-            dst.write(data)
+            # use the bounded-memory engine if requested
+            if max_memory is not None:
+                return resample_windowed(vrt, output_file, driver, compress, jpeg_quality, max_memory, statistics)
+
+            # warp the whole raster at once
+            data, mask = read_masked(vrt)
+            if statistics is not None:
+                statistics.update(data, mask)
+
+            # write the file
+            with rasterio.open(output_file, "w", **warped_profile(vrt, driver, compress, jpeg_quality)) as dst:
+                dst.write(data)
+                dst.write_mask(mask)
         
         # return a read-only reference to the file
         with rasterio.open(output_file, 'r') as dst:
@@ -0,0 +1,205 @@
+"""
+Pools of persistent SSH connections to the storage and the mapserver.
+
+Opening a fabric Connection costs a TCP handshake, the key exchange and the
+password authentication. The pools keep a few authenticated connections per server
+open and hand them out to one thread at a time. Fabric caches the SFTP session
+on the connection, so the SFTP channel is reused as well. Connections that stay
+unused for longer than idle_timeout are closed in the background.
+
+"""
+from typing import Callable, Dict, Generator, List, Literal, Optional, Tuple
+from contextlib import contextmanager
+import threading
+import time
+
+from fabric import Connection
+from paramiko import SSHException
+
+from .utils.settings import settings
+from .config import config
+
+
+# errors that mean the connection itself is broken
+CONNECTION_ERRORS = (SSHException, EOFError)
+
+# errors that might mean the connection is broken. They include the errors of
+# remote file operations, ie. FileNotFoundError, so the connection is checked
+MAYBE_CONNECTION_ERRORS = (OSError,)
+
+
+class ConnectionPool:
+    def __init__(self, factory: Callable[[], Connection], max_size: int = 4, idle_timeout: float = 300.0, acquire_timeout: Optional[float] = 60.0):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+
+        # idle connections with the time they were returned, the most recent last
+        self._idle: List[Tuple[Connection, float]] = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._reaper: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    @staticmethod
+    def is_healthy(connection: Connection) -> bool:
+        """
+        Check that the transport of the connection is still alive.
+        """
+        transport = connection.client.get_transport() if connection.is_connected else None
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except CONNECTION_ERRORS + MAYBE_CONNECTION_ERRORS:
+            return False
+
+    def discard(self, connection: Connection):
+        # close the connection and free its slot
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def evict_idle(self):
+        """
+        Close all connections that were idle for longer than idle_timeout.
+        """
+        now = time.monotonic()
+        with self._cond:
+            expired = [c for c, t in self._idle if now - t > self.idle_timeout]
+            self._idle = [(c, t) for c, t in self._idle if now - t <= self.idle_timeout]
+        for c in expired:
+            self.discard(c)
+
+    def _reap(self):
+        # close idle connections, even if no one asks for a connection
+        while not self._closed.wait(timeout=max(1.0, self.idle_timeout / 2)):
+            self.evict_idle()
+
+    def _start_reaper(self):
+        with self._cond:
+            if self._reaper is None or not self._reaper.is_alive():
+                self._closed.clear()
+                self._reaper = threading.Thread(target=self._reap, name="ssh-pool-reaper", daemon=True)
+                self._reaper.start()
+
+    def acquire(self, timeout: Optional[float] = None) -> Connection:
+        """
+        Take a healthy connection from the pool, open a new one if there is room,
+        or wait until another thread returns one. Waits at most timeout seconds,
+        by default the acquire_timeout of the pool.
+        """
+        self.evict_idle()
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self._cond:
+                if self._idle:
+                    connection, _ = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    connection = None
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if (remaining is not None and remaining <= 0) or not self._cond.wait(timeout=remaining):
+                        raise TimeoutError(f"No SSH connection became available within {timeout} seconds.")
+                    continue
+
+            # open a new connection outside of the lock
+            if connection is None:
+                try:
+                    connection = self.factory()
+                    connection.open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                return connection
+
+            # check the idle connection before handing it out
+            if self.is_healthy(connection):
+                return connection
+            self.discard(connection)
+
+    def release(self, connection: Connection):
+        """
+        Return the connection to the pool.
+        """
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+        self._start_reaper()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Generator[Connection, None, None]:
+        connection = self.acquire(timeout=timeout)
+        try:
+            yield connection
+        except CONNECTION_ERRORS:
+            # do not put broken connections back
+            self.discard(connection)
+            raise
+        except MAYBE_CONNECTION_ERRORS:
+            # a missing remote file does not break the connection
+            if self.is_healthy(connection):
+                self.release(connection)
+            else:
+                self.discard(connection)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self):
+        """
+        Close all idle connections and stop the background eviction.
+        """
+        self._closed.set()
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for c, _ in idle:
+            self.discard(c)
+
+
+__POOLS: Dict[str, ConnectionPool] = {}
+__LOCK = threading.Lock()
+
+
+def connection_factory(server: Literal['storage'] | Literal['mapserver'] = 'storage') -> Callable[[], Connection]:
+    # check which server to connect to
+    if server == 'storage':
+        serv = f"{settings.storage_ssh_user}@{settings.storage_ssh_host}"
+        args = dict(password=settings.storage_ssh_password)
+    elif server == 'mapserver':
+        serv = f"{settings.mapserver_ssh_user}@{settings.mapserver_ssh_host}"
+        args = dict(password=settings.mapserver_ssh_password)
+    else:
+        raise ValueError(f"Unknown server: {server}")
+
+    return lambda: Connection(serv, connect_kwargs=args)
+
+
+def get_pool(server: Literal['storage'] | Literal['mapserver'] = 'storage') -> ConnectionPool:
+    """
+    Return the connection pool of the given server and create it on first use.
+    """
+    with __LOCK:
+        if server not in __POOLS:
+            __POOLS[server] = ConnectionPool(
+                connection_factory(server),
+                max_size=config.ssh_pool_size,
+                idle_timeout=config.ssh_idle_timeout,
+                acquire_timeout=config.ssh_acquire_timeout
+            )
+
+    return __POOLS[server]
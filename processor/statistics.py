@@ -0,0 +1,115 @@
+"""
+Per-band statistics of the processed rasters.
+
+The statistics are accumulated from the pixel blocks the resampling has in memory
+anyway, so they do not need another pass over the file. They are used to set fixed
+SCALE values for the MapServer layers, instead of letting MapServer calculate them
+on each request with SCALE=AUTO.
+
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+# integer bands up to this number of bits are counted exactly in a full histogram
+MAX_HISTOGRAM_BITS = 16
+
+# otherwise, a subsample of at most this many pixels per band is kept for the percentiles
+MAX_SAMPLES = 1_000_000
+
+
+class BandStatistics:
+    def __init__(self, count: int, dtype: str, nodata: Optional[float] = None):
+        self.count = count
+        self.dtype = np.dtype(dtype)
+        self.nodata = nodata
+
+        # exact histograms for small integer types, samples otherwise
+        self.exact = self.dtype.kind in "ui" and self.dtype.itemsize * 8 <= MAX_HISTOGRAM_BITS
+        self.offset = int(np.iinfo(self.dtype).min) if self.exact else 0
+        self.bins = 2 ** (self.dtype.itemsize * 8) if self.exact else 0
+        self.histograms = np.zeros((count, self.bins), dtype=np.int64) if self.exact else None
+        self.samples: List[List[np.ndarray]] = [[] for _ in range(count)]
+        self.sampled = np.zeros(count, dtype=np.int64)
+
+        self.valid = 0
+        self.total = 0
+        self.sum = np.zeros(count, dtype=np.float64)
+        self.sum_sq = np.zeros(count, dtype=np.float64)
+        self.min = np.full(count, np.inf)
+        self.max = np.full(count, -np.inf)
+
+    def valid_mask(self, data: np.ndarray) -> np.ndarray:
+        """
+        Pixels are valid if they are not nodata in all bands. Without a nodata value,
+        pixels that are 0 in all bands are the area outside of the warped footprint.
+        """
+        nodata = self.nodata if self.nodata is not None else 0
+        if np.isnan(nodata):
+            return ~np.all(np.isnan(data), axis=0)
+        return ~np.all(data == nodata, axis=0)
+
+    def update(self, data: np.ndarray, mask: Optional[np.ndarray] = None):
+        """
+        Add a (count, rows, cols) block of pixels. If no mask of valid pixels
+        is given, it is derived from the nodata value.
+        """
+        if mask is None:
+            mask = self.valid_mask(data)
+        self.total += mask.size
+        self.valid += int(mask.sum())
+
+        # only look at the valid pixels from here on
+        values = data[:, mask]
+        if values.shape[1] == 0:
+            return
+
+        as_float = values.astype(np.float64)
+        self.sum += as_float.sum(axis=1)
+        self.sum_sq += (as_float ** 2).sum(axis=1)
+        self.min = np.minimum(self.min, as_float.min(axis=1))
+        self.max = np.maximum(self.max, as_float.max(axis=1))
+
+        for band in range(self.count):
+            if self.exact:
+                self.histograms[band] += np.bincount(values[band].astype(np.int64) - self.offset, minlength=self.bins)
+            elif self.sampled[band] < MAX_SAMPLES:
+                # take an evenly spaced subsample of the block
+                step = max(1, values.shape[1] * self.count // MAX_SAMPLES)
+                sample = values[band, ::step]
+                self.samples[band].append(sample)
+                self.sampled[band] += sample.size
+
+    def percentiles(self, band: int, q: Tuple[float, ...]) -> List[float]:
+        if self.exact:
+            # find the percentiles in the cumulative histogram
+            cumulative = np.cumsum(self.histograms[band])
+            positions = np.searchsorted(cumulative, np.array(q) / 100 * cumulative[-1], side="left")
+            return [float(p + self.offset) for p in positions]
+
+        return [float(p) for p in np.percentile(np.concatenate(self.samples[band]), q)]
+
+    def result(self, percentiles: Tuple[float, float] = (2.0, 98.0)) -> List[dict]:
+        """
+        Return the statistics of all bands. The percentiles are used as clip values.
+        """
+        if self.valid == 0:
+            return []
+
+        stats = []
+        for band in range(self.count):
+            mean = self.sum[band] / self.valid
+            low, high = self.percentiles(band, percentiles)
+            stats.append(dict(
+                band=band + 1,
+                min=float(self.min[band]),
+                max=float(self.max[band]),
+                mean=float(mean),
+                std=float(np.sqrt(max(self.sum_sq[band] / self.valid - mean ** 2, 0))),
+                valid_percent=100 * self.valid / self.total,
+                percentiles=list(percentiles),
+                clip=[low, high],
+            ))
+
+        return stats
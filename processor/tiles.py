@@ -0,0 +1,240 @@
+"""
+Render a static XYZ tile pyramid of a processed raster.
+
+MapServer renders every WMS request on demand. For datasets that are viewed a lot,
+the tiles can be rendered once after processing and served as static files instead.
+The tiles are 256x256 pixels in Web Mercator, scaled to 8 bit with the clip values
+of the band statistics and encoded as WebP or PNG with the mask as alpha channel.
+
+The zoom levels are rendered in parallel by the worker processes of the resampling
+pool, so no processes are started per file. The deepest levels hold most of the
+tiles, so they are split into several jobs of tile rows. Each level is read from
+the overview of the raster closest to its resolution.
+
+"""
+from typing import List, Literal, Optional, Tuple
+from concurrent.futures import Executor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import warnings
+import logging
+import math
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling, ColorInterp
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+from .utils.metadata_models import FileUploadMetadata
+from .config import config
+from .files import fetch_processed_raster, put_tiles
+from .pool import get_executor
+
+
+TILE_SIZE = 256
+
+# half the circumference of the earth in Web Mercator
+ORIGIN = 20037508.342789244
+
+# tiles per job, the deeper zoom levels are split into jobs of about this size
+TILES_PER_JOB = 256
+
+DRIVERS = {"webp": ("WEBP", dict(QUALITY=85)), "png": ("PNG", dict(ZLEVEL=6))}
+
+logger = logging.getLogger("processor")
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    size = 2 * ORIGIN / 2**z
+    return -ORIGIN + x * size, ORIGIN - (y + 1) * size, -ORIGIN + (x + 1) * size, ORIGIN - y * size
+
+
+def tile_range(bounds: Tuple[float, float, float, float], z: int) -> Tuple[int, int, int, int]:
+    """
+    The first and last column and row of the tiles covering the Web Mercator bounds at zoom z.
+    """
+    size = 2 * ORIGIN / 2**z
+    last = 2**z - 1
+    left, bottom, right, top = bounds
+    # bounds on the edge of a tile do not reach into the next one
+    return (
+        max(0, int((left + ORIGIN) // size)),
+        max(0, int((ORIGIN - top) // size)),
+        min(last, math.ceil((right + ORIGIN) / size) - 1),
+        min(last, math.ceil((ORIGIN - bottom) / size) - 1),
+    )
+
+
+def zoom_range(path: str) -> Tuple[int, int, Tuple[float, float, float, float]]:
+    """
+    The zoom levels from one tile covering the whole raster down to the native
+    resolution of the raster, and its Web Mercator bounds.
+    """
+    with rasterio.open(path) as src:
+        bounds = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+        width = src.width
+
+    extent = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+    resolution = (bounds[2] - bounds[0]) / width
+    # the tolerance keeps rasters at exactly the resolution of a zoom level at that level
+    max_zoom = max(0, math.ceil(math.log2(2 * ORIGIN / (TILE_SIZE * resolution)) - 1e-9))
+    min_zoom = min(max_zoom, max(0, math.floor(math.log2(2 * ORIGIN / extent))))
+
+    return min_zoom, max_zoom, bounds
+
+
+def overview_level(path: str, z: int) -> Optional[int]:
+    """
+    The index of the coarsest overview of the raster that is still at least as fine
+    as the tiles of zoom z, or None if the full resolution has to be read.
+    """
+    with rasterio.open(path) as src:
+        bounds = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+        resolution = (bounds[2] - bounds[0]) / src.width
+        factors = src.overviews(1)
+
+    tile_resolution = 2 * ORIGIN / 2**z / TILE_SIZE
+    levels = [i for i, factor in enumerate(factors) if factor * resolution <= tile_resolution * (1 + 1e-9)]
+    return levels[-1] if len(levels) > 0 else None
+
+
+def to_rgba(data: np.ndarray, mask: np.ndarray, clip: List[Tuple[float, float]]) -> np.ndarray:
+    # gray rasters are repeated into all three channels
+    if data.shape[0] < 3:
+        data = np.repeat(data[:1], 3, axis=0)
+        clip = clip[:1] * 3
+
+    rgb = np.empty((3, *data.shape[1:]), dtype=np.uint8)
+    for band, (low, high) in enumerate(clip[:3]):
+        scaled = (data[band].astype(np.float32) - low) / max(high - low, 1e-9) * 255
+        rgb[band] = np.clip(scaled, 0, 255).astype(np.uint8)
+
+    return np.concatenate([rgb, mask[np.newaxis].astype(np.uint8)])
+
+
+def render_tiles(
+    path: str,
+    out_dir: str,
+    z: int,
+    rows: Tuple[int, int],
+    cols: Tuple[int, int],
+    clip: List[Tuple[float, float]],
+    fmt: str = "webp",
+    level: Optional[int] = None
+) -> int:
+    """
+    Render the tiles of zoom level z in the given range of rows and columns from
+    the overview level of the raster, or its full resolution if level is None.
+
+    Returns the number of tiles written, empty tiles are skipped
+    """
+    driver, options = DRIVERS[fmt]
+    written = 0
+
+    # the warper does not pick the overviews by itself
+    with rasterio.open(path, **(dict(overview_level=level) if level is not None else {})) as src:
+        bands = [i for i, interp in enumerate(src.colorinterp, start=1) if interp != ColorInterp.alpha][:3]
+        for y in range(rows[0], rows[1] + 1):
+            for x in range(cols[0], cols[1] + 1):
+                # the alpha band carries the mask of the raster and its footprint
+                with WarpedVRT(
+                    src,
+                    crs="EPSG:3857",
+                    transform=from_bounds(*tile_bounds(z, x, y), TILE_SIZE, TILE_SIZE),
+                    width=TILE_SIZE,
+                    height=TILE_SIZE,
+                    resampling=Resampling.bilinear,
+                    add_alpha=ColorInterp.alpha not in src.colorinterp
+                ) as vrt:
+                    mask = vrt.dataset_mask()
+                    if not mask.any():
+                        continue
+                    rgba = to_rgba(vrt.read(bands), mask, clip)
+
+                tile_path = Path(out_dir) / str(z) / str(x) / f"{y}.{fmt}"
+                tile_path.parent.mkdir(parents=True, exist_ok=True)
+                with warnings.catch_warnings():
+                    # the tiles do not carry a georeference
+                    warnings.simplefilter("ignore", NotGeoreferencedWarning)
+                    with MemoryFile(ext=fmt) as memfile:
+                        with memfile.open(driver=driver, width=TILE_SIZE, height=TILE_SIZE, count=4, dtype="uint8", **options) as dst:
+                            dst.write(rgba)
+                        tile_path.write_bytes(memfile.read())
+                written += 1
+
+    return written
+
+
+def clip_values(path: str, band_stats: Optional[List[dict]] = None) -> List[Tuple[float, float]]:
+    # use the clip values of the statistics, or the full range of the data type
+    if band_stats:
+        return [tuple(s["clip"]) for s in band_stats]
+
+    with rasterio.open(path) as src:
+        dtype = np.dtype(src.dtypes[0])
+        count = src.count
+    low, high = (np.iinfo(dtype).min, np.iinfo(dtype).max) if dtype.kind in "ui" else (0.0, 1.0)
+    return [(float(low), float(high))] * count
+
+
+def render_pyramid(
+    path: str,
+    out_dir: str,
+    band_stats: Optional[List[dict]] = None,
+    fmt: Literal["webp", "png"] = "webp",
+    min_zoom: Optional[int] = None,
+    max_zoom: Optional[int] = None,
+    executor: Optional[Executor] = None
+) -> Tuple[int, int, int]:
+    """
+    Render the XYZ tiles of the raster at path into out_dir/{z}/{x}/{y}.{fmt}.
+    The zoom levels default to the range from a single tile to the native resolution.
+    The jobs run on executor, by default the shared resampling pool.
+
+    Returns the minimum and maximum zoom level and the number of tiles
+    """
+    native_min, native_max, bounds = zoom_range(path)
+    min_zoom = native_min if min_zoom is None else min_zoom
+    max_zoom = native_max if max_zoom is None else max_zoom
+    clip = clip_values(path, band_stats)
+
+    # split each zoom level into jobs of about TILES_PER_JOB tiles
+    jobs = []
+    for z in range(min_zoom, max_zoom + 1):
+        level = overview_level(path, z)
+        col_start, row_start, col_end, row_end = tile_range(bounds, z)
+        rows_per_job = max(1, TILES_PER_JOB // (col_end - col_start + 1))
+        for row in range(row_start, row_end + 1, rows_per_job):
+            jobs.append((z, (row, min(row + rows_per_job - 1, row_end)), (col_start, col_end), level))
+
+    executor = executor or get_executor()
+    futures = [executor.submit(render_tiles, path, out_dir, z, rows, cols, clip, fmt, level) for z, rows, cols, level in jobs]
+    count = sum(future.result() for future in futures)
+
+    return min_zoom, max_zoom, count
+
+
+def create_tile_source(metadata: FileUploadMetadata, band_stats: Optional[List[dict]] = None) -> str:
+    """
+    Render the tiles of the processed raster into the tiles_path of the MapServer.
+
+    Returns the URL template of the tiles
+    """
+    with fetch_processed_raster(metadata) as processed_path, TemporaryDirectory() as tmp:
+        out_dir = str(Path(tmp) / metadata.file_id)
+        min_zoom, max_zoom, count = render_pyramid(
+            processed_path,
+            out_dir,
+            band_stats=band_stats,
+            fmt=config.tiles_format,
+            min_zoom=config.tiles_min_zoom,
+            max_zoom=config.tiles_max_zoom
+        )
+        put_tiles(out_dir, metadata.file_id)
+
+    logger.info(f"Rendered {count} tiles of {metadata.file_id} for zoom levels {min_zoom} to {max_zoom}.")
+    return f"{config.tiles_base_url.rstrip('/')}/{metadata.file_id}/{{z}}/{{x}}/{{y}}.{config.tiles_format}"
@@ -0,0 +1,159 @@
+"""
+Upload a file over SFTP while it is still being written.
+
+The encoder writes the processed raster into a local file. A background thread
+follows the growing file and uploads every chunk that is complete into a temporary
+file on the server. Encoders may go back and rewrite parts of the file, ie. the
+GeoTIFF header, so each uploaded chunk is hashed. After the encoder finished, only
+the changed chunks and the remaining tail are sent, and the temporary file is
+renamed to its final name on the server. A connection is only taken from the
+pool once the first chunk is sent, so waiting for the encoder does not block
+the connections of other uploads.
+
+"""
+from typing import Dict, Literal, Optional
+from pathlib import Path
+import threading
+import hashlib
+import logging
+import os
+
+from .ssh import get_pool
+from .metrics import network_bytes
+
+
+logger = logging.getLogger("processor")
+
+
+class StreamingUpload:
+    def __init__(
+        self,
+        local_path: str,
+        remote_path: str,
+        server: Literal['storage'] | Literal['mapserver'] = 'mapserver',
+        chunk_size: int = 8 * 2**20,
+        poll_interval: float = 0.5
+    ):
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.remote_tmp_path = str(Path(remote_path).with_name(f".{Path(remote_path).name}.upload"))
+        self.server = server
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+
+        # hashes of the chunks already on the server and the bytes sent in total
+        self._uploaded: Dict[int, bytes] = {}
+        self.sent = 0
+        self._finished = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[Exception] = None
+        self._pool = get_pool(server)
+        self._connection = None
+        self._remote = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._follow, name=f"upload-{Path(self.remote_path).name}", daemon=True)
+        self._thread.start()
+
+    def _open(self):
+        # the follower thread and finish never run at the same time
+        if self._connection is not None:
+            return
+        self._connection = self._pool.acquire()
+        try:
+            self._remote = self._connection.sftp().open(self.remote_tmp_path, "wb")
+            self._remote.set_pipelined(True)
+        except Exception:
+            # ie. the remote directory is missing, which does not break the connection
+            if self._pool.is_healthy(self._connection):
+                self._pool.release(self._connection)
+            else:
+                self._pool.discard(self._connection)
+            self._connection = None
+            raise
+
+    def _send_chunk(self, index: int, data: bytes) -> int:
+        # upload the chunk, if the server does not have this version of it yet
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if self._uploaded.get(index) == digest:
+            return 0
+
+        self._open()
+
+        self._remote.seek(index * self.chunk_size)
+        self._remote.write(data)
+        self._uploaded[index] = digest
+        self.sent += len(data)
+        return len(data)
+
+    def _follow(self):
+        try:
+            while not self._finished.is_set():
+                # upload all complete chunks, but keep the last one as it might still change.
+                # The file is opened again each time, as the encoder might have replaced it
+                complete = os.path.getsize(self.local_path) // self.chunk_size - 1
+                if any(index not in self._uploaded for index in range(complete)):
+                    with open(self.local_path, "rb") as f:
+                        for index in range(complete):
+                            if index not in self._uploaded:
+                                f.seek(index * self.chunk_size)
+                                self._send_chunk(index, f.read(self.chunk_size))
+                self._finished.wait(timeout=self.poll_interval)
+        except Exception as e:
+            self._error = e
+
+    def finish(self) -> str:
+        """
+        Send the changed chunks and the tail of the finished local file and move
+        the upload to the final remote path.
+
+        Returns the remote path
+        """
+        self._finished.set()
+        self._thread.join()
+        try:
+            if self._error is not None:
+                raise self._error
+
+            # upload what changed since the chunks were sent
+            self._open()
+            size = os.path.getsize(self.local_path)
+            resent = 0
+            with open(self.local_path, "rb") as f:
+                for index in range((size + self.chunk_size - 1) // self.chunk_size):
+                    f.seek(index * self.chunk_size)
+                    resent += self._send_chunk(index, f.read(self.chunk_size))
+            self._remote.truncate(size)
+            self._remote.close()
+            logger.debug(f"Uploaded {size / 2**20:.1f} MB to {self.remote_path}, {resent / 2**20:.1f} MB after encoding finished.")
+
+            # replace the target in a single step
+            self._connection.sftp().posix_rename(self.remote_tmp_path, self.remote_path)
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            network_bytes.labels(direction="upload").inc(self.sent)
+
+        self._pool.release(self._connection)
+        self._connection = None
+        return self.remote_path
+
+    def abort(self):
+        """
+        Stop the upload and remove the temporary file on the server.
+        """
+        self._finished.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._connection is None:
+            return
+
+        try:
+            self._remote.close()
+            self._connection.sftp().remove(self.remote_tmp_path)
+            self._pool.release(self._connection)
+        except Exception:
+            # the connection might be broken, so don't put it back
+            self._pool.discard(self._connection)
+        self._connection = None
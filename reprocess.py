@@ -0,0 +1,14 @@
+"""
+Encode processed files again from the archive with the current settings, ie.:
+
+    python reprocess.py --limit=100
+    python reprocess.py --filters='{"user_id": "..."}' --start_after=<last uuid>
+
+"""
+import fire
+
+from processor.handler import reprocess_files
+
+
+if __name__ == "__main__":
+    fire.Fire(reprocess_files)
@@ -0,0 +1,27 @@
+import pytest
+
+from benchmarks import fakes
+from processor.utils.settings import settings
+from processor.leases import LeaseManager
+from processor import metadata
+
+
+@pytest.fixture
+def backend(tmp_path) -> fakes.FakeBackend:
+    """
+    An in-memory stand-in for the Supabase backend, with local directories
+    for the files.
+    """
+    return fakes.install(str(tmp_path))
+
+
+@pytest.fixture
+def leases(backend, monkeypatch) -> LeaseManager:
+    manager = LeaseManager(owner="test", ttl=60.0, heartbeat_interval=60.0)
+    monkeypatch.setattr(metadata, "get_leases", lambda: manager)
+    yield manager
+    manager.stop()
+
+
+def metadata_rows(backend: fakes.FakeBackend) -> dict:
+    return {row["uuid"]: row for row in backend.tables.get(settings.metadata_table, [])}
@@ -0,0 +1,80 @@
+import threading
+import time
+
+from processor import admission
+from processor.admission import MemoryAdmission, cgroup_memory_limit
+
+
+def acquire_in_thread(control: MemoryAdmission, cost: int):
+    """
+    Request cost MB in a thread. Returns the event set once it is admitted and
+    the list the ticket is put into.
+    """
+    admitted = threading.Event()
+    tickets = []
+
+    def run():
+        tickets.append(control.acquire(cost))
+        admitted.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    return admitted, tickets
+
+
+def test_small_jobs_overtake_a_waiting_large_job():
+    control = MemoryAdmission(budget=100, starvation_timeout=60.0)
+    running = control.acquire(60)
+
+    large, large_ticket = acquire_in_thread(control, 80)
+    assert not large.wait(0.2)
+
+    # the small job fits next to the running one
+    small, small_ticket = acquire_in_thread(control, 30)
+    assert small.wait(2.0)
+    assert control.used == 90
+
+    control.release(running)
+    assert not large.wait(0.2)
+    control.release(small_ticket[0])
+    assert large.wait(2.0)
+    assert control.used == 80
+
+
+def test_starving_jobs_are_not_overtaken():
+    control = MemoryAdmission(budget=100, starvation_timeout=0.2)
+    running = control.acquire(60)
+
+    large, large_ticket = acquire_in_thread(control, 80)
+    time.sleep(0.4)
+
+    # the small job would fit, but the large one waits for too long already
+    small, small_ticket = acquire_in_thread(control, 30)
+    assert not small.wait(0.3)
+
+    control.release(running)
+    assert large.wait(2.0)
+    assert not small.is_set()
+
+    control.release(large_ticket[0])
+    assert small.wait(2.0)
+
+
+def test_jobs_larger_than_the_budget_run_alone():
+    control = MemoryAdmission(budget=100)
+    with control.admit(150):
+        small, _ = acquire_in_thread(control, 10)
+        assert not small.wait(0.2)
+    assert small.wait(2.0)
+
+
+def test_cgroup_memory_limit(tmp_path, monkeypatch):
+    v2, v1 = tmp_path / "memory.max", tmp_path / "memory.limit_in_bytes"
+    monkeypatch.setattr(admission, "CGROUP_LIMITS", [str(v2), str(v1)])
+    assert cgroup_memory_limit() is None
+
+    v1.write_text(f"{4 * 2**30}\n")
+    assert cgroup_memory_limit() == 4096
+
+    # cgroup v2 takes precedence and has no limit
+    v2.write_text("max\n")
+    assert cgroup_memory_limit() is None
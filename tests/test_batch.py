@@ -0,0 +1,40 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from processor.utils.settings import settings
+from processor.batch import find_rasters, process_batch
+
+from .conftest import metadata_rows
+
+
+def write_raster(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = np.random.default_rng(0).integers(1, 255, (3, 64, 64), dtype=np.uint8)
+    profile = dict(driver="GTiff", width=64, height=64, count=3, dtype="uint8", crs="EPSG:32632", transform=from_origin(500000, 5000000, 1, 1))
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+
+
+def test_find_rasters_leaves_out_the_outputs(tmp_path):
+    write_raster(tmp_path / "a" / "one.tif")
+    write_raster(tmp_path / "out" / "a" / "one.tif")
+
+    assert find_rasters(str(tmp_path / "**" / "*.tif"), exclude=str(tmp_path / "out")) == [tmp_path / "a" / "one.tif"]
+
+
+def test_failed_registrations_are_retried(tmp_path, backend):
+    source, out = tmp_path / "source", tmp_path / "out"
+    write_raster(source / "upload.tif")
+
+    # there is no metadata row to register the raster with yet
+    rows = process_batch(str(source), str(out), scale_factor=0.5, driver="GTiff", workers=1, register=True)
+    assert rows[0]["status"] == "errored"
+    assert not (out / "upload.tif").exists()
+
+    backend.tables[settings.metadata_table] = [dict(uuid="u-1", file_id="upload.tif", raw_path=str(source / "upload.tif"), status="pending", user_id="someone")]
+    rows = process_batch(str(source), str(out), scale_factor=0.5, driver="GTiff", workers=1, register=True)
+
+    assert rows[0]["status"] == "processed"
+    assert (out / "upload.tif").exists()
+    assert metadata_rows(backend)["u-1"]["status"] == "processed"
@@ -0,0 +1,56 @@
+import hashlib
+import os
+
+import pytest
+
+from benchmarks import fakes
+from processor.download import download, hash_file
+
+
+CHUNK = 2**20
+
+
+@pytest.fixture
+def raw_file(tmp_path) -> str:
+    fakes.install(str(tmp_path), remote=True)
+    path = tmp_path / "raw" / "upload.tif"
+    path.write_bytes(os.urandom(5 * CHUNK + 12345))
+    return str(path)
+
+
+def test_download_hashes_the_file(raw_file, tmp_path):
+    digest = hashlib.sha256()
+    local_path = download(raw_file, str(tmp_path / "upload.part"), workers=4, chunk_size=CHUNK, digest=digest)
+
+    with open(local_path, "rb") as local, open(raw_file, "rb") as remote:
+        assert local.read() == remote.read()
+    assert digest.hexdigest() == hash_file(raw_file, hashlib.sha256()).hexdigest()
+
+
+def test_short_reads_fail_the_chunk(raw_file, tmp_path, monkeypatch):
+    readv = fakes.FakeRemoteFile.readv
+
+    def short_readv(remote, chunks):
+        # the server ends the last chunk early, the chunks after a failed one would be cancelled
+        for data in readv(remote, chunks):
+            yield data[:100] if chunks[0][0] == 5 * CHUNK else data
+
+    monkeypatch.setattr(fakes.FakeRemoteFile, "readv", short_readv)
+    local_path = tmp_path / "upload.part"
+    with pytest.raises(IOError, match="chunk 5"):
+        download(raw_file, str(local_path), workers=2, chunk_size=CHUNK)
+
+    # the resumed download only fetches the failed chunk
+    fetched = []
+
+    def counting_readv(remote, chunks):
+        fetched.append(chunks[0][0])
+        return readv(remote, chunks)
+
+    monkeypatch.setattr(fakes.FakeRemoteFile, "readv", counting_readv)
+    digest = hashlib.sha256()
+    download(raw_file, str(local_path), workers=2, chunk_size=CHUNK, verify=True, digest=digest)
+
+    assert fetched == [5 * CHUNK]
+    assert local_path.read_bytes() == open(raw_file, "rb").read()
+    assert digest.hexdigest() == hash_file(raw_file, hashlib.sha256()).hexdigest()
@@ -0,0 +1,59 @@
+import time
+
+from processor.jobs import JobQueue, Scheduler
+from processor import handler
+
+from .conftest import metadata_rows
+from .test_metadata import add_files
+
+
+def fake_process_file(calls: list):
+    def process_file(uuid, metadata):
+        calls.append(uuid)
+        return {"status": "processed"}
+    return process_file
+
+
+def run_until_finished(queue: JobQueue, uuids: list, timeout: float = 10.0):
+    scheduler = Scheduler(queue, worker=handler.preprocess_file, max_workers=2, poll_interval=0.05)
+    scheduler.start()
+    deadline = time.time() + timeout
+    while len(queue.list('done')) + len(queue.list('failed')) < len(uuids) and time.time() < deadline:
+        time.sleep(0.05)
+    scheduler.stop()
+
+
+def test_recovered_jobs_are_not_processed_twice(tmp_path, backend, leases, monkeypatch):
+    calls = []
+    monkeypatch.setattr(handler, "process_file", fake_process_file(calls))
+    add_files(backend, 2)
+
+    # the processor stopped after the first job was processed, but before it was finished
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    for uuid in ["pending-0", "pending-1"]:
+        queue.put(uuid)
+    assert queue.claim() == "pending-0"
+    handler.preprocess_file("pending-0")
+
+    run_until_finished(queue, ["pending-0", "pending-1"])
+
+    assert sorted(calls) == ["pending-0", "pending-1"]
+    assert sorted(queue.list('done')) == ["pending-0", "pending-1"]
+    assert all(row["status"] == "processed" for row in metadata_rows(backend).values())
+    assert backend.tables["processor_leases"] == []
+
+
+def test_finished_jobs_are_pruned(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"), retention=0.1)
+    queue.put("a")
+    queue.claim()
+    queue.finish("a")
+    assert queue.list('done') == ["a"]
+
+    time.sleep(0.2)
+    queue.put("b")
+    queue.claim()
+    queue.finish("b", error="failed")
+
+    assert queue.list('done') == []
+    assert queue.list('failed') == ["b"]
@@ -0,0 +1,218 @@
+"""
+Several processor nodes sharing one metadata table, run as local processes
+against a SQLite stand-in for the Supabase backend.
+
+"""
+from typing import Any, List
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+import multiprocessing
+import sqlite3
+import time
+
+import pytest
+
+from benchmarks import fakes
+from processor.utils.settings import settings
+from processor.leases import LeaseManager
+from processor.metadata import claim_pending, update_metadata_batch
+from processor import metadata, auth
+
+
+class SQLiteQuery:
+    """
+    The parts of the postgrest query builder the processor uses, run as SQL on a
+    SQLite file that all processes share.
+    """
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self.table = table
+        self.where: List[str] = []
+        self.params: List[Any] = []
+        self.operation = ("select",)
+        self.order_by = ""
+        self.max_rows = ""
+        self.as_single = False
+
+    def _filter(self, sql: str, *params: Any) -> "SQLiteQuery":
+        self.where.append(sql)
+        self.params.extend(params)
+        return self
+
+    def eq(self, column: str, value: Any) -> "SQLiteQuery":
+        return self._filter(f'"{column}" = ?', value)
+
+    def in_(self, column: str, values: List[Any]) -> "SQLiteQuery":
+        return self._filter(f'"{column}" IN ({", ".join("?" * len(values))})', *values)
+
+    def lt(self, column: str, value: Any) -> "SQLiteQuery":
+        return self._filter(f'"{column}" < ?', value)
+
+    def gt(self, column: str, value: Any) -> "SQLiteQuery":
+        return self._filter(f'"{column}" > ?', value)
+
+    def order(self, column: str) -> "SQLiteQuery":
+        self.order_by = f' ORDER BY "{column}"'
+        return self
+
+    def limit(self, n: int) -> "SQLiteQuery":
+        self.max_rows = f" LIMIT {int(n)}"
+        return self
+
+    def single(self) -> "SQLiteQuery":
+        self.as_single = True
+        return self
+
+    def select(self, *columns: str) -> "SQLiteQuery":
+        self.operation = ("select",)
+        return self
+
+    def update(self, values: dict) -> "SQLiteQuery":
+        self.operation = ("update", values)
+        return self
+
+    def delete(self) -> "SQLiteQuery":
+        self.operation = ("delete",)
+        return self
+
+    def upsert(self, rows: dict | List[dict], on_conflict: str = "uuid", ignore_duplicates: bool = False, **kwargs) -> "SQLiteQuery":
+        self.operation = ("upsert", rows if isinstance(rows, list) else [rows], on_conflict, ignore_duplicates)
+        return self
+
+    def execute(self) -> fakes.FakeResponse:
+        where = f" WHERE {' AND '.join(self.where)}" if self.where else ""
+        kind = self.operation[0]
+
+        with closing(sqlite3.connect(self.path, timeout=30, isolation_level=None)) as db:
+            db.row_factory = sqlite3.Row
+            if kind == "select":
+                rows = db.execute(f'SELECT * FROM "{self.table}"{where}{self.order_by}{self.max_rows}', self.params).fetchall()
+            elif kind == "update":
+                values = self.operation[1]
+                columns = ", ".join(f'"{column}" = ?' for column in values)
+                rows = db.execute(f'UPDATE "{self.table}" SET {columns}{where} RETURNING *', [*values.values(), *self.params]).fetchall()
+            elif kind == "delete":
+                rows = db.execute(f'DELETE FROM "{self.table}"{where} RETURNING *', self.params).fetchall()
+            else:
+                _, values, key, ignore_duplicates = self.operation
+                rows = []
+                db.execute("BEGIN IMMEDIATE")
+                for row in values:
+                    columns = ", ".join(f'"{column}"' for column in row)
+                    if ignore_duplicates:
+                        conflict = "DO NOTHING"
+                    else:
+                        conflict = "DO UPDATE SET " + ", ".join(f'"{column}" = excluded."{column}"' for column in row)
+                    sql = f'INSERT INTO "{self.table}" ({columns}) VALUES ({", ".join("?" * len(row))}) ON CONFLICT("{key}") {conflict} RETURNING *'
+                    rows.extend(db.execute(sql, list(row.values())).fetchall())
+                db.execute("COMMIT")
+
+        data = [dict(row) for row in rows]
+        if self.as_single:
+            if len(data) != 1:
+                raise ValueError(f"Expected a single row from {self.table}, found {len(data)}.")
+            data = data[0]
+        return fakes.FakeResponse(data)
+
+
+class SQLiteBackend(fakes.FakeBackend):
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def table(self, name: str) -> SQLiteQuery:
+        return SQLiteQuery(self.path, name)
+
+
+def create_database(path: str, files: int):
+    with closing(sqlite3.connect(path)) as db:
+        db.execute(f'CREATE TABLE "{settings.metadata_table}" (uuid TEXT PRIMARY KEY, file_id TEXT, raw_path TEXT, status TEXT)')
+        db.execute("CREATE TABLE processor_leases (uuid TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at TEXT NOT NULL, heartbeat_at TEXT NOT NULL)")
+        db.executemany(
+            f'INSERT INTO "{settings.metadata_table}" VALUES (?, ?, ?, ?)',
+            [(f"file-{i:03d}", f"file-{i:03d}.tif", f"/raw/{i}.tif", "pending") for i in range(files)]
+        )
+        db.commit()
+
+
+def connect(path: str, owner: str, ttl: float, heartbeat_interval: float) -> LeaseManager:
+    # point this process at the shared database
+    backend = SQLiteBackend(path)
+    auth.get_client = lambda: backend
+    auth.direct_authenticate_processor = backend.login
+
+    manager = LeaseManager(owner=owner, ttl=ttl, heartbeat_interval=heartbeat_interval)
+    metadata.get_leases = lambda: manager
+    return manager
+
+
+def claim_until_done(path: str, owner: str) -> List[str]:
+    manager = connect(path, owner, ttl=30.0, heartbeat_interval=1.0)
+    claimed = []
+    while True:
+        rows = claim_pending(limit=3)
+        if len(rows) == 0:
+            break
+        claimed.extend(rows)
+
+        # process the files
+        time.sleep(0.01)
+        update_metadata_batch({uuid: {"status": "processed"} for uuid in rows})
+        manager.release(list(rows))
+
+    manager.stop()
+    return claimed
+
+
+def claim_and_hang(path: str, claimed: multiprocessing.Queue):
+    connect(path, "doomed", ttl=1.0, heartbeat_interval=0.2)
+    claimed.put(list(claim_pending(limit=3)))
+    time.sleep(3600)
+
+
+@pytest.fixture
+def database(tmp_path, backend) -> str:
+    path = str(tmp_path / "backend.sqlite")
+    create_database(path, files=40)
+    return path
+
+
+def status_of(path: str) -> dict:
+    with closing(sqlite3.connect(path)) as db:
+        return dict(db.execute(f'SELECT uuid, status FROM "{settings.metadata_table}"').fetchall())
+
+
+def test_no_file_is_claimed_twice(database):
+    with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(claim_until_done, database, f"node-{i}") for i in range(4)]
+        claimed = [uuid for future in futures for uuid in future.result()]
+
+    assert len(claimed) == len(set(claimed)) == 40
+    assert set(status_of(database).values()) == {"processed"}
+
+
+def test_expired_leases_of_killed_nodes_are_reclaimed(database, monkeypatch):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    node = context.Process(target=claim_and_hang, args=(database, queue), daemon=True)
+    node.start()
+    doomed = queue.get(timeout=60)
+    assert len(doomed) == 3
+
+    monkeypatch.setattr(auth, "get_client", auth.get_client)
+    monkeypatch.setattr(auth, "direct_authenticate_processor", auth.direct_authenticate_processor)
+    monkeypatch.setattr(metadata, "get_leases", metadata.get_leases)
+    survivor = connect(database, "survivor", ttl=30.0, heartbeat_interval=1.0)
+
+    # the heartbeats keep the leases of a live node, even past their ttl
+    time.sleep(1.5)
+    assert survivor.reclaim() == []
+
+    node.kill()
+    node.join()
+    time.sleep(1.5)
+
+    claimed = claim_pending(limit=10)
+    assert set(doomed) <= set(claimed)
+    assert all(status_of(database)[uuid] == "processing" for uuid in doomed)
+    survivor.stop()
@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+import json
+
+import mappyfile
+import pytest
+
+from benchmarks import fakes
+from processor.utils.settings import settings
+from processor.files import include_in_mapfile, LAYERS_FILE
+from processor.mapserver import tileindex_band_stats, tileindex_layers
+from processor.config import config
+from processor import mapserver
+
+
+def load_mainfile() -> dict:
+    with open(settings.mapfile_path / "MAINFILE.map") as f:
+        return mappyfile.load(f, expand_includes=False)
+
+
+@pytest.mark.parametrize("remote", [False, True])
+def test_include_creates_missing_mainfile(tmp_path, remote):
+    fakes.install(str(tmp_path), remote=remote)
+    assert not (settings.mapfile_path / "MAINFILE.map").exists()
+
+    # the template already includes the layers file
+    include_in_mapfile(LAYERS_FILE)
+
+    mappy = load_mainfile()
+    assert mappy["include"].count(LAYERS_FILE) == 1
+    assert mappy["web"]["metadata"]["wms_onlineresource"] == settings.ows_base_url
+
+
+@pytest.mark.parametrize("remote", [False, True])
+def test_include_is_added_once(tmp_path, remote):
+    fakes.install(str(tmp_path), remote=remote)
+
+    include_in_mapfile("extra.map")
+    include_in_mapfile("extra.map")
+
+    mappy = load_mainfile()
+    assert mappy["include"].count("extra.map") == 1
+    assert LAYERS_FILE in mappy["include"]
+
+
+def test_tileindex_band_stats():
+    rows = [{f"{bound}_{band}": str(value + band) for band in (1, 2, 3) for bound, value in (("low", 0), ("high", 200))}]
+    assert tileindex_band_stats(rows) == [{"band": band, "clip": [float(band), 200.0 + band]} for band in (1, 2, 3)]
+
+    # an empty index or rasters without statistics fall back to automatic scaling
+    assert tileindex_band_stats([]) is None
+    assert tileindex_band_stats([{**rows[0], "high_2": ""}]) is None
+
+
+def test_tileindex_entry_scales_the_layer(monkeypatch):
+    added, layerfiles = [], {}
+    monkeypatch.setattr(mapserver, "append_tileindex", lambda fc, file_id, query=None: added.append(json.loads(fc)) or [
+        {"low_1": "1", "high_1": "250", "low_2": "2", "high_2": "240", "low_3": "3", "high_3": "230"}
+    ])
+    monkeypatch.setattr(mapserver, "put_layerfile", lambda name, content: layerfiles.update({name: content}) or f"layers/{name}.map")
+    monkeypatch.setattr(mapserver, "include_tileindex_layer", lambda relative_path: None)
+
+    metadata = SimpleNamespace(
+        file_id="a.tif",
+        processed_path="/data/processed/a.tif",
+        bbox=SimpleNamespace(left=10.0, bottom=50.0, right=11.0, top=51.0)
+    )
+    band_stats = [{"band": band, "clip": [band, 200 + band]} for band in (1, 2, 3)]
+    mapserver.add_tileindex_entry(metadata, band_stats)
+
+    properties = added[0]["features"][0]["properties"]
+    assert properties["clip_low_2"] == 2.0 and properties["clip_high_3"] == 203.0
+
+    # the raster layer is scaled by the union of the index, not by the new raster
+    layers = mappyfile.loads(layerfiles[config.tileindex_layer])
+    raster = [layer for layer in layers if layer["type"].lower() == "raster"][0]
+    assert "SCALE_1=1.0,250.0" in raster["processing"]
+    assert "SCALE_3=3.0,230.0" in raster["processing"]
+
+
+def test_tileindex_layers_without_statistics():
+    layers = mappyfile.loads(tileindex_layers())
+    raster = [layer for layer in layers if layer["type"].lower() == "raster"][0]
+    assert "SCALE=AUTO" in raster["processing"]
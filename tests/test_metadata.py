@@ -0,0 +1,125 @@
+import pytest
+
+from benchmarks import fakes
+from processor.utils.settings import settings
+from processor.metadata import claim_pending, update_metadata_batch, MetadataWriter
+
+from .conftest import metadata_rows
+
+
+def add_files(backend, n: int, status: str = "pending"):
+    rows = backend.tables.setdefault(settings.metadata_table, [])
+    for i in range(n):
+        rows.append(dict(uuid=f"{status}-{i}", file_id=f"{status}-{i}.tif", raw_path=f"/raw/{i}.tif", status=status, user_id="someone"))
+
+
+def fail_updates_of(monkeypatch, uuids):
+    # let the updates of some uuids fail in the backend
+    execute = fakes.FakeQuery.execute
+
+    def failing_execute(query):
+        if query.operation[0] == "update" and query.table == settings.metadata_table:
+            matches = [row for row in query.backend.tables[query.table] if all(f(row) for f in query.filters)]
+            if any(row["uuid"] in uuids for row in matches):
+                raise RuntimeError("backend unavailable")
+        return execute(query)
+
+    monkeypatch.setattr(fakes.FakeQuery, "execute", failing_execute)
+
+
+def test_claim_pending_flags_and_leases(backend, leases):
+    add_files(backend, 5)
+    add_files(backend, 2, status="processed")
+
+    claimed = claim_pending(limit=3)
+
+    assert len(claimed) == 3
+    assert all(row["status"] == "processing" for row in claimed.values())
+    rows = metadata_rows(backend)
+    assert sum(row["status"] == "processing" for row in rows.values()) == 3
+    assert {lease["uuid"] for lease in backend.tables["processor_leases"]} == set(claimed)
+
+    # the claimed files are not claimed again
+    again = claim_pending(limit=10)
+    assert len(again) == 2
+    assert not set(again) & set(claimed)
+
+
+def test_claim_pending_skips_leased_files(backend, leases):
+    add_files(backend, 2)
+    backend.tables["processor_leases"] = [dict(uuid="pending-0", owner="other", expires_at="9999-01-01T00:00:00+00:00", heartbeat_at="")]
+
+    claimed = claim_pending(limit=10)
+
+    assert list(claimed) == ["pending-1"]
+    assert metadata_rows(backend)["pending-0"]["status"] == "pending"
+
+
+def test_update_metadata_batch_keeps_other_columns(backend):
+    add_files(backend, 2, status="processing")
+
+    # another writer changes a column in the meantime
+    metadata_rows(backend)["processing-0"]["user_id"] = "someone else"
+    failed = update_metadata_batch({
+        "processing-0": {"status": "processed", "wms_source": "a"},
+        "processing-1": {"status": "errored"},
+    })
+
+    rows = metadata_rows(backend)
+    assert failed == []
+    assert rows["processing-0"]["status"] == "processed"
+    assert rows["processing-0"]["wms_source"] == "a"
+    assert rows["processing-0"]["user_id"] == "someone else"
+    assert rows["processing-1"]["status"] == "errored"
+
+
+def test_writer_batches_and_releases_leases(backend, leases):
+    add_files(backend, 5)
+    claimed = claim_pending(limit=5)
+    writer = MetadataWriter(batch_size=2)
+
+    for i, uuid in enumerate(claimed):
+        writer.add(uuid, {"status": "processed"})
+        # a batch is written once it is full
+        processed = sum(row["status"] == "processed" for row in metadata_rows(backend).values())
+        assert processed == (i + 1) // 2 * 2
+
+    writer.flush()
+    assert all(row["status"] == "processed" for row in metadata_rows(backend).values())
+    assert backend.tables["processor_leases"] == []
+
+
+def test_writer_abandons_leases_of_failed_updates(backend, leases, monkeypatch):
+    add_files(backend, 3)
+    claim_pending(limit=3)
+    fail_updates_of(monkeypatch, {"pending-1"})
+
+    writer = MetadataWriter(batch_size=10)
+    for uuid in ["pending-0", "pending-1", "pending-2"]:
+        writer.add(uuid, {"status": "processed"})
+    writer.flush()
+
+    rows = metadata_rows(backend)
+    assert rows["pending-1"]["status"] == "processing"
+    assert rows["pending-0"]["status"] == rows["pending-2"]["status"] == "processed"
+
+    # the failed file keeps its lease until it expires and is reclaimed, but it is not renewed anymore
+    assert [lease["uuid"] for lease in backend.tables["processor_leases"]] == ["pending-1"]
+    assert leases._held == set()
+
+
+def test_writer_abandons_leases_if_the_backend_fails(backend, leases, monkeypatch):
+    add_files(backend, 2)
+    claim_pending(limit=2)
+    def unavailable():
+        raise RuntimeError("backend unavailable")
+    monkeypatch.setattr("processor.metadata.supabase_client", unavailable)
+
+    writer = MetadataWriter(batch_size=10)
+    writer.add("pending-0", {"status": "processed"})
+    writer.add("pending-1", {"status": "processed"})
+    with pytest.raises(RuntimeError):
+        writer.flush()
+
+    assert len(backend.tables["processor_leases"]) == 2
+    assert leases._held == set()
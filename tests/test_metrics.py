@@ -0,0 +1,28 @@
+import pytest
+
+from processor.metrics import stage, stage_time, stage_errors
+
+
+def sample(metric, suffix: str, name: str) -> float:
+    for family in metric.collect():
+        for s in family.samples:
+            if s.name.endswith(suffix) and s.labels.get("stage") == name:
+                return s.value
+    return 0.0
+
+
+def test_stage_is_timed():
+    with stage("test-ok"):
+        pass
+
+    assert sample(stage_time, "_count", "test-ok") == 1
+    assert sample(stage_errors, "_total", "test-ok") == 0
+
+
+def test_failed_stage_is_timed_and_counted():
+    with pytest.raises(ValueError):
+        with stage("test-failed"):
+            raise ValueError("broken")
+
+    assert sample(stage_time, "_count", "test-failed") == 1
+    assert sample(stage_errors, "_total", "test-failed") == 1
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from processor.pipeline import Pipeline, Stage
+
+
+class Item:
+    def __init__(self, n: int):
+        self.n = n
+        self.error = None
+        self.seen = []
+
+
+def step(name: str, fail_on=()):
+    def func(item: Item) -> Item:
+        item.seen.append(name)
+        if item.n in fail_on:
+            raise ValueError(f"{name} failed on {item.n}")
+        return item
+    return func
+
+
+def run_with_timeout(pipeline: Pipeline, items, timeout: float = 10.0) -> list:
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(pipeline.run(items)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the pipeline did not finish"
+    return results
+
+
+def test_failed_items_skip_the_following_stages():
+    pipeline = Pipeline([
+        Stage("fetch", step("fetch"), workers=2),
+        Stage("resample", step("resample", fail_on={3, 5}), workers=2),
+        Stage("upload", step("upload"), workers=2),
+        Stage("publish", step("publish"), run_failed=True),
+    ])
+
+    results = run_with_timeout(pipeline, [Item(n) for n in range(10)])
+
+    assert sorted(item.n for item in results) == list(range(10))
+    for item in results:
+        if item.n in (3, 5):
+            assert isinstance(item.error, ValueError)
+            assert item.seen == ["fetch", "resample", "publish"]
+        else:
+            assert item.error is None
+            assert item.seen == ["fetch", "resample", "upload", "publish"]
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_shutdown_when_all_workers_of_a_stage_die():
+    def die(item: Item) -> Item:
+        # not an Exception, so the worker thread ends
+        raise SystemExit()
+
+    pipeline = Pipeline([
+        Stage("fetch", step("fetch"), workers=2, queue_size=1),
+        Stage("resample", die, workers=2, queue_size=1),
+        Stage("publish", step("publish"), queue_size=1, run_failed=True),
+    ])
+
+    # many more items than the queues hold, so the fetch stage would block on a dead stage
+    results = run_with_timeout(pipeline, [Item(n) for n in range(20)])
+
+    failed = [item for item in results if item.error is not None]
+    assert len(results) == 18
+    assert len(failed) == 18
+    assert all(item.seen == ["fetch", "publish"] for item in failed)
@@ -0,0 +1,67 @@
+import errno
+import os
+
+import pytest
+
+from processor import placement
+from processor.placement import place_file
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / "src.tif"
+    path.write_bytes(b"raster" * 1000)
+    return path
+
+
+def fail_for(monkeypatch, name: str, path, code: int):
+    # let os.<name> fail with the error code, if it is called with path as source
+    func = getattr(os, name)
+
+    def failing(a, b, *args, **kwargs):
+        if str(a) == str(path):
+            raise OSError(code, os.strerror(code))
+        return func(a, b, *args, **kwargs)
+
+    monkeypatch.setattr(os, name, failing)
+
+
+def test_move_renames(src, tmp_path):
+    dst = tmp_path / "dst.tif"
+    assert place_file(str(src), str(dst)) == 'rename'
+    assert not src.exists()
+    assert dst.read_bytes() == b"raster" * 1000
+
+
+def test_move_across_devices_falls_back_to_a_hardlink(src, tmp_path, monkeypatch):
+    fail_for(monkeypatch, "replace", src, errno.EXDEV)
+    dst = tmp_path / "dst.tif"
+    dst.write_bytes(b"old")
+
+    assert place_file(str(src), str(dst)) == 'hardlink'
+    assert not src.exists()
+    assert dst.read_bytes() == b"raster" * 1000
+    assert list(tmp_path.iterdir()) == [dst]
+
+
+def test_copy_falls_back_to_a_reflink_and_a_copy(src, tmp_path, monkeypatch):
+    fail_for(monkeypatch, "link", src, errno.EXDEV)
+    dst = tmp_path / "dst.tif"
+
+    # the filesystem might support reflinks
+    method = place_file(str(src), str(dst), keep_source=True)
+    assert method in ('reflink', 'copy')
+
+    def no_reflink(a, b):
+        raise OSError(errno.EOPNOTSUPP, "no reflinks")
+
+    monkeypatch.setattr(placement, "reflink", no_reflink)
+    assert place_file(str(src), str(dst), keep_source=True) == 'copy'
+    assert src.exists()
+    assert dst.read_bytes() == src.read_bytes()
+    assert sorted(tmp_path.iterdir()) == [dst, src]
+
+
+def test_other_errors_are_raised(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        place_file(str(tmp_path / "missing.tif"), str(tmp_path / "dst.tif"))
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import ColorInterp, MaskFlags
+from rasterio.transform import from_origin
+
+from processor.resample import resample, estimate_memory, BASE_MEMORY
+from processor.statistics import BandStatistics
+
+
+# the keyword arguments of resample for each of its engines
+MODES = {
+    "whole": dict(driver="GTiff"),
+    "windowed": dict(driver="GTiff", max_memory=1),
+    "cog": dict(driver="COG", blocksize=256),
+}
+
+
+@pytest.fixture(scope="module")
+def raw_file(tmp_path_factory) -> str:
+    """
+    A 1200x800 RGB raster in UTM with a nodata strip at the top.
+    """
+    data = np.random.default_rng(0).integers(1, 255, (3, 800, 1200), dtype=np.uint8)
+    data[:, :200, :] = 0
+    path = str(tmp_path_factory.mktemp("raw") / "raw.tif")
+    profile = dict(driver="GTiff", width=1200, height=800, count=3, dtype="uint8", crs="EPSG:32632", nodata=0, transform=from_origin(500000, 5000000, 0.5, 0.5))
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    return path
+
+
+@pytest.fixture(scope="module")
+def outputs(raw_file, tmp_path_factory) -> dict:
+    out_dir = tmp_path_factory.mktemp("processed")
+    results = {}
+    for mode, options in MODES.items():
+        path = str(out_dir / f"{mode}.tif")
+        statistics = BandStatistics(3, "uint8")
+        bounds = resample(raw_file, path, scale_factor=0.5, compress="deflate", statistics=statistics, **options)
+        results[mode] = (path, bounds, statistics.result())
+    return results
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_output_is_reprojected_with_an_internal_mask(outputs, mode):
+    path, bounds, _ = outputs[mode]
+
+    with rasterio.open(path) as dst:
+        assert dst.crs.to_epsg() == 4326
+        assert tuple(dst.bounds) == pytest.approx(tuple(bounds))
+        assert dst.count == 3
+        assert ColorInterp.alpha not in dst.colorinterp
+        assert dst.mask_flag_enums[0] == [MaskFlags.per_dataset]
+
+        # the nodata strip is masked, about a quarter of the footprint
+        valid = (dst.dataset_mask() > 0).mean()
+        assert 0.5 < valid < 0.8
+
+
+def test_engines_agree(outputs):
+    with rasterio.open(outputs["whole"][0]) as whole:
+        expected, expected_mask = whole.read(), whole.dataset_mask()
+
+    for mode in ("windowed", "cog"):
+        with rasterio.open(outputs[mode][0]) as dst:
+            assert (dst.width, dst.height) == (whole.width, whole.height)
+            # the strips are warped separately, so single pixels at their edges may differ
+            assert (dst.dataset_mask() != expected_mask).mean() < 0.01
+            assert (dst.read() == expected).mean() > 0.99
+
+
+def test_statistics_of_the_engines(outputs):
+    whole = outputs["whole"][2]
+    assert len(whole) == 3
+    assert all(1 <= s["clip"][0] < s["clip"][1] <= 254 for s in whole)
+
+    # the windowed engine sees the same pixels, the COG engine reads an overview
+    assert outputs["windowed"][2] == pytest.approx(whole, rel=0.01)
+    for cog, expected in zip(outputs["cog"][2], whole):
+        assert cog["clip"] == pytest.approx(expected["clip"], abs=3)
+
+
+def test_cog_has_overviews(outputs):
+    with rasterio.open(outputs["cog"][0]) as dst:
+        assert dst.overviews(1)[0] == 2
+        assert dst.block_shapes[0] == (256, 256)
+
+
+def test_estimate_memory(raw_file):
+    # the windowed engine stays within max_memory
+    assert estimate_memory(raw_file, 0.5, "GTiff", max_memory=64) == BASE_MEMORY + 64
+
+    whole = estimate_memory(raw_file, 0.5, "GTiff")
+    assert BASE_MEMORY < whole < BASE_MEMORY + 64
+    assert estimate_memory(raw_file, 1.0, "GTiff") > whole
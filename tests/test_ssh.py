@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+from paramiko import SSHException
+
+from processor.ssh import ConnectionPool
+from benchmarks.fakes import FakeConnection
+
+
+class CountingFactory:
+    """
+    A stand-in for the SSH server, that counts the connections opened to it.
+    """
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self) -> FakeConnection:
+        connection = FakeConnection()
+        self.opened.append(connection)
+        return connection
+
+
+def test_connections_are_reused():
+    factory = CountingFactory()
+    pool = ConnectionPool(factory, max_size=2)
+
+    for _ in range(5):
+        with pool.connection() as c:
+            c.run("true")
+
+    assert len(factory.opened) == 1
+    pool.close()
+
+
+def test_pool_size_is_bounded():
+    factory = CountingFactory()
+    pool = ConnectionPool(factory, max_size=2)
+    busy = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal busy, peak
+        with pool.connection():
+            with lock:
+                busy += 1
+                peak = max(peak, busy)
+            time.sleep(0.05)
+            with lock:
+                busy -= 1
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert peak == 2
+    assert len(factory.opened) == 2
+    pool.close()
+
+
+def test_acquire_times_out():
+    pool = ConnectionPool(CountingFactory(), max_size=1, acquire_timeout=0.1)
+    connection = pool.acquire()
+
+    t1 = time.monotonic()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    assert time.monotonic() - t1 < 1.0
+
+    pool.release(connection)
+    pool.close()
+
+
+def test_idle_connections_are_closed_in_the_background():
+    factory = CountingFactory()
+    pool = ConnectionPool(factory, max_size=2, idle_timeout=0.5)
+    with pool.connection():
+        pass
+
+    # nobody asks for a connection in the meantime
+    time.sleep(2.0)
+    assert not factory.opened[0].is_connected
+    assert pool._size == 0
+    pool.close()
+
+
+def test_remote_file_errors_keep_the_connection():
+    factory = CountingFactory()
+    pool = ConnectionPool(factory, max_size=1)
+
+    with pytest.raises(FileNotFoundError):
+        with pool.connection() as c:
+            c.sftp().stat("/does/not/exist")
+    with pool.connection():
+        pass
+
+    assert len(factory.opened) == 1
+    assert factory.opened[0].is_connected
+    pool.close()
+
+
+def test_broken_connections_are_replaced():
+    factory = CountingFactory()
+    pool = ConnectionPool(factory, max_size=1)
+
+    with pytest.raises(SSHException):
+        with pool.connection():
+            raise SSHException("connection reset")
+
+    # an OSError on a dead transport discards the connection as well
+    with pytest.raises(OSError):
+        with pool.connection() as c:
+            c.close()
+            raise OSError("socket closed")
+
+    with pool.connection() as c:
+        assert c.is_connected
+
+    assert len(factory.opened) == 3
+    pool.close()
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from processor import statistics
+from processor.statistics import BandStatistics
+
+
+def blocks(data: np.ndarray, rows: int):
+    # split a raster into strips, like the windowed resampling
+    for row in range(0, data.shape[1], rows):
+        yield data[:, row:row + rows]
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "int16"])
+def test_integer_bands_have_exact_percentiles(dtype):
+    info = np.iinfo(dtype)
+    data = np.random.default_rng(0).integers(max(info.min, -1000), min(info.max, 1000), (3, 300, 200), endpoint=True).astype(dtype)
+    stats = BandStatistics(3, dtype, nodata=0)
+    for block in blocks(data, 64):
+        stats.update(block)
+
+    assert stats.exact
+    valid = ~np.all(data == 0, axis=0)
+    for band, result in enumerate(stats.result((2.0, 98.0))):
+        values = data[band][valid]
+        assert result["clip"] == [float(v) for v in np.percentile(values, [2.0, 98.0], method="inverted_cdf")]
+        assert result["min"] == values.min()
+        assert result["max"] == values.max()
+        assert result["mean"] == pytest.approx(values.mean())
+        assert result["std"] == pytest.approx(values.std())
+
+
+def test_float_bands_are_subsampled(monkeypatch):
+    monkeypatch.setattr(statistics, "MAX_SAMPLES", 10_000)
+    data = np.random.default_rng(0).normal(100, 10, (2, 1000, 500)).astype("float32")
+    stats = BandStatistics(2, "float32", nodata=np.nan)
+    for block in blocks(data, 100):
+        stats.update(block)
+
+    assert not stats.exact
+    assert all(0 < sampled <= 2 * 10_000 for sampled in stats.sampled)
+
+    # the subsample is close to the percentiles of all pixels
+    for band, result in enumerate(stats.result((2.0, 98.0))):
+        exact = np.percentile(data[band], [2.0, 98.0])
+        assert result["clip"] == pytest.approx(exact, rel=0.02)
+        assert result["mean"] == pytest.approx(data[band].mean(dtype=np.float64))
+
+
+def test_masked_pixels_are_left_out():
+    data = np.full((3, 10, 10), 200, dtype="uint8")
+    data[:, :, :5] = 7
+    mask = np.zeros((10, 10), dtype=bool)
+    mask[:, 5:] = True
+
+    stats = BandStatistics(3, "uint8")
+    stats.update(data, mask)
+    result = stats.result()
+
+    assert [s["clip"] for s in result] == [[200.0, 200.0]] * 3
+    assert result[0]["valid_percent"] == 50.0
+
+
+def test_no_valid_pixels():
+    stats = BandStatistics(1, "uint8")
+    stats.update(np.zeros((1, 10, 10), dtype="uint8"))
+    assert stats.result() == []
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from processor.tiles import ORIGIN, TILE_SIZE, tile_range, zoom_range, overview_level, render_pyramid
+
+
+# the resolution of the tiles at zoom 12
+RESOLUTION = 2 * ORIGIN / 2**12 / TILE_SIZE
+
+
+@pytest.fixture
+def raster(tmp_path) -> str:
+    """
+    A 512x512 RGB raster in Web Mercator at the resolution of zoom 12, with an
+    internal mask leaving out the left half and overviews of factor 2 and 4.
+    """
+    data = np.random.default_rng(0).integers(1, 255, (3, 512, 512), dtype=np.uint8)
+    mask = np.zeros((512, 512), dtype=bool)
+    mask[:, 256:] = True
+
+    path = str(tmp_path / "raster.tif")
+    profile = dict(driver="GTiff", width=512, height=512, count=3, dtype="uint8", crs="EPSG:3857", tiled=True)
+    # align the raster with the tile grid of zoom 12
+    transform = from_origin(-ORIGIN + 1000 * TILE_SIZE * RESOLUTION, ORIGIN - 1000 * TILE_SIZE * RESOLUTION, RESOLUTION, RESOLUTION)
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True), rasterio.open(path, "w", transform=transform, **profile) as dst:
+        dst.write(data)
+        dst.write_mask(mask)
+        dst.build_overviews([2, 4])
+    return path
+
+
+def test_tile_range():
+    # the whole world is covered by all tiles
+    assert tile_range((-ORIGIN, -ORIGIN, ORIGIN, ORIGIN), 0) == (0, 0, 0, 0)
+    assert tile_range((-ORIGIN, -ORIGIN, ORIGIN, ORIGIN), 2) == (0, 0, 3, 3)
+
+    # a small area in the upper right quarter
+    size = 2 * ORIGIN / 2**3
+    assert tile_range((size * 0.5, size * 1.5, size * 1.5, size * 2.5), 3) == (4, 1, 5, 2)
+
+
+def test_zoom_range(raster):
+    min_zoom, max_zoom, bounds = zoom_range(raster)
+
+    # two tiles wide at the native zoom 12, one tile at zoom 11
+    assert (min_zoom, max_zoom) == (11, 12)
+    assert bounds[2] - bounds[0] == pytest.approx(512 * RESOLUTION)
+
+
+def test_overview_level(raster):
+    assert overview_level(raster, 12) is None
+    assert overview_level(raster, 11) == 0
+    assert overview_level(raster, 10) == 1
+    assert overview_level(raster, 5) == 1
+
+
+def test_render_pyramid(raster, tmp_path):
+    out_dir = tmp_path / "tiles"
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        min_zoom, max_zoom, count = render_pyramid(raster, str(out_dir), fmt="png", min_zoom=10, executor=executor)
+
+    # zoom 12 has two columns of tiles, but the left one is masked
+    assert (min_zoom, max_zoom) == (10, 12)
+    assert count == 1 + 1 + 2
+    assert sorted(p.relative_to(out_dir).as_posix() for p in out_dir.rglob("*.png")) == [
+        "10/250/250.png", "11/500/500.png", "12/1001/1000.png", "12/1001/1001.png"
+    ]
+
+    with rasterio.open(out_dir / "11" / "500" / "500.png") as tile:
+        rgba = tile.read()
+    assert rgba.shape == (4, TILE_SIZE, TILE_SIZE)
+
+    # the masked half of the raster is transparent
+    assert (rgba[3, :, :120] == 0).all()
+    assert (rgba[3, :, 136:] == 255).all()